@@ -1,9 +1,11 @@
 """
 Модуль для административных команд
 """
+import asyncio
 import logging
 from telegram import Update
 from telegram.ext import ContextTypes
+from telegram.helpers import escape_markdown
 
 from config import is_admin, read_prompt, write_prompt, reset_prompt
 
@@ -21,7 +23,7 @@ async def cmd_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         return
     
     try:
-        current_prompt = read_prompt()
+        current_prompt = await asyncio.to_thread(read_prompt)
         
         message = f"📝 **Текущий системный промпт:**\n\n```\n{current_prompt}\n```"
         
@@ -68,7 +70,7 @@ async def cmd_setprompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     
     try:
-        success = write_prompt(new_prompt)
+        success = await write_prompt(new_prompt)
         
         if success:
             await update.message.reply_text("✅ Промпт обновлён.")
@@ -92,7 +94,7 @@ async def cmd_resetprompt(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     
     try:
-        success = reset_prompt()
+        success = await reset_prompt()
         
         if success:
             await update.message.reply_text("✅ Промпт сброшен к значению по умолчанию.")
@@ -116,21 +118,13 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     try:
-        from config import DEBUG_SEND_VOICE, ADMIN_IDS, MAX_MESSAGES_PER_SESSION, SESSION_DURATION_MINUTES
-        from utils import TEMP_DIR
-        import os
-        
-        # Подсчитываем временные файлы
-        temp_files_count = len(list(TEMP_DIR.glob('*'))) if TEMP_DIR.exists() else 0
-        
-        # Размер директории с временными файлами
-        temp_dir_size = 0
-        if TEMP_DIR.exists():
-            for file_path in TEMP_DIR.rglob('*'):
-                if file_path.is_file():
-                    temp_dir_size += file_path.stat().st_size
+        import config
+        from metrics import metrics
+        from temp_files import temp_file_manager
+        from hedging import hedger
+        from token_budget import token_budget
         
-        temp_dir_size_mb = temp_dir_size / (1024 * 1024)
+        snapshot = metrics.snapshot()
         
         # Получаем информацию о заблокированных пользователях
         try:
@@ -139,35 +133,67 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         except Exception:
             blocked_count = 0
         
-        # Получаем информацию о токенах
-        try:
-            from config import get_current_max_tokens
-            current_tokens = get_current_max_tokens()
-        except Exception:
-            current_tokens = "Неизвестно"
+        # Длина промпта обновляется при чтении и записи; до первого запроса читаем файл один раз
+        prompt_chars = metrics.get_gauge('prompt_chars')
+        if prompt_chars is None:
+            prompt_chars = len(await asyncio.to_thread(read_prompt))
+        
+        stages = snapshot['stages']
+        stage_lines = "\n".join(
+            f"• {name}: в работе {stage['in_flight']}, успешно {stage['ok']}, "
+            f"ошибок {stage['failed']}, среднее {stage['avg_seconds']:.1f} с"
+            for name, stage in sorted(stages.items())
+        ) or "• Нет данных"
+        
+        hedge_lines = "\n".join(
+            f"• {endpoint}: запросов {stats['requests']}, дублей {stats['hedge_rate']:.1%}, "
+            f"дубль быстрее {stats['win_rate']:.0%}"
+            for endpoint, stats in sorted(hedger.stats().items())
+        ) if hedger.enabled else "• Выключены"
+        
+        counters = snapshot['counters']
+        uptime_minutes = int(snapshot['uptime_seconds'] // 60)
         
         stats_message = f"""📊 **Статистика бота:**
 
 🔧 **Настройки:**
-• DEBUG_SEND_VOICE: {DEBUG_SEND_VOICE}
-• Администраторов: {len([aid for aid in ADMIN_IDS if aid != 0])}
+• DEBUG_SEND_VOICE: {config.DEBUG_SEND_VOICE}
+• Администраторов: {len([aid for aid in config.ADMIN_IDS if aid != 0])}
+• Время работы: {uptime_minutes // 60} ч {uptime_minutes % 60} мин
+• Первое обновление после запуска: {metrics.get_gauge('startup.first_update_seconds') or '—'} с
 
 ⏱️ **Лимиты сессий:**
-• Максимум сообщений: {MAX_MESSAGES_PER_SESSION}
-• Длительность сессии: {SESSION_DURATION_MINUTES} минут
+• Максимум сообщений: {config.MAX_MESSAGES_PER_SESSION}
+• Длительность сессии: {config.SESSION_DURATION_MINUTES} минут
 
 🎯 **Настройки GPT:**
-• Лимит токенов: {current_tokens}
+• Лимит токенов: {config.MAX_TOKENS}
+• Бюджет TPM: {token_budget.used()} из {config.GPT_TOKENS_PER_MINUTE or '∞'}, в очереди {token_budget.waiting}, ожиданий: {counters.get('gpt.tpm_waits', 0)}
+
+👥 **Сессии:**
+• Активных: {snapshot['active_sessions']}
+• Начато с запуска: {counters.get('sessions.started', 0)}
+• Голосовых сообщений: {counters.get('voice.received', 0)}
+• Из кэша транскриптов: {counters.get('stt.cache_hits', 0)}
+• Без уверенной речи (GPT и TTS пропущены): {counters.get('stt.low_confidence_skipped', 0)}
+• В очереди: {snapshot['gauges'].get('queue.waiting', 0)}, отклонено при перегрузке: {counters.get('queue.shed', 0)}
+• Отменено обработок: {counters.get('cancel.total', 0)} (сэкономлено GPT: {counters.get('cancel.saved_gpt_calls', 0)}, TTS: {counters.get('cancel.saved_tts_calls', 0)})
+
+⚙️ **Этапы обработки:**
+{stage_lines}
+
+🔁 **Дублирующие запросы:**
+{hedge_lines or '• Нет данных'}
 
 🚫 **Заблокированные пользователи:**
 • Количество: {blocked_count}
 
 📁 **Временные файлы:**
-• Количество: {temp_files_count}
-• Размер: {temp_dir_size_mb:.2f} MB
+• Количество: {temp_file_manager.file_count} (ещё не записано: {temp_file_manager.reserved_count})
+• Размер: {temp_file_manager.total_bytes / (1024 * 1024):.2f} MB
 
 📝 **Промпт:**
-• Длина: {len(read_prompt())} символов
+• Длина: {prompt_chars} символов
 """
         
         await update.message.reply_text(
@@ -196,9 +222,9 @@ async def cmd_cleanup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         from utils import cleanup_old_temp_files
         
         # Очищаем файлы старше 1 часа
-        cleanup_old_temp_files(max_age_hours=1)
+        removed = await asyncio.to_thread(cleanup_old_temp_files, 1)
         
-        await update.message.reply_text("✅ Временные файлы очищены.")
+        await update.message.reply_text(f"✅ Временные файлы очищены (удалено: {removed}).")
         logger.info(f"Админ {user_id} запустил очистку временных файлов")
         
     except Exception as e:
@@ -291,7 +317,7 @@ async def cmd_unblock_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             await update.message.reply_text(f"❌ Пользователь {target_user_id} не заблокирован.")
             return
         
-        success = user_limit_manager.unblock_user(target_user_id)
+        success = await user_limit_manager.unblock_user(target_user_id)
         
         if success:
             await update.message.reply_text(f"✅ Пользователь {target_user_id} разблокирован.")
@@ -341,7 +367,7 @@ async def cmd_block_user(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await update.message.reply_text(f"❌ Пользователь {target_user_id} уже заблокирован.")
             return
         
-        success = user_limit_manager.block_user(
+        success = await user_limit_manager.block_user(
             user_id=target_user_id,
             reason=reason
         )
@@ -383,7 +409,7 @@ async def cmd_cleanup_blocks(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try:
         from user_limits import user_limit_manager
         
-        removed_count = user_limit_manager.cleanup_old_blocks(days_old)
+        removed_count = await user_limit_manager.cleanup_old_blocks(days_old)
         
         await update.message.reply_text(
             f"✅ Удалено {removed_count} старых блокировок (старше {days_old} дней)."
@@ -471,7 +497,7 @@ async def cmd_setlimits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     try:
         from config import write_limits
         
-        success = write_limits(max_messages, session_duration)
+        success = await write_limits(max_messages, session_duration)
         
         if success:
             await update.message.reply_text(
@@ -501,7 +527,7 @@ async def cmd_resetlimits(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     try:
         from config import reset_limits, get_current_limits
         
-        success = reset_limits()
+        success = await reset_limits()
         
         if success:
             max_messages, session_duration = get_current_limits()
@@ -544,7 +570,7 @@ async def cmd_clear_all_blocks(update: Update, context: ContextTypes.DEFAULT_TYP
             return
         
         # Выполняем полную очистку
-        cleared_count = user_limit_manager.clear_all_blocks()
+        cleared_count = await user_limit_manager.clear_all_blocks()
         
         await update.message.reply_text(
             f"🕛 **Выполнена полная очистка блокировок**\n\n"
@@ -642,7 +668,7 @@ async def cmd_settokens(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     try:
         from config import write_max_tokens
         
-        success = write_max_tokens(max_tokens)
+        success = await write_max_tokens(max_tokens)
         
         if success:
             await update.message.reply_text(
@@ -674,7 +700,7 @@ async def cmd_resettokens(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         from config import reset_max_tokens, get_current_max_tokens
         import os
         
-        success = reset_max_tokens()
+        success = await reset_max_tokens()
         
         if success:
             current_tokens = get_current_max_tokens()
@@ -693,4 +719,81 @@ async def cmd_resettokens(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             
     except Exception as e:
         logger.error(f"Ошибка команды /resettokens: {e}")
-        await update.message.reply_text("❌ Ошибка при сбросе лимита токенов.")
\ No newline at end of file
+        await update.message.reply_text("❌ Ошибка при сбросе лимита токенов.")
+
+async def cmd_analytics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Команда /analytics - сводка по сессиям за период
+    Использование: /analytics [дни] (по умолчанию 7 дней)
+    Доступна только администраторам
+    """
+    user_id = update.effective_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+        return
+    
+    # Получаем период
+    days = 7
+    if context.args:
+        try:
+            days = int(context.args[0])
+            if days < 1:
+                await update.message.reply_text("❌ Количество дней должно быть больше 0.")
+                return
+        except ValueError:
+            await update.message.reply_text("❌ Некорректное количество дней.")
+            return
+    
+    try:
+        from analytics import analytics_store
+        
+        summary = await analytics_store.summary(days)
+        
+        reasons = {
+            'completed': 'завершены',
+            'expired': 'истекло время',
+            'message_limit': 'лимит сообщений',
+            'cancel': '/cancel',
+            'restart': 'повторный /start',
+            'blocked': 'заблокирован',
+            'idle': 'брошены без завершения',
+        }
+        reason_lines = "\n".join(
+            f"• {reasons.get(reason) or escape_markdown(reason)}: {count}"
+            for reason, count in summary['end_reasons'].items()
+        ) or "• Нет данных"
+        
+        daily_lines = "\n".join(
+            f"`{day}` {users} польз., {sessions} сесс., STT {stt:.1f} с, GPT {gpt:.1f} с, TTS {tts:.1f} с"
+            for day, users, sessions, stt, gpt, tts in summary['daily']
+        ) or "Нет данных"
+        
+        message = f"""📈 **Статистика сессий за {days} дн.:**
+
+👥 **Пользователи и сессии:**
+• Уникальных пользователей: {summary['users']}
+• Сессий: {summary['sessions']}
+
+💬 **Обменов за сессию:**
+• В среднем: {summary['avg_exchanges']:.1f}
+• Медиана: {summary['median_exchanges']:.1f}
+
+❗ **Доля ошибок:** {summary['error_rate'] * 100:.1f}%
+
+🏁 **Причины завершения:**
+{reason_lines}
+
+📅 **По дням (среднее время этапов на обмен):**
+{daily_lines}"""
+        
+        await update.message.reply_text(
+            message,
+            parse_mode='Markdown'
+        )
+        
+        logger.info(f"Админ {user_id} запросил статистику сессий за {days} дн.")
+        
+    except Exception as e:
+        logger.error(f"Ошибка команды /analytics: {e}")
+        await update.message.reply_text("❌ Ошибка при получении статистики сессий.")
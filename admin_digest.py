@@ -0,0 +1,206 @@
+"""
+Сводки для администраторов вместо копии каждого сообщения
+
+В режиме ADMIN_MIRROR_MODE=session транскрипты и ответы сессии копятся
+в памяти и отправляются одной сводкой при завершении сессии или после
+ADMIN_DIGEST_IDLE_MINUTES без активности. В режиме window все сессии
+за ADMIN_DIGEST_WINDOW_MINUTES отправляются одной сводкой.
+Голосовые сообщения прикладываются по file_id, если ADMIN_DIGEST_VOICE=true.
+"""
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from telegram import Bot
+from telegram.error import TelegramError
+
+from config import (
+    ADMIN_IDS, ADMIN_MIRROR_MODE, ADMIN_DIGEST_WINDOW_MINUTES,
+    ADMIN_DIGEST_IDLE_MINUTES, ADMIN_DIGEST_VOICE
+)
+from metrics import metrics
+from rate_limiter import Priority
+
+logger = logging.getLogger(__name__)
+
+# Лимит длины сообщения Telegram (4096) с запасом
+_MAX_MESSAGE_LENGTH = 4000
+
+_ICONS = {
+    'STT': '🗣',
+    'GPT': '🤖',
+    'Voice (user)': '🎤',
+    'Voice (bot)': '🔊',
+}
+
+@dataclass
+class DigestEntry:
+    """Одна запись сводки"""
+    time: datetime
+    kind: str
+    text: Optional[str] = None
+    voice_file_id: Optional[str] = None
+
+@dataclass
+class SessionDigest:
+    """Записи одной сессии пользователя"""
+    user_id: int
+    user_name: str
+    started_at: datetime = field(default_factory=datetime.now)
+    last_activity: float = field(default_factory=time.monotonic)
+    entries: List[DigestEntry] = field(default_factory=list)
+    end_reason: Optional[str] = None
+
+class AdminDigest:
+    """Накопитель сводок для администраторов"""
+
+    def __init__(self, mode: str, window_seconds: float, idle_seconds: float, attach_voice: bool):
+        self.mode = mode
+        self.window_seconds = window_seconds
+        self.idle_seconds = idle_seconds
+        self.attach_voice = attach_voice
+        self._sessions: Dict[int, SessionDigest] = {}
+        self._window_started = time.monotonic()
+        # Бот, через который отправляются сводки по таймеру
+        self._bot: Optional[Bot] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ('session', 'window')
+
+    def add(self, bot: Bot, user_id: int, user_name: str, kind: str,
+            text: Optional[str] = None, voice_file_id: Optional[str] = None) -> None:
+        """Добавляет запись в сводку сессии пользователя"""
+        self._bot = bot
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = self._sessions[user_id] = SessionDigest(user_id, user_name)
+        session.user_name = user_name
+        session.last_activity = time.monotonic()
+        session.entries.append(DigestEntry(datetime.now(), kind, text, voice_file_id))
+
+    async def end_session(self, user_id: int, end_reason: str) -> None:
+        """Сессия завершена: в режиме session сводка отправляется сразу"""
+        session = self._sessions.get(user_id)
+        if session is None:
+            return
+        session.end_reason = end_reason
+        if self.mode == 'session':
+            del self._sessions[user_id]
+            await self._send([session])
+
+    async def flush_due(self) -> None:
+        """Отправляет сводки, срок которых подошёл (вызывается планировщиком)"""
+        now = time.monotonic()
+        if self.mode == 'session':
+            idle = [
+                user_id for user_id, session in self._sessions.items()
+                if now - session.last_activity >= self.idle_seconds
+            ]
+            for user_id in idle:
+                session = self._sessions.pop(user_id)
+                session.end_reason = session.end_reason or 'idle'
+                await self._send([session])
+        elif self.mode == 'window' and now - self._window_started >= self.window_seconds:
+            await self.flush_all()
+
+    async def flush_all(self) -> None:
+        """Отправляет всё накопленное (окно истекло или бот останавливается)"""
+        self._window_started = time.monotonic()
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        if sessions:
+            await self._send(sessions)
+
+    def _render(self, sessions: List[SessionDigest]) -> str:
+        """Формирует текст сводки"""
+        lines = []
+        if self.mode == 'window':
+            lines.append(f"📋 Сводка за {self.window_seconds / 60:.0f} мин, сессий: {len(sessions)}")
+            lines.append("")
+
+        for session in sessions:
+            exchanges = sum(1 for entry in session.entries if entry.kind == 'GPT')
+            ended = session.entries[-1].time if session.entries else session.started_at
+            header = (
+                f"📋 {session.user_name} (id {session.user_id}), "
+                f"{session.started_at.strftime('%H:%M')}–{ended.strftime('%H:%M')}, обменов: {exchanges}"
+            )
+            if session.end_reason:
+                header += f", завершение: {session.end_reason}"
+            lines.append(header)
+
+            for entry in session.entries:
+                icon = _ICONS.get(entry.kind, '•')
+                if entry.text:
+                    lines.append(f"[{entry.time.strftime('%H:%M:%S')}] {icon} {entry.text}")
+            lines.append("")
+
+        return "\n".join(lines).strip()
+
+    @staticmethod
+    def _split(text: str) -> List[str]:
+        """Делит текст на части по границам строк в пределах лимита Telegram"""
+        chunks: List[str] = []
+        current = ""
+        for line in text.split("\n"):
+            while len(line) > _MAX_MESSAGE_LENGTH:
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(line[:_MAX_MESSAGE_LENGTH])
+                line = line[_MAX_MESSAGE_LENGTH:]
+            if current and len(current) + len(line) + 1 > _MAX_MESSAGE_LENGTH:
+                chunks.append(current)
+                current = line
+            else:
+                current = f"{current}\n{line}" if current else line
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def _send(self, sessions: List[SessionDigest]) -> None:
+        """Отправляет сводку всем администраторам"""
+        if not ADMIN_IDS or self._bot is None:
+            return
+
+        chunks = self._split(self._render(sessions))
+        voices = [
+            (session.user_name, entry)
+            for session in sessions for entry in session.entries
+            if self.attach_voice and entry.voice_file_id
+        ]
+
+        for admin_id in ADMIN_IDS:
+            if admin_id == 0:  # Пропускаем некорректные ID
+                continue
+
+            try:
+                for chunk in chunks:
+                    await self._bot.send_message(
+                        chat_id=admin_id, text=chunk, rate_limit_args=Priority.ADMIN
+                    )
+                for user_name, entry in voices:
+                    await self._bot.send_voice(
+                        chat_id=admin_id,
+                        voice=entry.voice_file_id,
+                        caption=f"[{user_name}] {entry.kind} {entry.time.strftime('%H:%M:%S')}",
+                        rate_limit_args=Priority.ADMIN
+                    )
+            except TelegramError as e:
+                logger.error(f"Ошибка отправки сводки админу {admin_id}: {e}")
+            except Exception as e:
+                logger.error(f"Неожиданная ошибка при отправке сводки админу {admin_id}: {e}")
+
+        metrics.inc('admin_digest.sent')
+        logger.info(f"Сводка для администраторов отправлена: сессий {len(sessions)}, частей {len(chunks)}")
+
+# Глобальный экземпляр
+admin_digest = AdminDigest(
+    mode=ADMIN_MIRROR_MODE,
+    window_seconds=ADMIN_DIGEST_WINDOW_MINUTES * 60,
+    idle_seconds=ADMIN_DIGEST_IDLE_MINUTES * 60,
+    attach_voice=ADMIN_DIGEST_VOICE
+)
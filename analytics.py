@@ -0,0 +1,242 @@
+"""
+Хранилище статистики сессий (SQLite)
+
+Завершённые сессии накапливаются в памяти и записываются пачками в
+фоновом потоке (по размеру пачки или задачей планировщика). Сессии,
+брошенные без явного завершения, записываются с причиной 'idle' после
+ANALYTICS_IDLE_MINUTES без активности. Агрегатные запросы для
+администраторов выполняются по индексам и не блокируют цикл событий.
+"""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, astuple
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from config import DATA_DIR, ANALYTICS_BATCH_SIZE, ANALYTICS_IDLE_MINUTES
+
+logger = logging.getLogger(__name__)
+
+# Файл базы статистики
+ANALYTICS_DB = DATA_DIR / 'analytics.db'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    day TEXT NOT NULL,
+    duration_seconds REAL NOT NULL,
+    exchanges INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    end_reason TEXT NOT NULL,
+    stt_seconds REAL NOT NULL,
+    gpt_seconds REAL NOT NULL,
+    tts_seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_day ON sessions (day, user_id);
+CREATE INDEX IF NOT EXISTS idx_sessions_started ON sessions (started_at);
+"""
+
+@dataclass
+class SessionRecord:
+    """Итоги одной сессии"""
+    user_id: int
+    started_at: float  # unix time
+    duration_seconds: float
+    exchanges: int
+    errors: int
+    end_reason: str
+    stt_seconds: float = 0.0  # суммарное время этапов за сессию
+    gpt_seconds: float = 0.0
+    tts_seconds: float = 0.0
+
+    @classmethod
+    def from_latencies(cls, user_id: int, started_at: float, duration_seconds: float, exchanges: int,
+                       errors: int, end_reason: str, latencies: Dict[str, float]) -> 'SessionRecord':
+        """Создаёт запись из словаря времени этапов (см. metrics.stage)"""
+        return cls(
+            user_id, started_at, duration_seconds, exchanges, errors, end_reason,
+            latencies.get('stt', 0.0), latencies.get('gpt', 0.0), latencies.get('tts', 0.0)
+        )
+
+class _OpenSession:
+    """Незавершённая сессия: данные пользователя и время последней активности"""
+    __slots__ = ('started_at', 'user_data', 'last_activity')
+
+    def __init__(self, started_at: float, user_data: Dict[str, Any]):
+        self.started_at = started_at
+        self.user_data = user_data
+        self.last_activity = time.time()
+
+class AnalyticsStore:
+    """Пакетная запись сессий и агрегатные запросы"""
+
+    def __init__(self, db_path: Path, batch_size: int, idle_seconds: float):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.idle_seconds = idle_seconds
+        self._pending: List[SessionRecord] = []
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._open: Dict[int, _OpenSession] = {}
+        # Сессии, уже записанные как брошенные: (user_id, started_at)
+        self._expired: Set[Tuple[int, float]] = set()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Открывает базу при первом обращении (вызывается под блокировкой)"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def session_started(self, user_id: int, started_at: float, user_data: Dict[str, Any]) -> None:
+        """Начинает отслеживать сессию, чтобы записать её, даже если она не будет завершена"""
+        self._open[user_id] = _OpenSession(started_at, user_data)
+
+    def touch(self, user_id: int) -> None:
+        """Отмечает активность в сессии пользователя"""
+        session = self._open.get(user_id)
+        if session is not None:
+            session.last_activity = time.time()
+
+    def record(self, session: SessionRecord) -> None:
+        """Добавляет сессию в очередь на запись"""
+        self._open.pop(session.user_id, None)
+        key = (session.user_id, session.started_at)
+        if key in self._expired:
+            # Сессия уже записана как брошенная
+            self._expired.discard(key)
+            return
+        self._pending.append(session)
+        if len(self._pending) >= self.batch_size and (self._flush_task is None or self._flush_task.done()):
+            # Ссылка на задачу не даёт сборщику мусора удалить её до завершения
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    def expire_idle(self) -> int:
+        """
+        Записывает сессии без активности дольше idle_seconds с причиной 'idle'
+
+        Returns:
+            Количество записанных сессий
+        """
+        now = time.time()
+        # Отметки о брошенных сессиях, к которым пользователь так и не вернулся
+        self._expired = {key for key in self._expired if now - key[1] < 86400}
+        idle = [
+            user_id for user_id, session in self._open.items()
+            if now - session.last_activity >= self.idle_seconds
+        ]
+        for user_id in idle:
+            session = self._open.pop(user_id)
+            user_data = session.user_data
+            self._pending.append(SessionRecord.from_latencies(
+                user_id=user_id,
+                started_at=session.started_at,
+                duration_seconds=session.last_activity - session.started_at,
+                exchanges=user_data.get('message_count', 0),
+                errors=user_data.get('errors', 0),
+                end_reason='idle',
+                latencies=user_data.get('latencies', {})
+            ))
+            self._expired.add((user_id, session.started_at))
+        if idle:
+            logger.info("В статистику записано %s брошенных сессий", len(idle))
+        return len(idle)
+
+    def _write(self, batch: List[SessionRecord]) -> None:
+        rows = [
+            (s.user_id, s.started_at, time.strftime('%Y-%m-%d', time.localtime(s.started_at)),
+             *astuple(s)[2:])
+            for s in batch
+        ]
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    "INSERT INTO sessions (user_id, started_at, day, duration_seconds, exchanges, errors, "
+                    "end_reason, stt_seconds, gpt_seconds, tts_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+
+    async def flush(self) -> None:
+        """Записывает накопленные сессии одной транзакцией"""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            await asyncio.to_thread(self._write, batch)
+            logger.debug("Записано %s сессий в статистику", len(batch))
+        except Exception as e:
+            # Возвращаем записи в очередь, чтобы не потерять их
+            self._pending[:0] = batch
+            logger.error(f"Ошибка записи статистики сессий: {e}")
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._connection().execute(sql, params).fetchall()
+
+    async def query(self, sql: str, params: tuple = ()) -> list:
+        """Выполняет запрос в отдельном потоке"""
+        return await asyncio.to_thread(self._query, sql, params)
+
+    async def summary(self, days: int) -> dict:
+        """
+        Сводка за последние days дней
+
+        Returns:
+            dict: sessions, users, avg_exchanges, median_exchanges, error_rate,
+            end_reasons {причина: количество}, daily [(день, DAU, сессий, ср. STT, ср. GPT, ср. TTS)]
+        """
+        await self.flush()
+        since = time.time() - days * 86400
+
+        total = (await self.query(
+            "SELECT COUNT(*), COUNT(DISTINCT user_id), AVG(exchanges), SUM(exchanges), SUM(errors) "
+            "FROM sessions WHERE started_at >= ?", (since,)
+        ))[0]
+        sessions, users, avg_exchanges, exchanges_sum, errors_sum = total
+
+        median = None
+        if sessions:
+            median_rows = await self.query(
+                "SELECT exchanges FROM sessions WHERE started_at >= ? ORDER BY exchanges LIMIT 2 - (? % 2) OFFSET (? - 1) / 2",
+                (since, sessions, sessions)
+            )
+            median = sum(row[0] for row in median_rows) / len(median_rows)
+
+        end_reasons = dict(await self.query(
+            "SELECT end_reason, COUNT(*) FROM sessions WHERE started_at >= ? GROUP BY end_reason ORDER BY 2 DESC",
+            (since,)
+        ))
+
+        daily = await self.query(
+            "SELECT day, COUNT(DISTINCT user_id), COUNT(*), "
+            "SUM(stt_seconds) / MAX(SUM(exchanges), 1), SUM(gpt_seconds) / MAX(SUM(exchanges), 1), "
+            "SUM(tts_seconds) / MAX(SUM(exchanges), 1) "
+            "FROM sessions WHERE day >= ? GROUP BY day ORDER BY day",
+            (time.strftime('%Y-%m-%d', time.localtime(since)),)
+        )
+
+        attempts = (exchanges_sum or 0) + (errors_sum or 0)
+        return {
+            'sessions': sessions,
+            'users': users,
+            'avg_exchanges': avg_exchanges or 0.0,
+            'median_exchanges': median or 0.0,
+            'error_rate': (errors_sum or 0) / attempts if attempts else 0.0,
+            'end_reasons': end_reasons,
+            'daily': daily,
+        }
+
+# Глобальный экземпляр хранилища
+analytics_store = AnalyticsStore(
+    db_path=ANALYTICS_DB,
+    batch_size=ANALYTICS_BATCH_SIZE,
+    idle_seconds=ANALYTICS_IDLE_MINUTES * 60
+)
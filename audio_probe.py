@@ -0,0 +1,243 @@
+"""
+Быстрое определение параметров аудиофайла по заголовкам (без декодирования и ffmpeg)
+
+Поддерживаются OGG (Opus, Vorbis), MP3 и WAV. Длительность OGG берётся из
+позиции гранулы последней страницы, MP3 - из заголовка Xing/Info/VBRI или по
+заголовкам кадров, WAV - из заголовка RIFF.
+"""
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+from ogg import iter_pages, last_granule
+
+# Сколько байт читаем с начала и с конца файла
+_HEAD_BYTES = 64 * 1024
+_TAIL_BYTES = 64 * 1024
+
+@dataclass
+class AudioInfo:
+    """Параметры аудиофайла"""
+    format: str
+    duration_us: int
+    sample_rate: int
+    channels: int
+
+    @property
+    def duration_seconds(self) -> float:
+        """Длительность в секундах"""
+        return self.duration_us / 1_000_000
+
+def probe_audio(file_path: Path) -> AudioInfo:
+    """
+    Определяет формат, длительность, частоту дискретизации и число каналов
+
+    Читаются только заголовки (начало и конец файла), аудио не декодируется.
+
+    Args:
+        file_path: Путь к аудиофайлу
+
+    Returns:
+        AudioInfo: Параметры аудио
+
+    Raises:
+        ValueError: Если файл пуст, повреждён или формат не поддерживается
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(0, 2)
+        file_size = f.tell()
+        if file_size == 0:
+            raise ValueError("Аудиофайл пуст")
+        f.seek(0)
+        head = f.read(_HEAD_BYTES)
+
+        try:
+            if head.startswith(b'OggS'):
+                return _probe_ogg(f, head, file_size)
+            if head.startswith(b'RIFF') and head[8:12] == b'WAVE':
+                return _probe_wav(head, file_size)
+            if head.startswith(b'ID3') or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+                return _probe_mp3(f, head, file_size)
+        except (struct.error, IndexError, StopIteration):
+            raise ValueError("Повреждённый заголовок аудиофайла")
+
+    raise ValueError("Неподдерживаемый формат аудио")
+
+# --- OGG ---
+
+def _probe_ogg(f: BinaryIO, head: bytes, file_size: int) -> AudioInfo:
+    """Длительность OGG по позиции гранулы последней страницы"""
+    first_page = next(iter_pages(head))
+    packet = first_page.body
+
+    if packet.startswith(b'OpusHead'):
+        channels = packet[9]
+        pre_skip = struct.unpack_from('<H', packet, 10)[0]
+        input_rate = struct.unpack_from('<I', packet, 12)[0]
+        granule_rate = 48000  # гранулы Opus всегда в отсчётах 48 кГц
+        codec = 'opus'
+    elif packet.startswith(b'\x01vorbis'):
+        channels = packet[11]
+        input_rate = struct.unpack_from('<I', packet, 12)[0]
+        granule_rate = input_rate
+        pre_skip = 0
+        codec = 'vorbis'
+    else:
+        raise ValueError("Неподдерживаемый кодек в контейнере OGG")
+
+    f.seek(max(0, file_size - _TAIL_BYTES))
+    granule = last_granule(f.read(_TAIL_BYTES), first_page.serial)
+    if granule is None or granule_rate == 0:
+        raise ValueError("Не удалось определить длительность OGG")
+
+    samples = max(0, granule - pre_skip)
+    return AudioInfo(
+        format=f'ogg/{codec}',
+        duration_us=samples * 1_000_000 // granule_rate,
+        sample_rate=input_rate or granule_rate,
+        channels=channels
+    )
+
+# --- WAV ---
+
+def _probe_wav(head: bytes, file_size: int) -> AudioInfo:
+    """Длительность WAV по заголовкам fmt и data"""
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(head):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', head, offset)
+        body = offset + 8
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack_from('<HHIIHH', head, body)
+        elif chunk_id == b'data':
+            if fmt is None:
+                break
+            _, channels, sample_rate, byte_rate, _, _ = fmt
+            if byte_rate == 0:
+                break
+            # Размер 0xFFFFFFFF или больше файла - потоковая запись, берём остаток файла
+            data_size = min(chunk_size, file_size - body)
+            return AudioInfo(
+                format='wav',
+                duration_us=data_size * 1_000_000 // byte_rate,
+                sample_rate=sample_rate,
+                channels=channels
+            )
+        offset = body + chunk_size + (chunk_size & 1)
+
+    raise ValueError("Повреждённый заголовок WAV")
+
+# --- MP3 ---
+
+_MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_MP3_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    25: [11025, 12000, 8000],
+}
+
+@dataclass
+class _Mp3Frame:
+    """Заголовок кадра MP3"""
+    version: int  # 1, 2 или 25 (MPEG 2.5)
+    layer: int
+    bitrate: int  # бит/с
+    sample_rate: int
+    channels: int
+    length: int  # байт
+    samples: int
+
+def _parse_mp3_header(header: bytes) -> Optional[_Mp3Frame]:
+    """Разбирает 4-байтовый заголовок кадра MP3, None - если это не кадр"""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+
+    version_bits = (header[1] >> 3) & 0x03
+    layer_bits = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    mode = header[3] >> 6
+
+    if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    version = {0: 25, 2: 2, 3: 1}[version_bits]
+    layer = 4 - layer_bits
+    bitrate = _MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 2 or version == 1:
+        samples = 1152
+        length = 144 * bitrate // sample_rate + padding
+    else:
+        samples = 576
+        length = 72 * bitrate // sample_rate + padding
+
+    return _Mp3Frame(version, layer, bitrate, sample_rate, 1 if mode == 3 else 2, length, samples)
+
+def _vbr_frame_count(head: bytes, offset: int, frame: _Mp3Frame) -> Optional[int]:
+    """Количество кадров из заголовка Xing/Info или VBRI в первом кадре"""
+    if frame.version == 1:
+        side_info = 17 if frame.channels == 1 else 32
+    else:
+        side_info = 9 if frame.channels == 1 else 17
+
+    xing = offset + 4 + side_info
+    if head[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = struct.unpack_from('>I', head, xing + 4)[0]
+        if flags & 0x01:
+            return struct.unpack_from('>I', head, xing + 8)[0]
+
+    vbri = offset + 36
+    if head[vbri:vbri + 4] == b'VBRI':
+        return struct.unpack_from('>I', head, vbri + 14)[0]
+
+    return None
+
+def _probe_mp3(f: BinaryIO, head: bytes, file_size: int) -> AudioInfo:
+    """Длительность MP3 по заголовку VBR или по заголовкам всех кадров"""
+    offset = 0
+    if head.startswith(b'ID3'):
+        # Размер тега ID3v2 - synchsafe integer
+        size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+        offset = 10 + size + (10 if head[5] & 0x10 else 0)
+        f.seek(offset)
+        head = f.read(_HEAD_BYTES)
+
+    frame = _parse_mp3_header(head[:4])
+    if frame is None:
+        raise ValueError("Повреждённый заголовок MP3")
+
+    frames = _vbr_frame_count(head, 0, frame)
+    if frames is None:
+        # Проходим по заголовкам кадров, не читая аудиоданные
+        frames = 0
+        position = offset
+        while position + 4 <= file_size:
+            f.seek(position)
+            current = _parse_mp3_header(f.read(4))
+            if current is None or current.length <= 0:
+                break
+            frames += 1
+            position += current.length
+        if frames == 0:
+            raise ValueError("Повреждённый поток MP3")
+
+    return AudioInfo(
+        format='mp3',
+        duration_us=frames * frame.samples * 1_000_000 // frame.sample_rate,
+        sample_rate=frame.sample_rate,
+        channels=frame.channels
+    )
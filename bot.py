@@ -3,8 +3,19 @@
 """
 import asyncio
 import logging
+import signal
+import time
 from pathlib import Path
 from datetime import datetime
+from typing import Optional
+
+# Замеры запуска: в режиме --profile-startup импорт каждого модуля замеряется отдельно
+from startup import startup_profile
+startup_profile.profile_imports([
+    'telegram.ext', 'logging_setup', 'config', 'metrics', 'persistence', 'rate_limiter',
+    'temp_files', 'utils', 'analytics', 'stt', 'transcript_cache', 'gpt', 'tts',
+    'admin', 'scheduler', 'admin_digest', 'fair_queue', 'pipelines', 'coalescer'
+])
 
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from telegram.ext import (
@@ -13,19 +24,15 @@ from telegram.ext import (
     MessageHandler, 
     ConversationHandler,
     ContextTypes,
+    TypeHandler,
+    ApplicationHandlerStop,
     filters
 )
 from telegram.error import TelegramError
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('session.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Настройка логирования (запись в файл в фоновом потоке)
+from logging_setup import setup_logging, shutdown_logging, set_correlation_id
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Отключаем избыточное логирование HTTP запросов
@@ -35,45 +42,59 @@ logging.getLogger('openai').setLevel(logging.WARNING)
 logging.getLogger('openai._base_client').setLevel(logging.WARNING)
 
 # Импорты наших модулей
-from config import TELEGRAM_TOKEN, MAX_MESSAGES_PER_SESSION, SESSION_DURATION_MINUTES
-from utils import SessionTimer, send_to_admins, log_session, cleanup_old_temp_files, create_temp_file, cleanup_temp_file
-from stt import speech_to_text, get_audio_duration
+from config import TELEGRAM_TOKEN, MAX_MESSAGES_PER_SESSION, SESSION_DURATION_MINUTES, MAX_VOICE_DURATION_SECONDS, MAX_VOICE_FILE_MB, is_admin, read_prompt
+from config import SHUTDOWN_DRAIN_SECONDS
+from utils import SessionTimer, send_to_admins, log_session, set_notification_bot
+from temp_files import temp_file_manager, TempScope
+from metrics import metrics
+from analytics import analytics_store, SessionRecord
+from stt import transcribe, NoSpeechError, Transcription
+from transcript_cache import transcript_cache
 from gpt import get_gpt_response, validate_user_input
 from tts import text_to_speech, prepare_text_for_tts
 from admin import cmd_prompt, cmd_setprompt, cmd_resetprompt, cmd_stats, cmd_cleanup
-from scheduler import daily_scheduler
+from scheduler import scheduler
+from persistence import persistence
+from rate_limiter import PriorityRateLimiter
+from fair_queue import FairUpdateProcessor
+from deadline import Deadline, DeadlineExceeded, current_deadline
+from admin_digest import admin_digest
+from openai_client import get_client
+from pipelines import pipeline_registry
+from coalescer import voice_coalescer
 
 # Состояния FSM
 AWAIT_NAME, MAIN_MENU, RECORDING = range(3)
 
+# Как часто напоминать заблокированному пользователю о блокировке
+BLOCKED_REPLY_COOLDOWN_SECONDS = 600
+
 class PsychologyBot:
     """Основной класс бота"""
     
     def __init__(self):
         self.application = None
+        # Время последнего ответа заблокированным пользователям (monotonic)
+        self._blocked_replies: dict = {}
+        # Остановка: новые сообщения не обрабатываются, начатые дообрабатываются
+        self._draining = False
+        self._pipelines = 0
+        self._stop_event: Optional[asyncio.Event] = None
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Обработчик команды /start"""
         user = update.effective_user
         user_id = user.id
         
-        logger.info(f"[START] Пользователь {user_id} ({user.first_name}) начал сессию")
-        logger.debug(f"[START] Update: {update}")
-        logger.debug(f"[START] Chat ID: {update.effective_chat.id}")
+        logger.info("[START] Пользователь %s (%s) начал сессию", user_id, user.first_name)
+        logger.debug("[START] Update: %s", update)
+        logger.debug("[START] Chat ID: %s", update.effective_chat.id)
         
-        # Проверяем, не заблокирован ли пользователь
-        try:
-            from user_limits import user_limit_manager
-            if user_limit_manager.is_user_blocked(user_id):
-                logger.info(f"[START] Пользователь {user_id} заблокирован, отказываем в доступе")
-                await update.message.reply_text(
-                    f"❌ Ваш период эксплуатации бота истёк.\n\n"
-                    f"Вы превысили лимиты использования ({MAX_MESSAGES_PER_SESSION} запросов или {SESSION_DURATION_MINUTES} минут).\n"
-                    f"Для восстановления доступа обратитесь к администратору."
-                )
-                return ConversationHandler.END
-        except Exception as e:
-            logger.error(f"[START] Ошибка проверки блокировки пользователя {user_id}: {e}")
+        # Заблокированные пользователи сюда не доходят - их отсекает reject_blocked_users
+        
+        # Повторный /start посреди сессии завершает предыдущую
+        if context.user_data.get('timer'):
+            self.record_session(update, context, 'restart')
         
         # Инициализируем данные пользователя
         context.user_data.clear()
@@ -81,10 +102,11 @@ class PsychologyBot:
         context.user_data['start_time'] = datetime.now()
         context.user_data['timer'] = SessionTimer()
         context.user_data['message_count'] = 0
+        context.user_data['errors'] = 0
+        context.user_data['latencies'] = {}
         context.user_data['name'] = "Пользователь"
-        
-        # Очищаем старые временные файлы
-        cleanup_old_temp_files()
+        metrics.session_started(user_id, context.user_data['timer'].max_duration.total_seconds())
+        analytics_store.session_started(user_id, context.user_data['timer'].start_time.timestamp(), context.user_data)
         
         # Приветственное сообщение
         welcome_text = (
@@ -109,10 +131,10 @@ class PsychologyBot:
         message_text = update.message.text
         user_id = update.effective_user.id
         
-        logger.info(f"[NAME_INPUT] Пользователь {user_id} ввел: '{message_text}'")
+        logger.info("[NAME_INPUT] Пользователь %s ввел: '%s'", user_id, message_text)
         
         if message_text == "Пропустить":
-            logger.info(f"[NAME_INPUT] Пользователь {user_id} пропустил ввод имени")
+            logger.info("[NAME_INPUT] Пользователь %s пропустил ввод имени", user_id)
             context.user_data['name'] = "Пользователь"
             # Убираем клавиатуру перед переходом к главному меню
             try:
@@ -120,20 +142,20 @@ class PsychologyBot:
                     "Хорошо, будем называть тебя просто Пользователь! 😊",
                     reply_markup=ReplyKeyboardRemove()
                 )
-                logger.info(f"[NAME_INPUT] Клавиатура убрана для пользователя {user_id}")
+                logger.info("[NAME_INPUT] Клавиатура убрана для пользователя %s", user_id)
             except Exception as e:
-                logger.error(f"[NAME_INPUT] Ошибка убирания клавиатуры для пользователя {user_id}: {e}")
+                logger.error("[NAME_INPUT] Ошибка убирания клавиатуры для пользователя %s: %s", user_id, e)
             return await self.show_main_menu(update, context)
         elif message_text == "Ввести имя":
-            logger.info(f"[NAME_INPUT] Пользователь {user_id} выбрал ввести имя")
+            logger.info("[NAME_INPUT] Пользователь %s выбрал ввести имя", user_id)
             try:
                 await update.message.reply_text(
                     "Напиши своё имя:",
                     reply_markup=ReplyKeyboardRemove()
                 )
-                logger.info(f"[NAME_INPUT] Отправлен запрос имени пользователю {user_id}")
+                logger.info("[NAME_INPUT] Отправлен запрос имени пользователю %s", user_id)
             except Exception as e:
-                logger.error(f"[NAME_INPUT] Ошибка отправки сообщения пользователю {user_id}: {e}")
+                logger.error("[NAME_INPUT] Ошибка отправки сообщения пользователю %s: %s", user_id, e)
             return AWAIT_NAME
         else:
             # Пользователь ввел имя
@@ -143,7 +165,7 @@ class PsychologyBot:
             if len(name) < 1:
                 name = "Пользователь"
             
-            logger.info(f"[NAME_INPUT] Пользователь {user_id} установил имя: '{name}'")
+            logger.info("[NAME_INPUT] Пользователь %s установил имя: '%s'", user_id, name)
             context.user_data['name'] = name
             # Убираем клавиатуру (если она была) перед переходом к главному меню
             try:
@@ -151,9 +173,9 @@ class PsychologyBot:
                     f"Приятно познакомиться, {name}! 😊",
                     reply_markup=ReplyKeyboardRemove()
                 )
-                logger.info(f"[NAME_INPUT] Клавиатура убрана после ввода имени для пользователя {user_id}")
+                logger.info("[NAME_INPUT] Клавиатура убрана после ввода имени для пользователя %s", user_id)
             except Exception as e:
-                logger.error(f"[NAME_INPUT] Ошибка убирания клавиатуры после ввода имени для пользователя {user_id}: {e}")
+                logger.error("[NAME_INPUT] Ошибка убирания клавиатуры после ввода имени для пользователя %s: %s", user_id, e)
             return await self.show_main_menu(update, context)
     
     async def show_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -161,7 +183,7 @@ class PsychologyBot:
         user_id = update.effective_user.id
         name = context.user_data.get('name', 'Пользователь')
         
-        logger.info(f"[MAIN_MENU] Переходим к записи для пользователя {user_id} (имя: {name})")
+        logger.info("[MAIN_MENU] Переходим к записи для пользователя %s (имя: %s)", user_id, name)
         
         try:
             await update.message.reply_text(
@@ -170,9 +192,9 @@ class PsychologyBot:
                 "Максимальная длительность одного сообщения: 7 минут",
                 reply_markup=ReplyKeyboardRemove()
             )
-            logger.info(f"[MAIN_MENU] Сообщение о записи отправлено пользователю {user_id}")
+            logger.info("[MAIN_MENU] Сообщение о записи отправлено пользователю %s", user_id)
         except Exception as e:
-            logger.error(f"[MAIN_MENU] Ошибка отправки сообщения пользователю {user_id}: {e}")
+            logger.error("[MAIN_MENU] Ошибка отправки сообщения пользователю %s: %s", user_id, e)
         
         return RECORDING
     
@@ -181,7 +203,7 @@ class PsychologyBot:
         # Проверяем таймер сессии
         timer = context.user_data.get('timer')
         if timer and timer.is_expired():
-            return await self.end_session(update, context)
+            return await self.end_session(update, context, 'expired')
         
         await update.message.reply_text(
             "🎙 Нажмите на значёк 'микрофон' и говорите... (отпустите, чтобы отправить)\n\n"
@@ -192,205 +214,390 @@ class PsychologyBot:
         return RECORDING
     
     async def handle_voice_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        """Обработчик голосовых сообщений"""
+        """
+        Обработчик голосовых сообщений
+        
+        Обработка идёт отдельной задачей, которую отменяют /cancel, /start
+        и новое голосовое сообщение (см. pipelines.py).
+        """
+        user_id = update.effective_user.id
+        task = asyncio.create_task(self.process_voice_message(update, context))
+        with pipeline_registry.track(user_id, task) as pipeline:
+            try:
+                return await task
+            except asyncio.CancelledError:
+                # Отмена самого обработчика (остановка бота) передаётся дальше
+                if pipeline.cancel_reason is None or asyncio.current_task().cancelling():
+                    raise
+                logger.info("[VOICE] Обработка сообщения от %s отменена (%s)", user_id, pipeline.cancel_reason)
+                if pipeline.cancel_reason == 'new_voice':
+                    # Ответ на эти сообщения подготовим вместе с новым
+                    voice_coalescer.defer(user_id)
+                return RECORDING
+            finally:
+                voice_coalescer.end(user_id)
+    
+    async def process_voice_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        """Обрабатывает голосовое сообщение: STT → GPT → TTS → отправка ответа"""
         user_id = update.effective_user.id
         user_name = context.user_data.get('name', 'Пользователь')
         
-        logger.info(f"[VOICE] Получено голосовое сообщение от пользователя {user_id} ({user_name})")
+        logger.info("[VOICE] Получено голосовое сообщение от пользователя %s (%s)", user_id, user_name)
+        metrics.inc('voice.received')
         
         # Проверяем таймер сессии
         timer = context.user_data.get('timer')
         if timer and timer.is_expired():
-            logger.info(f"[VOICE] Сессия пользователя {user_id} истекла, завершаем")
-            return await self.end_session(update, context)
+            logger.info("[VOICE] Сессия пользователя %s истекла, завершаем", user_id)
+            return await self.end_session(update, context, 'expired')
+        
+        # Бот останавливается: не начинаем платную обработку, которую можем не успеть закончить
+        if self._draining:
+            logger.info("[VOICE] Бот останавливается, сообщение от %s не обрабатывается", user_id)
+            metrics.inc('voice.rejected_draining')
+            await update.message.reply_text(
+                "⏳ Бот перезапускается. Отправь, пожалуйста, это сообщение ещё раз через минуту."
+            )
+            return RECORDING
         
-        voice_file = None
-        wav_file = None
         tts_file = None
+        scope = temp_file_manager.scope()
+        self._pipelines += 1
+        # Общий срок обработки; запросы к OpenAI получают таймаут по его остатку
+        deadline = Deadline()
+        deadline_token = current_deadline.set(deadline)
         
         try:
-            logger.info(f"[VOICE] Начинаем обработку голосового сообщения от {user_id}")
+            logger.info("[VOICE] Начинаем обработку голосового сообщения от %s", user_id)
             
             # Показываем индикацию "записывает голосовое сообщение"
             await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="record_voice")
             
-            # Получаем голосовое сообщение
-            voice = update.message.voice
-            duration_seconds = voice.duration
-            
-            logger.info(f"[VOICE] Длительность голосового сообщения: {duration_seconds} сек")
-            
-            # Проверяем длительность
-            if duration_seconds > 420:  # 7 минут
-                logger.warning(f"[VOICE] Сообщение от {user_id} слишком длинное: {duration_seconds} сек")
-                await update.message.reply_text(
-                    f"❌ Сообщение слишком длинное ({duration_seconds//60}:{duration_seconds%60:02d}). "
-                    "Максимум 7 минут. Попробуйте записать покороче."
-                )
-                return RECORDING
-            
-            # Скачиваем файл
-            voice_file = create_temp_file('.ogg')
-            logger.info(f"[VOICE] Скачиваем голосовой файл в {voice_file}")
-            
-            file = await context.bot.get_file(voice.file_id)
-            await file.download_to_drive(voice_file)
-            
-            logger.info(f"[VOICE] Файл скачан, размер: {voice_file.stat().st_size} байт")
-            
-            # Отправляем голосовое сообщение администраторам (если включен DEBUG)
-            logger.debug(f"[VOICE] Отправляем голосовое сообщение администраторам")
-            await send_to_admins(
-                context.bot, 
-                "Voice (user)", 
-                voice_file=voice_file,
-                user_name=user_name
-            )
-            
-            # Показываем индикацию "обрабатывает"
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-            
-            # Преобразуем речь в текст
-            logger.info(f"[VOICE] Начинаем STT для пользователя {user_id}")
+            # При превышении квоты временных файлов ждём, пока освободится место
             try:
-                # Проверяем файл
-                if not voice_file or not voice_file.exists():
-                    raise ValueError("Голосовой файл отсутствует или недоступен")
-                
-                # Проверяем размер файла
-                file_size = voice_file.stat().st_size
-                if file_size == 0:
-                    raise ValueError("Голосовой файл пуст")
-                
-                # Пытаемся выполнить STT
-                try:
-                    user_text = await speech_to_text(voice_file)
-                except ConnectionError:
-                    raise ValueError("Сервис распознавания речи недоступен. Попробуйте позже.")
-                except Exception as stt_error:
-                    logger.error(f"[VOICE] Ошибка сервиса STT: {stt_error}")
-                    raise ValueError("Ошибка при распознавании речи. Попробуйте ещё раз.")
-                
-                # Проверяем результат
-                if not user_text or len(user_text.strip()) == 0:
-                    raise ValueError("Не удалось распознать речь. Пожалуйста, говорите чётче.")
-                
-                logger.info(f"[VOICE] STT успешно: '{user_text[:100]}...' (длина: {len(user_text)})")
-                
+                await temp_file_manager.wait_for_space()
             except ValueError as e:
-                error_msg = str(e)
-                logger.error(f"[VOICE] Ошибка STT для пользователя {user_id}: {error_msg}")
-                
-                # Отправляем понятное пользователю сообщение об ошибке
-                user_msg = f"❌ {error_msg}"
-                try:
-                    await update.message.reply_text(user_msg)
-                except Exception as send_error:
-                    logger.error(f"[VOICE] Не удалось отправить сообщение об ошибке: {send_error}")
-                
+                logger.warning("[VOICE] Квота временных файлов, сообщение от %s отклонено", user_id)
+                await update.message.reply_text(f"❌ {e}")
+                return RECORDING
+            
+            transcription = await self.transcribe_batch(update, context, scope, deadline)
+            if transcription is None:
                 return RECORDING
+            user_text = transcription.text
             
             # Проверяем корректность распознанного текста
             if not validate_user_input(user_text):
-                logger.warning(f"[VOICE] Некорректный текст от пользователя {user_id}: '{user_text}'")
+                logger.warning("[VOICE] Некорректный текст от пользователя %s: '%s'", user_id, user_text)
                 await update.message.reply_text(
                     "❌ Не удалось разобрать речь. Попробуйте говорить четче и громче."
                 )
                 return RECORDING
             
             # Отправляем STT результат администраторам
-            logger.debug(f"[VOICE] Отправляем STT результат администраторам")
+            logger.debug("[VOICE] Отправляем STT результат администраторам")
             await send_to_admins(
                 context.bot, 
                 "STT", 
                 content=user_text,
-                user_name=user_name
+                user_name=user_name,
+                user_id=user_id
             )
             
             # Показываем индикацию "генерирует ответ"
             await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
             
             # Получаем ответ от GPT
-            logger.info(f"[VOICE] Отправляем запрос к GPT для пользователя {user_id}")
+            pipeline_registry.set_stage(user_id, 'gpt')
+            logger.info("[VOICE] Отправляем запрос к GPT для пользователя %s", user_id)
             try:
-                gpt_response = await get_gpt_response(user_text, user_name)
-                logger.info(f"[VOICE] GPT отв��т получен: '{gpt_response[:100]}...' (длина: {len(gpt_response)})")
+                with metrics.stage('gpt', context.user_data.get('latencies')):
+                    gpt_response = await deadline.run('gpt', get_gpt_response(user_text, user_name))
+                logger.info("[VOICE] GPT отв��т получен: '%s...' (длина: %s)", gpt_response[:100], len(gpt_response))
             except ValueError as e:
-                logger.error(f"[VOICE] Ошибка GPT для пользователя {user_id}: {e}")
+                logger.error("[VOICE] Ошибка GPT для пользователя %s: %s", user_id, e)
+                context.user_data['errors'] = context.user_data.get('errors', 0) + 1
                 await update.message.reply_text(f"❌ {str(e)}")
                 return RECORDING
             
             # Отправляем GPT ответ администраторам
-            logger.debug(f"[VOICE] Отправляем GPT ответ администраторам")
+            logger.debug("[VOICE] Отправляем GPT ответ администраторам")
             await send_to_admins(
                 context.bot, 
                 "GPT", 
                 content=gpt_response,
-                user_name=user_name
+                user_name=user_name,
+                user_id=user_id
             )
             
             # Показываем индикацию "озвучивает"
             await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="record_voice")
             
             # Преобразуем ответ в речь
-            logger.info(f"[VOICE] Начинаем TTS для пользователя {user_id}")
+            logger.info("[VOICE] Начинаем TTS для пользователя %s", user_id)
             try:
                 prepared_text = prepare_text_for_tts(gpt_response)
-                tts_file = await text_to_speech(prepared_text)
-                logger.info(f"[VOICE] TTS успешно создан: {tts_file}")
+                pipeline_registry.set_stage(user_id, 'tts', len(prepared_text))
+                with metrics.stage('tts', context.user_data.get('latencies')):
+                    tts_file = await deadline.run('tts', text_to_speech(prepared_text, scope.create('.ogg')))
+                logger.info("[VOICE] TTS успешно создан: %s", tts_file)
+            except DeadlineExceeded:
+                # Озвучивание не успело - отвечаем текстом, ответ GPT уже оплачен
+                logger.warning("[VOICE] TTS для пользователя %s не уложился в срок, отвечаем текстом", user_id)
+                context.user_data['errors'] = context.user_data.get('errors', 0) + 1
+                await update.message.reply_text(f"💬 {gpt_response}")
+                return await self.continue_or_end(update, context)
             except ValueError as e:
-                logger.error(f"[VOICE] Ошибка TTS для пользователя {user_id}: {e}")
+                logger.error("[VOICE] Ошибка TTS для пользователя %s: %s", user_id, e)
+                context.user_data['errors'] = context.user_data.get('errors', 0) + 1
                 # Если TTS не работает, отправляем текстом
                 await update.message.reply_text(f"💬 {gpt_response}")
                 await update.message.reply_text(f"❌ Ошибка озвучивания: {str(e)}")
                 return await self.continue_or_end(update, context)
             
             # Отправляем голосовой ответ пользователю
-            logger.info(f"[VOICE] Отправляем голосовой ответ пользователю {user_id}")
+            logger.info("[VOICE] Отправляем голосовой ответ пользователю %s", user_id)
+            pipeline_registry.set_stage(user_id, 'send')
+            bot_voice_id = None
             try:
-                with open(tts_file, 'rb') as audio:
-                    await context.bot.send_voice(
+                with metrics.stage('send'), open(tts_file, 'rb') as audio:
+                    sent = await deadline.run('send', context.bot.send_voice(
                         chat_id=update.effective_chat.id,
                         voice=audio
-                    )
-                logger.info(f"[VOICE] Голосовой ответ успешно отправлен пользователю {user_id}")
+                    ))
+                bot_voice_id = sent.voice.file_id if sent.voice else None
+                logger.info("[VOICE] Голосовой ответ успешно отправлен пользователю %s", user_id)
             except Exception as e:
-                logger.error(f"[VOICE] Ошибка отправки голосового ответа пользователю {user_id}: {e}")
+                logger.error("[VOICE] Ошибка отправки голосового ответа пользователю %s: %s", user_id, e)
                 # Отправляем текстом как fallback
                 await update.message.reply_text(f"💬 {gpt_response}")
             
             # Отправляем голосовой ответ администраторам (��сли включен DEBUG)
-            logger.debug(f"[VOICE] Отправляем голосовой ответ администраторам")
+            logger.debug("[VOICE] Отправляем голосовой ответ администраторам")
             await send_to_admins(
                 context.bot, 
                 "Voice (bot)", 
                 voice_file=tts_file,
-                user_name=user_name
+                user_name=user_name,
+                user_id=user_id,
+                voice_file_id=bot_voice_id
             )
             
             # Увеличиваем счетчик сообщений
             context.user_data['message_count'] = context.user_data.get('message_count', 0) + 1
-            logger.info(f"[VOICE] Обработка завершена для пользователя {user_id}, сообщений: {context.user_data['message_count']}")
+            analytics_store.touch(user_id)
+            logger.info("[VOICE] Обработка завершена для пользователя %s, сообщений: %s", user_id, context.user_data['message_count'])
             
             return await self.continue_or_end(update, context)
             
+        except DeadlineExceeded as e:
+            logger.warning("[VOICE] Обработка сообщения от %s не уложилась в срок: этап %s", user_id, e.stage)
+            context.user_data['errors'] = context.user_data.get('errors', 0) + 1
+            try:
+                await update.message.reply_text(f"⏳ {e}")
+            except Exception as send_error:
+                logger.error("[VOICE] Не удалось отправить сообщение об ошибке пользователю %s: %s", user_id, send_error)
+            return RECORDING
+            
         except Exception as e:
-            logger.error(f"[VOICE] Критическая ошибка обработки голосового сообщения от {user_id}: {e}")
+            logger.error("[VOICE] Критическая ошибка обработки голосового сообщения от %s: %s", user_id, e)
             logger.exception("Полная трассировка ошибки:")
+            context.user_data['errors'] = context.user_data.get('errors', 0) + 1
             try:
                 await update.message.reply_text(
                     "❌ Извини, произошла ошибка. Попробуй ещё раз."
                 )
             except Exception as send_error:
-                logger.error(f"[VOICE] Не удалось отправить сообщение об ошибке пользователю {user_id}: {send_error}")
+                logger.error("[VOICE] Не удалось отправить сообщение об ошибке пользователю %s: %s", user_id, send_error)
             return RECORDING
             
         finally:
             # Очищаем временные файлы
-            logger.debug(f"[VOICE] Очищаем временные файлы для пользователя {user_id}")
-            for temp_file in [voice_file, wav_file, tts_file]:
-                if temp_file:
-                    cleanup_temp_file(temp_file)
+            logger.debug("[VOICE] Очищаем временные файлы для пользователя %s", user_id)
+            scope.release()
+            current_deadline.reset(deadline_token)
+            self._pipelines -= 1
+    
+    async def transcribe_batch(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE, scope: TempScope, deadline: Deadline
+    ) -> Optional[Transcription]:
+        """
+        Распознаёт голосовое сообщение вместе с пришедшими за окно объединения
+        
+        Сообщения распознаются параллельно по мере поступления, тексты
+        склеиваются в порядке отправки (см. coalescer.py).
+        
+        Returns:
+            Transcription или None, если не распознано ни одно сообщение
+        """
+        user_id = update.effective_user.id
+        updates = voice_coalescer.begin(user_id, update)
+        tasks = [
+            asyncio.create_task(self.transcribe_voice(u, context, u.message.voice, scope, deadline))
+            for u in updates
+        ]
+        try:
+            async for extra in voice_coalescer.collect(user_id):
+                tasks.append(asyncio.create_task(
+                    self.transcribe_voice(extra, context, extra.message.voice, scope, deadline)
+                ))
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        
+        # В пачке остаются только распознанные сообщения: если ответ отменят,
+        # они войдут в следующий без повторных сообщений об ошибках
+        updates[:] = [u for u, t in zip(updates, results) if t is not None]
+        transcriptions = [t for t in results if t is not None]
+        if len(transcriptions) <= 1:
+            return transcriptions[0] if transcriptions else None
+        return Transcription(
+            text=" ".join(t.text for t in transcriptions),
+            original_seconds=sum(t.original_seconds for t in transcriptions),
+            speech_seconds=sum(t.speech_seconds for t in transcriptions)
+        )
+    
+    async def transcribe_voice(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE, voice, scope: TempScope, deadline: Deadline
+    ) -> Optional[Transcription]:
+        """
+        Скачивает и распознаёт голосовое сообщение
+        
+        Транскрипты кэшируются по file_unique_id: для пересланных и повторно
+        отправленных сообщений не нужно ни скачивание, ни Whisper.
+        
+        Returns:
+            Transcription или None, если пользователю уже отправлено сообщение об ошибке
+        """
+        user_id = update.effective_user.id
+        user_name = context.user_data.get('name', 'Пользователь')
+        
+        duration_seconds = voice.duration
+        logger.info("[VOICE] Длительность голосового сообщения: %s сек", duration_seconds)
+        
+        # Проверяем длительность и размер по данным Telegram, до скачивания
+        if duration_seconds > MAX_VOICE_DURATION_SECONDS:
+            logger.warning("[VOICE] Сообщение от %s слишком длинное: %s сек", user_id, duration_seconds)
+            await update.message.reply_text(
+                f"❌ Сообщение слишком длинное ({duration_seconds//60}:{duration_seconds%60:02d}). "
+                f"Максимум {MAX_VOICE_DURATION_SECONDS // 60} минут. Попробуйте записать покороче."
+            )
+            return None
+        
+        if voice.file_size and voice.file_size > MAX_VOICE_FILE_MB * 1024 * 1024:
+            logger.warning("[VOICE] Файл от %s слишком большой: %s байт", user_id, voice.file_size)
+            await update.message.reply_text(
+                f"❌ Файл слишком большой (макс. {MAX_VOICE_FILE_MB} MB). Попробуйте записать покороче."
+            )
+            return None
+        
+        # Отправляем голосовое сообщение администраторам по file_id (без повторной загрузки),
+        # в том числе когда транскрипт уже есть в кэше
+        logger.debug("[VOICE] Отправляем голосовое сообщение администраторам")
+        await send_to_admins(
+            context.bot, 
+            "Voice (user)", 
+            user_name=user_name,
+            user_id=user_id,
+            voice_file_id=voice.file_id
+        )
+        
+        cached = transcript_cache.get(voice.file_unique_id)
+        if cached:
+            logger.info("[VOICE] Транскрипт для %s найден в кэше, скачивание и STT пропущены", user_id)
+            metrics.inc('stt.cache_hits')
+            return cached
+        
+        voice_file = None
+        
+        try:
+            # Скачиваем файл
+            voice_file = scope.create('.ogg')
+            logger.info("[VOICE] Скачиваем голосовой файл в %s", voice_file)
+            
+            async def download() -> None:
+                file = await context.bot.get_file(voice.file_id)
+                await file.download_to_drive(voice_file)
+            
+            with metrics.stage('download'):
+                await deadline.run('download', download())
+            temp_file_manager.commit(voice_file)
+            
+            logger.info("[VOICE] Файл скачан, размер: %s байт", voice_file.stat().st_size)
+            
+            # Показываем индикацию "обрабатывает"
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+            
+            # Преобразуем речь в текст
+            pipeline_registry.set_stage(user_id, 'stt')
+            logger.info("[VOICE] Начинаем STT для пользователя %s", user_id)
+            try:
+                # Проверяем файл
+                if not voice_file or not voice_file.exists():
+                    raise ValueError("Голосовой файл отсутствует или недоступен")
+                
+                # Проверяем размер файла
+                file_size = voice_file.stat().st_size
+                if file_size == 0:
+                    raise ValueError("Голосовой файл пуст")
+                
+                # Пытаемся выполнить STT
+                try:
+                    with metrics.stage('stt', context.user_data.get('latencies')):
+                        transcription = await deadline.run('stt', transcribe(voice_file))
+                except NoSpeechError:
+                    # В записи только тишина - не тратим STT, GPT и TTS
+                    logger.info("[VOICE] В сообщении от %s нет речи", user_id)
+                    await update.message.reply_text(
+                        "🤫 Кажется, в записи только тишина. Расскажи, что у тебя на душе, — я слушаю."
+                    )
+                    return None
+                except DeadlineExceeded:
+                    raise
+                except ConnectionError:
+                    raise ValueError("Сервис распознавания речи недоступен. Попробуйте позже.")
+                except Exception as stt_error:
+                    logger.error("[VOICE] Ошибка сервиса STT: %s", stt_error)
+                    raise ValueError("Ошибка при распознавании речи. Попробуйте ещё раз.")
+                
+                user_text = transcription.text
+                logger.info(
+                    "[VOICE] VAD: %.1f с -> %.1f с, "
+                    "сэкономлено %.1f с аудио",
+                    transcription.original_seconds, transcription.speech_seconds, transcription.saved_seconds
+                )
+                
+                # Проверяем результат
+                if not user_text or len(user_text.strip()) == 0:
+                    raise ValueError("Не удалось распознать речь. Пожалуйста, говорите чётче.")
+                
+                logger.info("[VOICE] STT успешно: '%s...' (длина: %s)", user_text[:100], len(user_text))
+                
+            except ValueError as e:
+                error_msg = str(e)
+                logger.error("[VOICE] Ошибка STT для пользователя %s: %s", user_id, error_msg)
+                context.user_data['errors'] = context.user_data.get('errors', 0) + 1
+                
+                # Отправляем понятное пользователю сообщение об ошибке
+                user_msg = f"❌ {error_msg}"
+                try:
+                    await update.message.reply_text(user_msg)
+                except Exception as send_error:
+                    logger.error("[VOICE] Не удалось отправить сообщение об ошибке: %s", send_error)
+                
+                return None
+            
+            # На диск кэш сохраняет периодическая задача планировщика и остановка бота
+            transcript_cache.put(voice.file_unique_id, transcription)
+            return transcription
+            
+        finally:
+            # Файл больше не нужен этому прогону; поток декодирования может ещё держать ссылку
+            if voice_file:
+                scope.release_file(voice_file)
     
     async def continue_or_end(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Предлагает продолжить или завершить сессию"""
@@ -399,7 +606,7 @@ class PsychologyBot:
         
         # Проверяем лимит времени
         if timer and timer.is_expired():
-            return await self.end_session(update, context)
+            return await self.end_session(update, context, 'expired')
         
         # Проверяем лимит сообщений
         if message_count >= MAX_MESSAGES_PER_SESSION:
@@ -407,7 +614,7 @@ class PsychologyBot:
                 f"Достигнут лимит сообщений ({MAX_MESSAGES_PER_SESSION}) для одной сессии. "
                 "Сессия будет завершена."
             )
-            return await self.end_session(update, context)
+            return await self.end_session(update, context, 'message_limit')
         
         await update.message.reply_text(
             "Хочешь ещё что-то рассказать?\n\n"
@@ -419,7 +626,29 @@ class PsychologyBot:
         
         return RECORDING
     
-    async def end_session(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    def record_session(self, update: Update, context: ContextTypes.DEFAULT_TYPE, end_reason: str) -> None:
+        """Передаёт итоги сессии в статистику и помечает её завершённой"""
+        timer = context.user_data.pop('timer', None)
+        if not timer:
+            return
+        
+        metrics.session_ended(update.effective_user.id)
+        if admin_digest.enabled:
+            # Сводка отправляется в фоне и не задерживает ответ пользователю
+            context.application.create_task(
+                admin_digest.end_session(update.effective_user.id, end_reason), update=update
+            )
+        analytics_store.record(SessionRecord.from_latencies(
+            user_id=update.effective_user.id,
+            started_at=timer.start_time.timestamp(),
+            duration_seconds=timer.elapsed_time().total_seconds(),
+            exchanges=context.user_data.get('message_count', 0),
+            errors=context.user_data.get('errors', 0),
+            end_reason=end_reason,
+            latencies=context.user_data.get('latencies', {})
+        ))
+    
+    async def end_session(self, update: Update, context: ContextTypes.DEFAULT_TYPE, end_reason: str = 'completed') -> int:
         """Завершает сессию"""
         timer = context.user_data.get('timer')
         user_name = context.user_data.get('name', 'Пользователь')
@@ -436,7 +665,7 @@ class PsychologyBot:
                 session_duration_minutes = int(timer.elapsed_time() / 60)
             
             # Проверяем, нужно ли заблокировать пользователя
-            should_block = user_limit_manager.check_user_limits(
+            should_block = await user_limit_manager.check_user_limits(
                 user_id=user_id,
                 message_count=message_count,
                 session_duration_minutes=session_duration_minutes,
@@ -445,14 +674,15 @@ class PsychologyBot:
             )
             
             if should_block:
-                logger.info(f"[END_SESSION] Пользователь {user_id} заблокирован за превышение лимитов")
+                logger.info("[END_SESSION] Пользователь %s заблокирован за превышение лимитов", user_id)
         except Exception as e:
-            logger.error(f"[END_SESSION] Ошибка проверки лимитов для пользователя {user_id}: {e}")
+            logger.error("[END_SESSION] Ошибка проверки лимитов для пользователя %s: %s", user_id, e)
         
         # Логируем сессию
         if timer:
             duration = timer.elapsed_time()
             log_session(user_name, duration, message_count)
+        self.record_session(update, context, end_reason)
         
         # Прощальное сообщение
         await update.message.reply_text(
@@ -482,24 +712,25 @@ class PsychologyBot:
         user_id = update.effective_user.id
         current_state = context.user_data.get('current_state', 'UNKNOWN')
         
-        logger.info(f"[TEXT] Пользователь {user_id} отправил текст: '{message_text}' (состояние: {current_state})")
+        logger.info("[TEXT] Пользователь %s отправил текст: '%s' (состояние: %s)", user_id, message_text, current_state)
         
         if message_text == "Начать снова":
-            logger.info(f"[TEXT] Пользователь {user_id} нажал кнопку 'Начать снова'")
+            logger.info("[TEXT] Пользователь %s нажал кнопку 'Начать снова'", user_id)
             return await self.handle_restart(update, context)
         else:
-            logger.info(f"[TEXT] Пользователь {user_id} отправил неизвестное сообщение: '{message_text}'")
+            logger.info("[TEXT] Пользователь %s отправил неизвестное сообщение: '%s'", user_id, message_text)
             try:
                 await update.message.reply_text(
                     "Я понимаю только голосовые сообщения. Нажмите на значёк 'микрофон' и говорите."
                 )
-                logger.info(f"[TEXT] Отправлено напоминание пользователю {user_id}")
+                logger.info("[TEXT] Отправлено напоминание пользователю %s", user_id)
             except Exception as e:
-                logger.error(f"[TEXT] Ошибка отправки напоминания пользователю {user_id}: {e}")
+                logger.error("[TEXT] Ошибка отправки напоминания пользователю %s: %s", user_id, e)
             return MAIN_MENU
     
     async def cancel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Обработчик команды /cancel"""
+        self.record_session(update, context, 'cancel')
         await update.message.reply_text(
             "Сессия отменена. До свидания! 👋",
             reply_markup=ReplyKeyboardRemove()
@@ -508,7 +739,7 @@ class PsychologyBot:
     
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Обработчик ошибок"""
-        logger.error(f"Ошибка бота: {context.error}")
+        logger.error("Ошибка бота: %s", context.error)
         
         if isinstance(update, Update) and update.effective_message:
             try:
@@ -516,10 +747,63 @@ class PsychologyBot:
                     "❌ Произошла ошибка. Попробуйте ещё раз или начните сначала с /start"
                 )
             except Exception as e:
-                logger.error(f"Не удалось отправить сообщение об ошибке: {e}")
+                logger.error("Не удалось отправить сообщение об ошибке: %s", e)
+    
+    async def bind_correlation_id(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Связывает записи лога с обрабатываемым обновлением"""
+        if isinstance(update, Update):
+            set_correlation_id(f"upd-{update.update_id}")
+            startup_profile.update_received()
+    
+    async def reject_blocked_users(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """
+        Отсекает обновления заблокированных пользователей до остальных обработчиков
+        
+        Проверка по множеству в памяти, без файлов и сети. Пользователь получает
+        ответ не чаще раза в BLOCKED_REPLY_COOLDOWN_SECONDS, остальное молча отбрасывается.
+        """
+        if not isinstance(update, Update) or not update.effective_user:
+            return
+        
+        from user_limits import user_limit_manager
+        
+        user_id = update.effective_user.id
+        if not user_limit_manager.is_user_blocked(user_id) or is_admin(user_id):
+            return
+        
+        metrics.inc('blocked.rejected')
+        logger.info("[BLOCKED] Обновление от заблокированного пользователя %s отклонено", user_id)
+        
+        # Блокировка посреди сессии (например, через /block) завершает её
+        if context.user_data is not None and context.user_data.get('timer'):
+            self.record_session(update, context, 'blocked')
+        
+        now = time.monotonic()
+        if update.effective_message and now - self._blocked_replies.get(user_id, -BLOCKED_REPLY_COOLDOWN_SECONDS) >= BLOCKED_REPLY_COOLDOWN_SECONDS:
+            if len(self._blocked_replies) > 1000:
+                self._blocked_replies = {
+                    uid: t for uid, t in self._blocked_replies.items() if now - t < BLOCKED_REPLY_COOLDOWN_SECONDS
+                }
+            self._blocked_replies[user_id] = now
+            try:
+                await update.effective_message.reply_text(
+                    f"❌ Ваш период эксплуатации бота истёк.\n\n"
+                    f"Вы превысили лимиты использования ({MAX_MESSAGES_PER_SESSION} запросов или {SESSION_DURATION_MINUTES} минут).\n"
+                    f"Для восстановления доступа обратитесь к администратору.",
+                    reply_markup=ReplyKeyboardRemove()
+                )
+            except TelegramError as e:
+                logger.error("[BLOCKED] Не удалось ответить заблокированному пользователю %s: %s", user_id, e)
+        
+        raise ApplicationHandlerStop
     
     def setup_handlers(self):
         """Настраивает обработчики сообщений"""
+        # Идентификатор обновления для логов (выполняется раньше остальных обработчиков)
+        self.application.add_handler(TypeHandler(Update, self.bind_correlation_id), group=-2)
+        # Заблокированные пользователи отсекаются до ConversationHandler и любого ввода-вывода
+        self.application.add_handler(TypeHandler(Update, self.reject_blocked_users), group=-1)
+        
         # Основной conversation handler
         conv_handler = ConversationHandler(
             entry_points=[
@@ -586,47 +870,127 @@ class PsychologyBot:
         self.application.add_handler(CommandHandler('settokens', cmd_settokens))
         self.application.add_handler(CommandHandler('resettokens', cmd_resettokens))
         
+        # Статистика сессий
+        from admin import cmd_analytics
+        self.application.add_handler(CommandHandler('analytics', cmd_analytics))
+        
         # Обработчик ошибок
         self.application.add_error_handler(self.error_handler)
     
+    async def load_stores(self) -> None:
+        """Загружает хранилища параллельно, каждое в своём потоке"""
+        from user_limits import user_limit_manager
+        
+        async def load(name, func):
+            with startup_profile.phase(f"load {name}"):
+                await asyncio.to_thread(func)
+        
+        await asyncio.gather(
+            load('user_limits', user_limit_manager.load),
+            load('transcript_cache', transcript_cache.load),
+            load('prompt', read_prompt)
+        )
+    
     async def run(self):
         """Запускает бота"""
-        # Создаем приложение
-        self.application = Application.builder().token(TELEGRAM_TOKEN).build()
-        
-        # Настраиваем обработчики
-        self.setup_handlers()
+        # Создаем приложение: исходящие запросы проходят через ограничитель с приоритетами,
+        # входящие обновления - через справедливую очередь (пользователи обслуживаются по кругу)
+        with startup_profile.phase('build application'):
+            self.application = (
+                Application.builder()
+                .token(TELEGRAM_TOKEN)
+                .rate_limiter(PriorityRateLimiter())
+                .concurrent_updates(FairUpdateProcessor())
+                .build()
+            )
+            set_notification_bot(self.application.bot)
+            
+            # Настраиваем обработчики
+            self.setup_handlers()
         
         logger.info("Бот запущен и готов к работе!")
         
-        # Инициализируем приложение
-        await self.application.initialize()
+        # SIGINT и SIGTERM запускают корректную остановку
+        self._stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stop_event.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Windows или цикл событий не в главном потоке
+                pass
+        
+        # Инициализируем приложение (запрос getMe) и одновременно загружаем хранилища
+        with startup_profile.phase('initialize + load stores'):
+            await asyncio.gather(self.application.initialize(), self.load_stores())
         
         try:
-            # Запускаем планировщик ежедневной очистки
-            await daily_scheduler.start()
+            # Запускаем планировщик задач обслуживания
+            with startup_profile.phase('start scheduler'):
+                await scheduler.start()
             
             # Запускаем бота
-            await self.application.start()
-            await self.application.updater.start_polling(
-                allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True
-            )
+            with startup_profile.phase('start polling'):
+                await self.application.start()
+                await self.application.updater.start_polling(
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True
+                )
+            startup_profile.report()
+            
+            # Клиент OpenAI (долгий импорт openai) создаём в фоне, пока ждём первых сообщений
+            self.application.create_task(asyncio.to_thread(get_client))
             
-            # Ждем бесконечно
-            while True:
-                await asyncio.sleep(1)
+            # Ждем сигнала остановки
+            await self._stop_event.wait()
+            logger.info("Получен сигнал остановки")
                 
         except KeyboardInterrupt:
             logger.info("Получен сигнал остановки")
         finally:
-            # Останавливаем планировщик
-            await daily_scheduler.stop()
-            
-            # Корректно останавливаем бота
+            await self.drain()
+    
+    async def drain(self) -> None:
+        """
+        Корректно останавливает бота, не теряя начатую работу
+        
+        Новые обновления больше не получаются, начатые голосовые сообщения
+        дообрабатываются (не дольше SHUTDOWN_DRAIN_SECONDS), затем сохраняются
+        данные и отправляются накопленные сообщения администраторам.
+        """
+        self._draining = True
+        logger.info(
+            "Остановка: дообрабатываем %s сообщений "
+            "(не дольше %.0f с)",
+            self._pipelines, SHUTDOWN_DRAIN_SECONDS
+        )
+        
+        # Больше не получаем обновления от Telegram
+        if self.application.updater.running:
             await self.application.updater.stop()
-            await self.application.stop()
+        
+        # Обрабатываем уже полученные обновления и ждём фоновые задачи приложения (сводки и т.п.)
+        stopped = True
+        if self.application.running:
+            stopping = asyncio.ensure_future(self.application.stop())
+            done, _ = await asyncio.wait({stopping}, timeout=SHUTDOWN_DRAIN_SECONDS)
+            stopped = bool(done)
+            if not stopped:
+                logger.warning(
+                    "За %.0f с не завершена обработка %s сообщений", SHUTDOWN_DRAIN_SECONDS, self._pipelines
+                )
+        
+        # Останавливаем планировщик и сохраняем накопленные данные
+        await scheduler.stop()
+        await analytics_store.flush()
+        await admin_digest.flush_all()
+        await transcript_cache.save()
+        await persistence.stop()
+        
+        # Завершаем работу бота (если обработка не уложилась в срок, её прервёт выход из процесса)
+        if stopped:
             await self.application.shutdown()
+        logger.info("Бот остановлен")
 
 async def main():
     """Главная функция"""
@@ -662,5 +1026,7 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
     except Exception as e:
-        logger.error(f"Критическая ошибка: {e}")
-        raise
\ No newline at end of file
+        logger.error("Критическая ошибка: %s", e)
+        raise
+    finally:
+        shutdown_logging()
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""
+Объединение голосовых сообщений, отправленных подряд
+
+Пользователи часто надиктовывают мысль несколькими короткими сообщениями.
+Обработка первого сообщения ждёт следующие VOICE_COALESCE_SECONDS (окно
+продлевается с каждым новым сообщением, но не дольше VOICE_COALESCE_MAX_SECONDS);
+сообщения, пришедшие за это время, распознаются параллельно, а ответ GPT и TTS
+готовится один на все.
+
+Сообщения забираются в пачку при получении (см. fair_queue.py) и не проходят
+обработчики сами. Если ответ на пачку отменён новым сообщением (см. pipelines.py),
+её сообщения переходят в начало следующей пачки - их транскрипты уже в кэше.
+"""
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Dict, List
+
+from telegram import Update
+
+from config import VOICE_COALESCE_SECONDS, VOICE_COALESCE_MAX_SECONDS
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class _Batch:
+    """Сообщения одного ответа"""
+    __slots__ = ('updates', 'queue', 'open')
+
+    def __init__(self, updates: List[Update]):
+        self.updates = updates
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.open = True
+
+class VoiceCoalescer:
+    """Пачки голосовых сообщений по пользователям"""
+
+    def __init__(self, window_seconds: float, max_seconds: float):
+        self.window_seconds = window_seconds
+        self.max_seconds = max_seconds
+        self._batches: Dict[int, _Batch] = {}
+        # Сообщения отменённых ответов, которые войдут в следующий ответ
+        self._deferred: Dict[int, List[Update]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_seconds > 0
+
+    def begin(self, user_id: int, update: Update) -> List[Update]:
+        """
+        Начинает пачку с сообщения update
+
+        Returns:
+            List[Update]: Сообщения пачки по порядку; пополняется в collect()
+        """
+        updates = self._deferred.pop(user_id, []) + [update]
+        self._batches[user_id] = _Batch(updates)
+        return updates
+
+    def absorb(self, update: Update) -> bool:
+        """Добавляет голосовое сообщение в открытую пачку пользователя; True, если добавлено"""
+        batch = self._batches.get(update.effective_user.id)
+        if not self.enabled or batch is None or not batch.open:
+            return False
+        batch.queue.put_nowait(update)
+        metrics.inc('voice.received')
+        metrics.inc('voice.coalesced')
+        return True
+
+    async def collect(self, user_id: int) -> AsyncIterator[Update]:
+        """Выдаёт сообщения, пришедшие в пачку за окно объединения, и закрывает её"""
+        batch = self._batches[user_id]
+        started = time.monotonic()
+        try:
+            while self.enabled:
+                timeout = min(self.window_seconds, self.max_seconds - (time.monotonic() - started))
+                if timeout <= 0:
+                    break
+                try:
+                    update = await asyncio.wait_for(batch.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.updates.append(update)
+                yield update
+        finally:
+            batch.open = False
+
+        # Сообщения, пришедшие одновременно с окончанием окна
+        while not batch.queue.empty():
+            update = batch.queue.get_nowait()
+            batch.updates.append(update)
+            yield update
+
+        if len(batch.updates) > 1:
+            logger.info(f"[COALESCE] {len(batch.updates)} сообщений пользователя {user_id} объединены в один ответ")
+
+    def defer(self, user_id: int) -> None:
+        """Переносит сообщения отменённого ответа в следующую пачку"""
+        batch = self._batches.get(user_id)
+        if batch and self.enabled:
+            self._deferred[user_id] = batch.updates
+
+    def end(self, user_id: int) -> None:
+        """Завершает пачку пользователя"""
+        self._batches.pop(user_id, None)
+
+# Глобальный экземпляр
+voice_coalescer = VoiceCoalescer(
+    window_seconds=VOICE_COALESCE_SECONDS,
+    max_seconds=VOICE_COALESCE_MAX_SECONDS
+)
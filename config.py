@@ -4,8 +4,12 @@
 import os
 import logging
 from pathlib import Path
+from typing import Optional
 from dotenv import load_dotenv
 
+from metrics import metrics
+from persistence import persistence
+
 # Загружаем переменные окружения
 load_dotenv()
 
@@ -29,23 +33,112 @@ ADMIN_IDS = [
 ]
 DEBUG_SEND_VOICE = os.getenv('DEBUG_SEND_VOICE', 'false').lower() == 'true'
 
+# Копии для администраторов: immediate - каждое сообщение сразу,
+# session - одна сводка на сессию, window - одна сводка за окно времени
+ADMIN_MIRROR_MODE = os.getenv('ADMIN_MIRROR_MODE', 'immediate').lower()
+ADMIN_DIGEST_WINDOW_MINUTES = float(os.getenv('ADMIN_DIGEST_WINDOW_MINUTES', 15))
+ADMIN_DIGEST_IDLE_MINUTES = float(os.getenv('ADMIN_DIGEST_IDLE_MINUTES', 10))  # сводка сессии без активности
+ADMIN_DIGEST_VOICE = os.getenv('ADMIN_DIGEST_VOICE', 'false').lower() == 'true'  # прикладывать голосовые
+
 # Лимиты пользователей (глобальные переменные для динамического изменения)
 MAX_MESSAGES_PER_SESSION = int(os.getenv('MAX_MESSAGES_PER_SESSION', 10))
 SESSION_DURATION_MINUTES = int(os.getenv('SESSION_DURATION_MINUTES', 30))
 
 # Пути
 DATA_DIR = Path('data')
-TEMP_DIR = Path('temp')
+TEMP_DIR = Path(os.getenv('TEMP_DIR', 'temp'))  # можно указать tmpfs, например /dev/shm/gptnitik
 PROMPT_FILE = DATA_DIR / 'prompt.txt'
 LIMITS_FILE = DATA_DIR / 'limits.txt'
 
 # Создаем необходимые директории
 DATA_DIR.mkdir(exist_ok=True)
-TEMP_DIR.mkdir(exist_ok=True)
+TEMP_DIR.mkdir(parents=True, exist_ok=True)
 
 # Настройки GPT
 MAX_TOKENS = int(os.getenv('MAX_TOKENS', 500))
 
+# Ограничения входящих голосовых сообщений (проверяются до скачивания и декодирования)
+MAX_VOICE_DURATION_SECONDS = int(os.getenv('MAX_VOICE_DURATION_SECONDS', 420))  # 7 минут
+MAX_VOICE_FILE_MB = int(os.getenv('MAX_VOICE_FILE_MB', 20))  # лимит скачивания Bot API
+
+# Детектор речи (VAD): обрезка тишины перед отправкой в Whisper
+VAD_ENABLED = os.getenv('VAD_ENABLED', 'true').lower() == 'true'
+VAD_MAX_PAUSE_MS = int(os.getenv('VAD_MAX_PAUSE_MS', 800))  # длинные паузы сжимаются до этой длины
+VAD_MARGIN_DB = float(os.getenv('VAD_MARGIN_DB', 12))  # превышение над уровнем шума для речи
+
+# Длинные записи распознаются параллельно перекрывающимися фрагментами
+STT_CHUNK_SECONDS = float(os.getenv('STT_CHUNK_SECONDS', 45))  # не больше ~13 мин (25MB WAV 16kHz)
+STT_CHUNK_OVERLAP_SECONDS = float(os.getenv('STT_CHUNK_OVERLAP_SECONDS', 1.0))
+STT_MAX_CONCURRENCY = int(os.getenv('STT_MAX_CONCURRENCY', 4))
+
+# Отсев неуверенно распознанных сегментов Whisper (шум, принятый за речь): сегмент
+# отбрасывается, если вероятность отсутствия речи выше порога или средний logprob ниже порога
+STT_SEGMENT_FILTER = os.getenv('STT_SEGMENT_FILTER', 'false').lower() == 'true'
+STT_NO_SPEECH_PROB = float(os.getenv('STT_NO_SPEECH_PROB', 0.8))
+STT_MIN_AVG_LOGPROB = float(os.getenv('STT_MIN_AVG_LOGPROB', -1.0))  # порог повторного декодирования в Whisper
+
+# Кэш транскриптов по file_unique_id (пересланные и повторно отправленные голосовые)
+TRANSCRIPT_CACHE_SIZE = int(os.getenv('TRANSCRIPT_CACHE_SIZE', 500))
+TRANSCRIPT_CACHE_TTL_HOURS = float(os.getenv('TRANSCRIPT_CACHE_TTL_HOURS', 24))
+TRANSCRIPT_CACHE_PERSIST = os.getenv('TRANSCRIPT_CACHE_PERSIST', 'false').lower() == 'true'
+
+# Настройки TTS: длинные ответы синтезируются параллельно по фрагментам
+# Обычный ответ (MAX_TOKENS=500, около 1000-1500 символов) синтезируется одним запросом:
+# каждый стык фрагментов - это склейка потоков Opus
+TTS_CHUNK_CHARS = min(int(os.getenv('TTS_CHUNK_CHARS', 2000)), 4096)  # 4096 - лимит OpenAI TTS
+TTS_MAX_CONCURRENCY = int(os.getenv('TTS_MAX_CONCURRENCY', 4))
+
+# Временные файлы: квота на объём и периодическая очистка (задача планировщика)
+TEMP_QUOTA_MB = int(os.getenv('TEMP_QUOTA_MB', 500))
+TEMP_QUOTA_WAIT_SECONDS = float(os.getenv('TEMP_QUOTA_WAIT_SECONDS', 30))  # ожидание места при превышении квоты
+TEMP_MAX_AGE_MINUTES = int(os.getenv('TEMP_MAX_AGE_MINUTES', 60))
+TEMP_JANITOR_INTERVAL_SECONDS = int(os.getenv('TEMP_JANITOR_INTERVAL_SECONDS', 300))
+
+# Статистика сессий: записи копятся в памяти и пишутся в SQLite пачками
+ANALYTICS_BATCH_SIZE = int(os.getenv('ANALYTICS_BATCH_SIZE', 20))
+ANALYTICS_FLUSH_SECONDS = float(os.getenv('ANALYTICS_FLUSH_SECONDS', 60))
+ANALYTICS_IDLE_MINUTES = float(os.getenv('ANALYTICS_IDLE_MINUTES', 30))  # сессия без активности считается брошенной
+
+# Планировщик: фоновые задачи откладываются, пока идёт обработка сообщений, но не дольше
+SCHEDULER_OFF_PEAK_MAX_DEFER_MINUTES = int(os.getenv('SCHEDULER_OFF_PEAK_MAX_DEFER_MINUTES', 30))
+
+# Исходящие запросы к Telegram: лимиты бота и чата, повторы после RetryAfter
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))  # запросов в секунду на бота
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))  # сообщений в секунду в личный чат
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv('TELEGRAM_GROUP_RATE_PER_MINUTE', 20))
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', 2))
+
+# Очередь голосовых: мест в конвейере STT → GPT → TTS и пределы очереди
+VOICE_MAX_CONCURRENCY = int(os.getenv('VOICE_MAX_CONCURRENCY', 4))
+VOICE_QUEUE_MAX_DEPTH = int(os.getenv('VOICE_QUEUE_MAX_DEPTH', 20))  # дальше - сразу отказ с оценкой ожидания
+VOICE_QUEUE_MAX_PER_USER = int(os.getenv('VOICE_QUEUE_MAX_PER_USER', 3))
+
+# Объединение голосовых сообщений подряд в один ответ: окно ожидания следующего сообщения
+# и максимальное ожидание (с); 0 - каждое сообщение обрабатывается отдельно
+VOICE_COALESCE_SECONDS = float(os.getenv('VOICE_COALESCE_SECONDS', 0))
+VOICE_COALESCE_MAX_SECONDS = float(os.getenv('VOICE_COALESCE_MAX_SECONDS', 15))
+
+# Сроки обработки голосового сообщения: общий и лимиты этапов (с)
+VOICE_DEADLINE_SECONDS = float(os.getenv('VOICE_DEADLINE_SECONDS', 150))
+DEADLINE_DOWNLOAD_SECONDS = float(os.getenv('DEADLINE_DOWNLOAD_SECONDS', 20))
+DEADLINE_STT_SECONDS = float(os.getenv('DEADLINE_STT_SECONDS', 60))
+DEADLINE_GPT_SECONDS = float(os.getenv('DEADLINE_GPT_SECONDS', 40))
+DEADLINE_TTS_SECONDS = float(os.getenv('DEADLINE_TTS_SECONDS', 60))
+DEADLINE_SEND_SECONDS = float(os.getenv('DEADLINE_SEND_SECONDS', 30))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv('OPENAI_TIMEOUT_SECONDS', 60))  # для запросов вне обработки сообщения
+
+# Остановка: сколько ждать завершения начатой обработки сообщений
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', 60))
+
+# Бюджет токенов в минуту для GPT (лимит TPM аккаунта OpenAI); 0 - без ограничения
+GPT_TOKENS_PER_MINUTE = int(os.getenv('GPT_TOKENS_PER_MINUTE', 0))
+
+# Дублирующие запросы к STT/TTS: дубль отправляется, если ответа нет дольше p95
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() == 'true'
+HEDGE_BUDGET_PERCENT = float(os.getenv('HEDGE_BUDGET_PERCENT', 5))  # максимум дублей, % от всех запросов
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 20))  # замеров до первого дубля
+
 # Файл для хранения настроек токенов
 TOKENS_FILE = DATA_DIR / 'tokens.txt'
 
@@ -57,18 +150,22 @@ def get_current_max_tokens() -> int:
         Текущий лимит токенов
     """
     try:
-        if TOKENS_FILE.exists():
-            with open(TOKENS_FILE, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-                if content:
-                    return int(content)
+        content = persistence.read_text(TOKENS_FILE)
+        if content and content.strip():
+            return int(content.strip())
     except (ValueError, FileNotFoundError):
         pass
     
     # Возвращаем значение по умолчанию
     return int(os.getenv('MAX_TOKENS', 500))
 
-def write_max_tokens(max_tokens: int) -> bool:
+async def _persist(path: Path, content: Optional[str]) -> None:
+    """Записывает (None - удаляет) файл через persistence и дожидается результата"""
+    future = persistence.write(path, content)
+    if future is not None:
+        await future
+
+async def write_max_tokens(max_tokens: int) -> bool:
     """
     Записывает новый лимит токенов в файл
     
@@ -79,11 +176,7 @@ def write_max_tokens(max_tokens: int) -> bool:
         True если успешно запи��ано, False в случае ошибки
     """
     try:
-        # Создаем директорию если не существует
-        DATA_DIR.mkdir(exist_ok=True)
-        
-        with open(TOKENS_FILE, 'w', encoding='utf-8') as f:
-            f.write(str(max_tokens))
+        await _persist(TOKENS_FILE, str(max_tokens))
         
         # Обновляем глобальную переменную
         global MAX_TOKENS
@@ -94,7 +187,7 @@ def write_max_tokens(max_tokens: int) -> bool:
         logger.error(f"Ошибка записи лимита токенов: {e}")
         return False
 
-def reset_max_tokens() -> bool:
+async def reset_max_tokens() -> bool:
     """
     Сбрасывает лимит токенов к значению по умолчанию
     
@@ -104,8 +197,7 @@ def reset_max_tokens() -> bool:
     try:
         default_tokens = int(os.getenv('MAX_TOKENS', 500))
         
-        if TOKENS_FILE.exists():
-            TOKENS_FILE.unlink()
+        await _persist(TOKENS_FILE, None)
         
         # Обновляем глобальную переменную
         global MAX_TOKENS
@@ -129,36 +221,40 @@ def is_admin(user_id: int) -> bool:
 def read_prompt() -> str:
     """Читает системный промпт из файла"""
     try:
-        if PROMPT_FILE.exists():
-            return PROMPT_FILE.read_text(encoding='utf-8').strip()
+        prompt = persistence.read_text(PROMPT_FILE)
+        if prompt is not None:
+            prompt = prompt.strip()
+            metrics.set_gauge('prompt_chars', len(prompt))
+            return prompt
         else:
-            # Создаем файл с промптом по умолчанию
-            write_prompt(DEFAULT_PROMPT)
+            # Создаем файл с промптом по умолчанию (без ожидания: чтение синхронное)
+            persistence.write_logged(PROMPT_FILE, DEFAULT_PROMPT)
             return DEFAULT_PROMPT
     except Exception as e:
         logger.error(f"Ошибка чтения промпта: {e}")
         return DEFAULT_PROMPT
 
-def write_prompt(prompt: str) -> bool:
+async def write_prompt(prompt: str) -> bool:
     """Записывает системный промпт в файл"""
     try:
-        PROMPT_FILE.write_text(prompt, encoding='utf-8')
+        await _persist(PROMPT_FILE, prompt)
+        metrics.set_gauge('prompt_chars', len(prompt))
         logger.info(f"Промпт обновлён: {prompt[:50]}...")
         return True
     except Exception as e:
         logger.error(f"Ошибка записи промпта: {e}")
         return False
 
-def reset_prompt() -> bool:
+async def reset_prompt() -> bool:
     """Сбрасывает промпт к значению по умолчанию"""
-    return write_prompt(DEFAULT_PROMPT)
+    return await write_prompt(DEFAULT_PROMPT)
 
 def read_limits() -> tuple[int, int]:
     """Читает лимиты из файла или возвращает текущие значения"""
     try:
-        if LIMITS_FILE.exists():
-            content = LIMITS_FILE.read_text(encoding='utf-8').strip()
-            lines = content.split('\n')
+        content = persistence.read_text(LIMITS_FILE)
+        if content is not None:
+            lines = content.strip().split('\n')
             if len(lines) >= 2:
                 max_messages = int(lines[0].split('=')[1])
                 session_duration = int(lines[1].split('=')[1])
@@ -169,13 +265,13 @@ def read_limits() -> tuple[int, int]:
     # Возвращаем текущие значения если файл не существует или есть ошибка
     return MAX_MESSAGES_PER_SESSION, SESSION_DURATION_MINUTES
 
-def write_limits(max_messages: int, session_duration: int) -> bool:
+async def write_limits(max_messages: int, session_duration: int) -> bool:
     """Записывает лимиты в файл и обновляет глобальные переменные"""
     global MAX_MESSAGES_PER_SESSION, SESSION_DURATION_MINUTES
     
     try:
         content = f"MAX_MESSAGES_PER_SESSION={max_messages}\nSESSION_DURATION_MINUTES={session_duration}\n"
-        LIMITS_FILE.write_text(content, encoding='utf-8')
+        await _persist(LIMITS_FILE, content)
         
         # Обновляем глобальные переменные
         MAX_MESSAGES_PER_SESSION = max_messages
@@ -191,11 +287,11 @@ def get_current_limits() -> tuple[int, int]:
     """Возвращает текущие лимиты"""
     return MAX_MESSAGES_PER_SESSION, SESSION_DURATION_MINUTES
 
-def reset_limits() -> bool:
+async def reset_limits() -> bool:
     """Сбрасывает лимиты к значениям по умолчанию из .env"""
     default_messages = int(os.getenv('MAX_MESSAGES_PER_SESSION', 10))
     default_duration = int(os.getenv('SESSION_DURATION_MINUTES', 30))
-    return write_limits(default_messages, default_duration)
+    return await write_limits(default_messages, default_duration)
 
 # Загружаем лимиты из файла при запуске (если файл существует)
 def _load_limits_on_startup():
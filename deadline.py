@@ -0,0 +1,91 @@
+"""
+Сроки обработки голосового сообщения
+
+У каждого сообщения общий срок VOICE_DEADLINE_SECONDS; каждому этапу
+(скачивание, STT, GPT, TTS, отправка) достаётся не больше своего лимита
+и не больше остатка общего срока. Этап, не уложившийся в срок, отменяется.
+Срок текущего сообщения доступен через contextvar, поэтому запросы к OpenAI
+получают таймаут по остатку срока без передачи параметров через все вызовы.
+"""
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Dict, Optional, TypeVar
+
+from config import (
+    VOICE_DEADLINE_SECONDS, DEADLINE_DOWNLOAD_SECONDS, DEADLINE_STT_SECONDS,
+    DEADLINE_GPT_SECONDS, DEADLINE_TTS_SECONDS, DEADLINE_SEND_SECONDS
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Лимиты этапов (с)
+STAGE_LIMITS: Dict[str, float] = {
+    'download': DEADLINE_DOWNLOAD_SECONDS,
+    'stt': DEADLINE_STT_SECONDS,
+    'gpt': DEADLINE_GPT_SECONDS,
+    'tts': DEADLINE_TTS_SECONDS,
+    'send': DEADLINE_SEND_SECONDS,
+}
+
+_STAGE_NAMES = {
+    'download': 'загрузка сообщения',
+    'stt': 'распознавание речи',
+    'gpt': 'подготовка ответа',
+    'tts': 'озвучивание ответа',
+    'send': 'отправка ответа',
+}
+
+class DeadlineExceeded(ValueError):
+    """Этап не уложился в срок (текст - для пользователя)"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        super().__init__(f"Слишком долго: {_STAGE_NAMES.get(stage, stage)}. Попробуйте ещё раз.")
+
+class Deadline:
+    """Общий срок обработки одного сообщения"""
+
+    def __init__(self, seconds: float = VOICE_DEADLINE_SECONDS):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """Сколько секунд осталось до общего срока"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def timeout_for(self, stage: str) -> float:
+        """Таймаут этапа: его лимит, но не больше остатка общего срока"""
+        return min(STAGE_LIMITS.get(stage, float('inf')), self.remaining())
+
+    async def run(self, stage: str, awaitable: Awaitable[T]) -> T:
+        """
+        Выполняет этап с таймаутом; при превышении этап отменяется
+
+        Raises:
+            DeadlineExceeded: Если этап не уложился в срок
+        """
+        timeout = self.timeout_for(stage)
+        try:
+            if timeout <= 0:
+                raise asyncio.TimeoutError
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            metrics.inc(f'deadline.{stage}')
+            logger.warning(f"Этап {stage} не уложился в {timeout:.1f} с (до общего срока {self.remaining():.1f} с)")
+            raise DeadlineExceeded(stage) from None
+
+# Срок сообщения, обрабатываемого в текущей задаче
+current_deadline: ContextVar[Optional[Deadline]] = ContextVar('deadline', default=None)
+
+def request_timeout() -> Dict[str, Any]:
+    """Аргумент timeout для запроса к OpenAI по остатку срока (пустой, если срока нет)"""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return {}
+    return {'timeout': max(deadline.remaining(), 1.0)}
@@ -0,0 +1,193 @@
+"""
+Справедливая очередь обработки обновлений
+
+Обновления каждого пользователя обрабатываются строго по одному и по порядку
+(на это рассчитан ConversationHandler), а разные пользователи - параллельно.
+Голосовые сообщения занимают одно из VOICE_MAX_CONCURRENCY мест конвейера
+STT → GPT → TTS; свободное место получает пользователь, которого дольше
+всех не обслуживали, поэтому серия сообщений одного пользователя не задерживает остальных.
+
+Если очередь голосовых длиннее VOICE_QUEUE_MAX_DEPTH (или у пользователя
+больше VOICE_QUEUE_MAX_PER_USER сообщений в очереди), новое сообщение сразу
+отклоняется с оценкой ожидания вместо того, чтобы ждать до таймаута.
+
+Команды отмены и новые голосовые сообщения отменяют начатую обработку
+сразу при получении, до постановки в очередь (см. pipelines.py), а голосовые,
+пришедшие в окно объединения, забираются в начатый ответ (см. coalescer.py).
+"""
+import asyncio
+import itertools
+import logging
+import math
+from collections import deque
+from typing import Any, Awaitable, Deque, Dict, Optional, Set
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from config import VOICE_MAX_CONCURRENCY, VOICE_QUEUE_MAX_DEPTH, VOICE_QUEUE_MAX_PER_USER
+from metrics import metrics
+from pipelines import pipeline_registry
+from coalescer import voice_coalescer
+
+logger = logging.getLogger(__name__)
+
+# Этапы конвейера, из средних длительностей которых складывается оценка ожидания
+_PIPELINE_STAGES = ('download', 'stt', 'gpt', 'tts', 'send')
+
+# Оценка длительности конвейера, пока нет замеров
+_DEFAULT_PIPELINE_SECONDS = 20.0
+
+# Верхняя граница одновременно обрабатываемых обновлений (лёгкие обновления не ждут конвейер)
+_MAX_CONCURRENT_UPDATES = 256
+
+class _Ticket:
+    """Место обновления в очереди пользователя"""
+    __slots__ = ('heavy', 'turn')
+
+    def __init__(self, heavy: bool, turn: asyncio.Future):
+        self.heavy = heavy
+        self.turn = turn
+
+class FairUpdateProcessor(BaseUpdateProcessor):
+    """Обработчик обновлений для Application.builder().concurrent_updates(...)"""
+
+    def __init__(
+        self,
+        max_pipelines: int = VOICE_MAX_CONCURRENCY,
+        max_queue_depth: int = VOICE_QUEUE_MAX_DEPTH,
+        max_per_user: int = VOICE_QUEUE_MAX_PER_USER
+    ):
+        super().__init__(max_concurrent_updates=_MAX_CONCURRENT_UPDATES)
+        self.max_pipelines = max_pipelines
+        self.max_queue_depth = max_queue_depth
+        self.max_per_user = max_per_user
+
+        self._queues: Dict[int, Deque[_Ticket]] = {}
+        # Номер последнего выданного места конвейера по пользователям (меньше - раньше в очереди)
+        self._last_served: Dict[int, int] = {}
+        self._serve_counter = itertools.count(1)
+        # Пользователи, у которых сейчас обрабатывается обновление
+        self._running: Set[int] = set()
+        self._active_pipelines = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def waiting(self) -> int:
+        """Сколько голосовых сообщений ждут места в конвейере"""
+        return sum(
+            1 for queue in self._queues.values() for ticket in queue
+            if ticket.heavy and not ticket.turn.done()
+        )
+
+    @staticmethod
+    def _is_heavy(update: Update) -> bool:
+        """Голосовое сообщение от незаблокированного пользователя (заблокированных отсекают сразу)"""
+        if not update.message or not update.message.voice:
+            return False
+        from user_limits import user_limit_manager
+        return not user_limit_manager.is_user_blocked(update.effective_user.id)
+
+    def estimate_wait(self, position: int) -> float:
+        """Оценка ожидания (с) для места position в очереди по средним длительностям этапов"""
+        stages = metrics.snapshot()['stages']
+        pipeline_seconds = sum(
+            stages[name]['avg_seconds'] for name in _PIPELINE_STAGES if name in stages
+        ) or _DEFAULT_PIPELINE_SECONDS
+        return math.ceil(position / self.max_pipelines) * pipeline_seconds
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if not isinstance(update, Update) or not update.effective_user:
+            await coroutine
+            return
+
+        user_id = update.effective_user.id
+        heavy = self._is_heavy(update)
+        queue = self._queues.get(user_id)
+
+        # Сообщение, пришедшее в окно объединения, войдёт в уже начатый ответ
+        if heavy and voice_coalescer.absorb(update):
+            coroutine.close()
+            return
+
+        if heavy and await self._shed(update, queue):
+            coroutine.close()
+            return
+
+        # /cancel и новое голосовое отменяют начатую обработку, не дожидаясь своей очереди
+        pipeline_registry.supersede(update, heavy)
+
+        ticket = _Ticket(heavy, asyncio.get_running_loop().create_future())
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+        queue.append(ticket)
+        self._dispatch()
+        metrics.set_gauge('queue.waiting', self.waiting)
+
+        try:
+            await ticket.turn
+            await coroutine
+        finally:
+            if ticket.turn.done() and not ticket.turn.cancelled():
+                self._running.discard(user_id)
+                if heavy:
+                    self._active_pipelines -= 1
+            else:
+                ticket.turn.cancel()
+            # Если до обработки дело не дошло (отмена при остановке), закрываем корутину без запуска
+            coroutine.close()
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[user_id]
+                self._last_served.pop(user_id, None)
+            self._dispatch()
+            metrics.set_gauge('queue.waiting', self.waiting)
+
+    async def _shed(self, update: Update, queue: Optional[Deque[_Ticket]]) -> bool:
+        """Отклоняет голосовое сообщение, если очередь переполнена; возвращает True, если отклонено"""
+        user_pending = sum(1 for ticket in queue if ticket.heavy) if queue else 0
+        waiting = self.waiting
+        if waiting < self.max_queue_depth and user_pending < self.max_per_user:
+            return False
+
+        position = waiting + 1
+        wait_seconds = self.estimate_wait(position)
+        metrics.inc('queue.shed')
+        logger.warning(
+            f"[QUEUE] Сообщение от {update.effective_user.id} отклонено: в очереди {waiting}, "
+            f"у пользователя {user_pending}, ожидание ~{wait_seconds:.0f} с"
+        )
+        try:
+            if user_pending >= self.max_per_user:
+                text = (
+                    f"⏳ Я ещё обрабатываю твои предыдущие сообщения ({user_pending}). "
+                    f"Отправь это ещё раз примерно через {wait_seconds:.0f} с."
+                )
+            else:
+                text = (
+                    f"⏳ Сейчас очень много сообщений: ты {position}-й в очереди, "
+                    f"это примерно {wait_seconds:.0f} с. Отправь сообщение ещё раз чуть позже."
+                )
+            await update.message.reply_text(text)
+        except Exception as e:
+            logger.error(f"[QUEUE] Не удалось сообщить об очереди пользователю {update.effective_user.id}: {e}")
+        return True
+
+    def _dispatch(self) -> None:
+        """Раздаёт очередь: по одному обновлению на пользователя, места конвейера - дольше всех ждущим"""
+        for user_id in sorted(self._queues, key=lambda uid: self._last_served.get(uid, 0)):
+            if user_id in self._running:
+                continue
+            ticket = self._queues[user_id][0]
+            if ticket.heavy:
+                if self._active_pipelines >= self.max_pipelines:
+                    continue
+                self._active_pipelines += 1
+                self._last_served[user_id] = next(self._serve_counter)
+            self._running.add(user_id)
+            ticket.turn.set_result(None)
@@ -4,15 +4,15 @@
 import asyncio
 import logging
 from typing import AsyncGenerator
-from openai import AsyncOpenAI
 
-from config import OPENAI_API_KEY, read_prompt, MAX_TOKENS
+import config
+from config import read_prompt
+from openai_client import get_client
+from deadline import request_timeout
+from token_budget import token_budget, estimate_prompt_tokens
 
 logger = logging.getLogger(__name__)
 
-# Инициализируем клиент OpenAI
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-
 async def get_gpt_response(text: str, user_name: str = "Пользователь") -> str:
     """
     Получает ответ от GPT-4 на основе пользовательского текста
@@ -28,8 +28,8 @@ async def get_gpt_response(text: str, user_name: str = "Пользователь
         ValueError: При ошибках API или обработки
     """
     try:
-        # Читаем текущий системный промпт
-        system_prompt = read_prompt()
+        # Читаем текущий системный промпт (чтение файла - в отдельном потоке)
+        system_prompt = await asyncio.to_thread(read_prompt)
         
         # Формируем сообщения для GPT
         messages = [
@@ -43,15 +43,30 @@ async def get_gpt_response(text: str, user_name: str = "Пользователь
             }
         ]
         
+        # Лимит читается при каждом запросе: его меняет /settokens
+        max_tokens = config.MAX_TOKENS
+        
+        # Резервируем токены в бюджете TPM; при нехватке ждём, а не получаем 429
+        prompt_tokens = estimate_prompt_tokens(messages)
+        reservation = await token_budget.reserve(prompt_tokens + max_tokens)
+        
         # Отправляем запрос к GPT-4
-        response = await client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            max_tokens=MAX_TOKENS,  # Ограничиваем длину ответа (настраивается в .env)
-            temperature=0.7,  # Немного креативности, но не слишком много
-            presence_penalty=0.1,  # Избегаем повторений
-            frequency_penalty=0.1
-        )
+        try:
+            response = await get_client().chat.completions.create(
+                model="gpt-4",
+                messages=messages,
+                max_tokens=max_tokens,  # Ограничиваем длину ответа (настраивается в .env)
+                temperature=0.7,  # Немного креативности, но не слишком много
+                presence_penalty=0.1,  # Избегаем повторений
+                frequency_penalty=0.1,
+                **request_timeout()
+            )
+        except BaseException:
+            # Ответа нет (429, таймаут, отмена): резерв под ответ освобождается
+            token_budget.settle(reservation, prompt_tokens)
+            raise
+        if response.usage:
+            token_budget.settle(reservation, response.usage.total_tokens)
         
         gpt_text = response.choices[0].message.content.strip()
         
@@ -85,8 +100,8 @@ async def get_gpt_response_stream(text: str, user_name: str = "Пользова
         str: Части ответа от GPT-4
     """
     try:
-        # Читаем текущий системный промпт
-        system_prompt = read_prompt()
+        # Читаем текущий системный промпт (чтение файла - в отдельном потоке)
+        system_prompt = await asyncio.to_thread(read_prompt)
         
         # Формируем сообщения для GPT
         messages = [
@@ -100,20 +115,36 @@ async def get_gpt_response_stream(text: str, user_name: str = "Пользова
             }
         ]
         
-        # Отправляем потоковый запрос к GPT-4
-        stream = await client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            max_tokens=MAX_TOKENS,
-            temperature=0.7,
-            presence_penalty=0.1,
-            frequency_penalty=0.1,
-            stream=True
-        )
-        
-        async for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                yield chunk.choices[0].delta.content
+        max_tokens = config.MAX_TOKENS
+        prompt_tokens = estimate_prompt_tokens(messages)
+        reservation = await token_budget.reserve(prompt_tokens + max_tokens)
+        settled = False
+        
+        try:
+            # Отправляем потоковый запрос к GPT-4; расход приходит в последнем фрагменте
+            stream = await get_client().chat.completions.create(
+                model="gpt-4",
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=0.7,
+                presence_penalty=0.1,
+                frequency_penalty=0.1,
+                stream=True,
+                stream_options={"include_usage": True},
+                **request_timeout()
+            )
+            
+            async for chunk in stream:
+                if chunk.usage:
+                    token_budget.settle(reservation, chunk.usage.total_tokens)
+                    settled = True
+                # Последний фрагмент с usage не содержит choices
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    yield chunk.choices[0].delta.content
+        finally:
+            if not settled:
+                # Итогового расхода нет (ошибка, таймаут, прерванный поток) - резерв под ответ освобождается
+                token_budget.settle(reservation, prompt_tokens)
                 
     except Exception as e:
         logger.error(f"Ошибка потокового GPT: {e}")
@@ -0,0 +1,123 @@
+"""
+Дублирующие (hedged) запросы к STT и TTS
+
+Если запрос не завершился за текущий p95 своего endpoint, отправляется
+второй такой же запрос; берётся ответ, пришедший первым, второй отменяется.
+Доля дублей ограничена бюджетом HEDGE_BUDGET_PERCENT от всех запросов.
+Включается через HEDGE_ENABLED=true.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+
+from config import HEDGE_ENABLED, HEDGE_BUDGET_PERCENT, HEDGE_MIN_SAMPLES
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Сколько последних длительностей хранить для расчёта p95
+_WINDOW = 200
+
+class Hedger:
+    """Дублирующие запросы с порогом по p95 и бюджетом на дубли"""
+
+    def __init__(self, enabled: bool, budget_percent: float, min_samples: int):
+        self.enabled = enabled
+        self.budget = budget_percent / 100
+        self.min_samples = min_samples
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._requests: Dict[str, int] = {}
+        self._hedges: Dict[str, int] = {}
+        self._wins: Dict[str, int] = {}
+
+    def p95(self, endpoint: str) -> Optional[float]:
+        """p95 длительности запросов endpoint или None, если замеров мало"""
+        samples = self._latencies.get(endpoint)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def _record(self, endpoint: str, seconds: float) -> None:
+        self._latencies.setdefault(endpoint, deque(maxlen=_WINDOW)).append(seconds)
+
+    def _budget_allows(self, endpoint: str) -> bool:
+        return self._hedges.get(endpoint, 0) < self.budget * self._requests.get(endpoint, 0)
+
+    async def run(self, endpoint: str, request: Callable[[], Awaitable[T]]) -> T:
+        """
+        Выполняет запрос, при задержке дольше p95 дублируя его
+
+        Args:
+            endpoint: Имя endpoint для статистики (stt, tts)
+            request: Функция, создающая новый запрос при каждом вызове
+        """
+        self._requests[endpoint] = self._requests.get(endpoint, 0) + 1
+        threshold = self.p95(endpoint) if self.enabled else None
+
+        started = time.monotonic()
+        primary = asyncio.ensure_future(request())
+        tasks = {primary}
+        hedge: Optional[asyncio.Future] = None
+        hedge_started = 0.0
+
+        try:
+            if threshold is not None:
+                await asyncio.wait(tasks, timeout=threshold)
+                if not primary.done() and self._budget_allows(endpoint):
+                    self._hedges[endpoint] = self._hedges.get(endpoint, 0) + 1
+                    metrics.inc(f'hedge.{endpoint}.sent')
+                    logger.debug("Запрос %s дольше p95 (%.2f с), отправляем дубль", endpoint, threshold)
+                    hedge_started = time.monotonic()
+                    hedge = asyncio.ensure_future(request())
+                    tasks.add(hedge)
+
+            # Первый успешный ответ; ошибка учитывается, только если упали все запросы
+            failed: List[asyncio.Task] = []
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                # exception() у отменённой задачи сама бросает CancelledError
+                winner = next((task for task in done if not task.cancelled() and task.exception() is None), None)
+                if winner is not None:
+                    break
+                failed = [task for task in done if not task.cancelled()] or failed
+                tasks -= done
+                if not tasks:
+                    # Ошибку запроса предпочитаем отмене
+                    return (failed or list(done))[0].result()
+
+            if winner is hedge:
+                self._wins[endpoint] = self._wins.get(endpoint, 0) + 1
+                metrics.inc(f'hedge.{endpoint}.won')
+                self._record(endpoint, time.monotonic() - hedge_started)
+            else:
+                self._record(endpoint, time.monotonic() - started)
+            return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Доля дублей и доля выигравших дублей по endpoint"""
+        result = {}
+        for endpoint, requests in self._requests.items():
+            hedges = self._hedges.get(endpoint, 0)
+            result[endpoint] = {
+                'requests': requests,
+                'hedge_rate': hedges / requests if requests else 0.0,
+                'win_rate': self._wins.get(endpoint, 0) / hedges if hedges else 0.0,
+                'p95': self.p95(endpoint),
+            }
+        return result
+
+# Глобальный экземпляр
+hedger = Hedger(
+    enabled=HEDGE_ENABLED,
+    budget_percent=HEDGE_BUDGET_PERCENT,
+    min_samples=HEDGE_MIN_SAMPLES
+)
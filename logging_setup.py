@@ -0,0 +1,164 @@
+"""
+Неблокирующее логирование: записи передаются через ограниченную очередь
+фоновому потоку, который собирает сообщения из %-аргументов, форматирует
+их (текст или JSON) и пишет в session.log с ротацией по размеру и времени
+и сжатием старых файлов
+
+Модуль настраивается до импорта config, чтобы не терять сообщения,
+которые config пишет при загрузке, поэтому читает .env сам.
+"""
+import contextvars
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+from datetime import datetime
+from pathlib import PurePath
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from metrics import metrics
+
+load_dotenv()
+
+LOG_FILE = os.getenv('LOG_FILE', 'session.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()  # text или json
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_MAX_MB = float(os.getenv('LOG_MAX_MB', 10))
+LOG_ROTATE_HOURS = float(os.getenv('LOG_ROTATE_HOURS', 24))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 14))
+
+# Идентификатор обрабатываемого обновления Telegram для связывания записей лога
+correlation_id: contextvars.ContextVar[str] = contextvars.ContextVar('correlation_id', default='-')
+
+_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s'
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+class CorrelationFilter(logging.Filter):
+    """Добавляет в запись идентификатор текущего обновления (в потоке вызова)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись как одну строку JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'corr': getattr(record, 'correlation_id', '-'),
+            'msg': record.getMessage(),
+        }
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+# Аргументы этих типов не меняются после вызова логгера, их можно подставить позже
+_IMMUTABLE_ARGS = (str, int, float, bool, bytes, type(None), PurePath)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который не блокирует цикл событий
+
+    Если все аргументы %-сообщения неизменяемые (строки, числа, пути),
+    запись уходит в очередь как есть, и сообщение собирается вместе с
+    форматированием в фоновом потоке. Изменяемые аргументы (объекты,
+    исключения, словари) подставляются сразу в потоке вызова, иначе в лог
+    попало бы их более позднее состояние. Трассировка исключения тоже
+    форматируется в потоке вызова. При переполнении очереди запись
+    отбрасывается и учитывается в счётчике log.dropped.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        args = record.args
+        if args and not (isinstance(args, tuple) and all(isinstance(arg, _IMMUTABLE_ARGS) for arg in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('log.dropped')
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Ротация файла лога по размеру или по истечении интервала, архивы сжимаются gzip"""
+
+    def __init__(self, filename: str, max_bytes: int, interval_seconds: float, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.interval_seconds = interval_seconds
+        self.rollover_at = time.time() + interval_seconds
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source: str, dest: str) -> None:
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.interval_seconds > 0 and time.time() >= self.rollover_at:
+            return os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval_seconds
+
+def set_correlation_id(value: str) -> None:
+    """Устанавливает идентификатор для записей текущей задачи"""
+    correlation_id.set(value)
+
+def setup_logging() -> None:
+    """Направляет все записи через очередь в фоновый поток записи"""
+    global _listener
+    if _listener:
+        return
+
+    formatter = JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(_TEXT_FORMAT)
+
+    file_handler = SizeAndTimeRotatingFileHandler(
+        LOG_FILE,
+        max_bytes=int(LOG_MAX_MB * 1024 * 1024),
+        interval_seconds=LOG_ROTATE_HOURS * 3600,
+        backup_count=LOG_BACKUP_COUNT
+    )
+    console_handler = logging.StreamHandler()
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationFilter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [queue_handler]
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+
+def shutdown_logging() -> None:
+    """Дописывает оставшиеся записи и останавливает поток записи"""
+    global _listener
+    if not _listener:
+        return
+    _listener.stop()
+    _listener = None
@@ -0,0 +1,110 @@
+"""
+Счётчики работы бота, обновляемые по мере событий
+
+Команда /stats строит отчёт по снимку этих счётчиков и не обращается к диску.
+"""
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+class Metrics:
+    """Счётчики событий, текущие значения и этапы обработки в работе"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._counters: Dict[str, int] = defaultdict(int)
+        self._gauges: Dict[str, float] = {}
+        self._in_flight: Dict[str, int] = defaultdict(int)
+        self._stage_seconds: Dict[str, float] = defaultdict(float)
+        # user_id -> момент истечения сессии (time.monotonic)
+        self._sessions: Dict[int, float] = {}
+
+    def inc(self, name: str, value: int = 1) -> None:
+        """Увеличивает счётчик событий"""
+        self._counters[name] += value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        """Устанавливает текущее значение показателя"""
+        self._gauges[name] = value
+
+    def get_gauge(self, name: str, default=None):
+        """Возвращает текущее значение показателя"""
+        return self._gauges.get(name, default)
+
+    @contextmanager
+    def stage(self, name: str, sink: Optional[Dict[str, float]] = None) -> Iterator[None]:
+        """
+        Учитывает этап обработки: количество выполняющихся, успешных и
+        неудачных вызовов и суммарное время
+
+        Args:
+            name: Название этапа
+            sink: Словарь, в который дополнительно прибавляется время этапа
+                (например, время этапов текущей сессии)
+
+        Пример:
+            with metrics.stage('stt', context.user_data['latencies']):
+                transcription = await transcribe(path)
+        """
+        self._in_flight[name] += 1
+        started = time.perf_counter()
+        try:
+            yield
+            self._counters[f'{name}.ok'] += 1
+        except BaseException:
+            self._counters[f'{name}.failed'] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self._in_flight[name] -= 1
+            self._stage_seconds[name] += elapsed
+            if sink is not None:
+                sink[name] = sink.get(name, 0.0) + elapsed
+
+    def in_flight_total(self) -> int:
+        """Количество выполняющихся сейчас этапов обработки"""
+        return sum(self._in_flight.values())
+
+    def session_started(self, user_id: int, duration_seconds: float) -> None:
+        """Отмечает начало сессии пользователя"""
+        if user_id not in self._sessions:
+            self._counters['sessions.started'] += 1
+        self._sessions[user_id] = time.monotonic() + duration_seconds
+
+    def session_ended(self, user_id: int) -> None:
+        """Отмечает завершение сессии пользователя"""
+        self._sessions.pop(user_id, None)
+
+    def active_sessions(self) -> int:
+        """Количество неистёкших сессий (брошенные сессии отбрасываются по таймеру)"""
+        now = time.monotonic()
+        expired = [user_id for user_id, expires_at in self._sessions.items() if expires_at < now]
+        for user_id in expired:
+            del self._sessions[user_id]
+        return len(self._sessions)
+
+    def snapshot(self) -> dict:
+        """Копия всех показателей на текущий момент"""
+        stages = {}
+        for name in set(self._in_flight) | set(self._stage_seconds):
+            ok = self._counters.get(f'{name}.ok', 0)
+            failed = self._counters.get(f'{name}.failed', 0)
+            total = ok + failed
+            stages[name] = {
+                'in_flight': self._in_flight.get(name, 0),
+                'ok': ok,
+                'failed': failed,
+                'avg_seconds': self._stage_seconds.get(name, 0.0) / total if total else 0.0,
+            }
+
+        return {
+            'uptime_seconds': time.time() - self.started_at,
+            'active_sessions': self.active_sessions(),
+            'counters': dict(self._counters),
+            'gauges': dict(self._gauges),
+            'stages': stages,
+        }
+
+# Глобальный экземпляр счётчиков
+metrics = Metrics()
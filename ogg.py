@@ -0,0 +1,272 @@
+"""
+Работа с контейнером OGG на уровне страниц (без перекодирования аудио)
+"""
+import struct
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+# Флаги заголовка страницы
+FLAG_CONTINUED = 0x01
+FLAG_BOS = 0x02
+FLAG_EOS = 0x04
+
+_CAPTURE = b'OggS'
+_HEADER = struct.Struct('<4sBBqIIIB')  # capture, version, flags, granule, serial, seq, crc, segments
+
+def _build_crc_table() -> List[int]:
+    """Таблица CRC-32 OGG (полином 0x04C11DB7, без отражения битов)"""
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+_CRC_TABLE = _build_crc_table()
+
+def ogg_crc(data: bytes) -> int:
+    """Вычисляет контрольную сумму страницы OGG"""
+    crc = 0
+    table = _CRC_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ table[(crc >> 24) ^ byte]
+    return crc
+
+@dataclass
+class OggPage:
+    """Страница OGG"""
+    flags: int
+    granule: int
+    serial: int
+    sequence: int
+    lacing: bytes
+    body: bytes
+
+    @property
+    def completed_packets(self) -> int:
+        """Количество пакетов, заканчивающихся на этой странице"""
+        return sum(1 for value in self.lacing if value < 255)
+
+    def to_bytes(self) -> bytes:
+        """Сериализует страницу с пересчётом CRC"""
+        header = _HEADER.pack(
+            _CAPTURE, 0, self.flags, self.granule,
+            self.serial, self.sequence, 0, len(self.lacing)
+        )
+        page = bytearray(header + self.lacing + self.body)
+        struct.pack_into('<I', page, 22, ogg_crc(page))
+        return bytes(page)
+
+def iter_pages(data: bytes) -> Iterator[OggPage]:
+    """
+    Разбирает поток OGG на страницы
+
+    Raises:
+        ValueError: Если поток повреждён
+    """
+    offset = 0
+    size = len(data)
+    while offset < size:
+        if size - offset < _HEADER.size:
+            raise ValueError("Обрезанный заголовок страницы OGG")
+        capture, version, flags, granule, serial, sequence, _, segments = _HEADER.unpack_from(data, offset)
+        if capture != _CAPTURE or version != 0:
+            raise ValueError("Некорректная страница OGG")
+
+        lacing_start = offset + _HEADER.size
+        body_start = lacing_start + segments
+        lacing = data[lacing_start:body_start]
+        body_end = body_start + sum(lacing)
+        if len(lacing) != segments or body_end > size:
+            raise ValueError("Обрезанная страница OGG")
+
+        yield OggPage(flags, granule, serial, sequence, lacing, data[body_start:body_end])
+        offset = body_end
+
+def iter_packets(pages: List[OggPage]) -> Iterator[Tuple[int, bytes]]:
+    """
+    Собирает пакеты из страниц одного логического потока
+
+    Yields:
+        (индекс страницы, на которой пакет заканчивается; пакет)
+    """
+    pending = bytearray()
+    for index, page in enumerate(pages):
+        offset = 0
+        for value in page.lacing:
+            pending += page.body[offset:offset + value]
+            offset += value
+            if value < 255:
+                yield index, bytes(pending)
+                pending.clear()
+
+def last_granule(data: bytes, serial: Optional[int] = None) -> Optional[int]:
+    """
+    Находит позицию гранулы последней страницы в хвосте потока OGG
+
+    Args:
+        data: Конец файла (достаточно последних нескольких десятков КБ)
+        serial: Серийный номер логического потока (None - любой)
+
+    Returns:
+        Optional[int]: Позиция гранулы или None, если подходящая страница не найдена
+    """
+    offset = data.rfind(_CAPTURE)
+    while offset >= 0:
+        if len(data) - offset >= _HEADER.size:
+            _, version, _, granule, page_serial, _, _, _ = _HEADER.unpack_from(data, offset)
+            if version == 0 and granule != -1 and (serial is None or page_serial == serial):
+                return granule
+        offset = data.rfind(_CAPTURE, 0, offset)
+    return None
+
+# Длительность кадра Opus (в отсчётах 48 кГц) по номеру конфигурации из TOC
+_OPUS_FRAME_SAMPLES = (
+    [480, 960, 1920, 2880] * 3      # SILK: 10, 20, 40, 60 мс
+    + [480, 960] * 2                # Hybrid: 10, 20 мс
+    + [120, 240, 480, 960] * 4      # CELT: 2.5, 5, 10, 20 мс
+)
+
+def opus_packet_samples(packet: bytes) -> int:
+    """Количество отсчётов (48 кГц) в пакете Opus по байту TOC (RFC 6716, 3.1)"""
+    if not packet:
+        return 0
+    toc = packet[0]
+    frame_samples = _OPUS_FRAME_SAMPLES[toc >> 3]
+    code = toc & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frame_samples * frames
+
+def _split_headers(pages: List[OggPage]) -> tuple:
+    """Делит страницы потока Opus на заголовочные (OpusHead, OpusTags) и аудио"""
+    packets = 0
+    for index, page in enumerate(pages):
+        packets += page.completed_packets
+        if packets >= 2:
+            return pages[:index + 1], pages[index + 1:]
+    raise ValueError("В потоке Opus нет заголовков OpusHead/OpusTags")
+
+def _drop_leading_packets(page: OggPage, min_samples: int) -> int:
+    """
+    Удаляет из начала страницы целые пакеты, пока не наберётся min_samples отсчётов
+
+    Returns:
+        int: Количество удалённых отсчётов (48 кГц)
+    """
+    dropped = 0
+    lacing_index = 0
+    body_offset = 0
+    while dropped < min_samples:
+        end = lacing_index
+        length = 0
+        while end < len(page.lacing):
+            length += page.lacing[end]
+            end += 1
+            if page.lacing[end - 1] < 255:
+                break
+        else:
+            # Пакет продолжается на следующей странице - оставляем как есть
+            break
+        dropped += opus_packet_samples(page.body[body_offset:body_offset + length])
+        lacing_index = end
+        body_offset += length
+
+    page.lacing = page.lacing[lacing_index:]
+    page.body = page.body[body_offset:]
+    return dropped
+
+def concat_opus_streams(streams: List[bytes]) -> bytes:
+    """
+    Склеивает несколько файлов OGG/Opus в один логический поток без перекодирования
+
+    Заголовки берутся из первого потока, аудиостраницы остальных потоков
+    дописываются с новым серийным номером, номерами страниц и позициями
+    гранул. Позиции пересчитываются по длительности пакетов, поэтому
+    итоговая длительность равна сумме фрагментов; обрезка тишины в конце
+    сохраняется только у последнего фрагмента.
+
+    Каждый поток начинается с отсчётов разгона кодера (pre-skip из OpusHead,
+    обычно 312), но в одном логическом потоке pre-skip задаётся только один
+    раз - для первого фрагмента. У следующих фрагментов начальные пакеты,
+    покрывающие их pre-skip, отбрасываются целиком (обычно один пакет 20 мс),
+    иначе на каждом стыке слышен щелчок разгона, а длительность завышена.
+
+    Args:
+        streams: Содержимое файлов OGG/Opus в порядке воспроизведения
+
+    Returns:
+        bytes: Единый файл OGG/Opus
+
+    Raises:
+        ValueError: Если потоки повреждены или имеют разные параметры
+    """
+    if not streams:
+        raise ValueError("Нет аудиофрагментов для склейки")
+    if len(streams) == 1:
+        return streams[0]
+
+    output = bytearray()
+    serial: Optional[int] = None
+    opus_head: Optional[bytes] = None
+    sequence = 0
+    granule_base = 0
+
+    for stream_index, stream in enumerate(streams):
+        header_pages, audio_pages = _split_headers(list(iter_pages(stream)))
+        head_packet = next(iter_packets(header_pages))[1]
+        if not head_packet.startswith(b'OpusHead'):
+            raise ValueError("Фрагмент не является потоком Opus")
+
+        if stream_index == 0:
+            serial = header_pages[0].serial
+            opus_head = head_packet
+            for page in header_pages:
+                page.serial = serial
+                page.sequence = sequence
+                page.flags &= ~FLAG_EOS
+                output += page.to_bytes()
+                sequence += 1
+        elif head_packet[9] != opus_head[9] or head_packet[12:16] != opus_head[12:16]:
+            # Количество каналов и частота дискретизации должны совпадать
+            raise ValueError("Параметры фрагментов Opus не совпадают")
+
+        dropped_samples = 0
+        if stream_index > 0 and audio_pages:
+            pre_skip = struct.unpack_from('<H', head_packet, 10)[0]
+            dropped_samples = _drop_leading_packets(audio_pages[0], pre_skip)
+
+        page_samples = [0] * len(audio_pages)
+        for page_index, packet in iter_packets(audio_pages):
+            page_samples[page_index] += opus_packet_samples(packet)
+
+        is_last_stream = stream_index == len(streams) - 1
+        stream_samples = 0
+        for page_index, page in enumerate(audio_pages):
+            is_last_page = page_index == len(audio_pages) - 1
+            stream_samples += page_samples[page_index]
+
+            if is_last_stream and is_last_page:
+                # Сохраняем обрезку конца у последнего фрагмента
+                page.granule = granule_base + page.granule - dropped_samples
+            elif page.completed_packets:
+                page.granule = granule_base + stream_samples
+            else:
+                page.granule = -1
+
+            page.serial = serial
+            page.sequence = sequence
+            page.flags &= ~(FLAG_BOS | FLAG_EOS)
+            if is_last_stream and is_last_page:
+                page.flags |= FLAG_EOS
+            output += page.to_bytes()
+            sequence += 1
+
+        granule_base += stream_samples
+
+    return bytes(output)
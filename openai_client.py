@@ -0,0 +1,30 @@
+"""
+Общий клиент OpenAI для STT, GPT и TTS
+
+Пакет openai импортируется долго, поэтому клиент создаётся при первом
+обращении (или заранее в фоне после запуска бота), а не при импорте модулей.
+"""
+import logging
+import threading
+from typing import TYPE_CHECKING, Optional
+
+from config import OPENAI_API_KEY, OPENAI_TIMEOUT_SECONDS
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+_client: Optional['AsyncOpenAI'] = None
+_lock = threading.Lock()
+
+def get_client() -> 'AsyncOpenAI':
+    """Возвращает общий клиент OpenAI, создавая его при первом вызове"""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                from openai import AsyncOpenAI
+                _client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT_SECONDS)
+                logger.debug("Клиент OpenAI создан")
+    return _client
@@ -0,0 +1,226 @@
+"""
+Единственный писатель файлов в data/
+
+Обработчики не пишут файлы сами, а ставят намерение записи в очередь.
+Фоновая задача собирает намерения пачкой, оставляет для каждого файла
+только последнее содержимое и записывает пачку в отдельном потоке: сначала
+все временные файлы (каждый с fsync - без этого переименование после
+сбоя может оставить пустой файл), затем один проход атомарных переименований
+и один fsync каталога на всю пачку. Цикл событий при этом не блокируется.
+"""
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Содержимое файла: текст, байты или функция, которая построит их в потоке записи.
+# None - удалить файл
+Content = Union[str, bytes, Callable[[], Union[str, bytes]], None]
+
+# Сколько ждать следующих намерений, прежде чем записывать пачку
+_BATCH_WINDOW_SECONDS = 0.05
+
+_STOP = object()
+
+class PersistenceActor:
+    """Очередь записи файлов с объединением и атомарной записью"""
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Содержимое, поставленное в очередь, но ещё не записанное
+        self._pending: Dict[Path, Content] = {}
+
+    def write(self, path: Path, content: Content) -> Optional['asyncio.Future[None]']:
+        """
+        Ставит запись файла в очередь
+
+        Вызов не блокирует; результат можно дождаться через возвращаемый Future.
+        Вне цикла событий файл записывается сразу и возвращается None.
+
+        Args:
+            path: Путь к файлу
+            content: Новое содержимое (или функция, строящая его в потоке записи)
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            errors = self._write_batch({path: content})
+            if path in errors:
+                raise errors[path]
+            return None
+
+        self._ensure_started(loop)
+        future = loop.create_future()
+        self._pending[path] = content
+        self._queue.put_nowait((path, content, future))
+        return future
+
+    def write_logged(self, path: Path, content: Content) -> None:
+        """
+        Ставит запись в очередь без ожидания результата
+
+        Для мест, которым некуда вернуть ошибку: она пишется в лог, а не
+        теряется в «Future exception was never retrieved».
+        """
+        future = self.write(path, content)
+        if future is None:
+            return
+
+        def log_failure(done: 'asyncio.Future[None]') -> None:
+            if not done.cancelled() and done.exception() is not None:
+                logger.error(f"Не удалось записать {path}: {done.exception()}")
+
+        future.add_done_callback(log_failure)
+
+    def delete(self, path: Path) -> Optional['asyncio.Future[None]']:
+        """Ставит удаление файла в очередь"""
+        return self.write(path, None)
+
+    def read_text(self, path: Path) -> Optional[str]:
+        """
+        Читает файл с учётом ещё не записанных изменений
+
+        Вызов блокирующий (чтение с диска или построение отложенного
+        содержимого), поэтому из цикла событий его вызывают через
+        asyncio.to_thread.
+
+        Returns:
+            Optional[str]: Содержимое или None, если файла нет (или он будет удалён)
+        """
+        if path in self._pending:
+            content = self._pending[path]
+            if callable(content):
+                content = content()
+            if isinstance(content, bytes):
+                content = content.decode('utf-8')
+            return content
+
+        if not path.exists():
+            return None
+        return path.read_text(encoding='utf-8')
+
+    async def flush(self) -> None:
+        """Дожидается записи всех поставленных в очередь изменений"""
+        if self._queue is None or self._task is None or self._task.done():
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((None, None, future))
+        await future
+
+    async def stop(self) -> None:
+        """Записывает оставшиеся изменения и останавливает фоновую задачу"""
+        if self._task is None or self._task.done():
+            return
+        self._queue.put_nowait(_STOP)
+        await self._task
+        self._task = None
+
+    def _ensure_started(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        """Основной цикл: собирает пачку намерений и записывает её"""
+        stopping = False
+        while not stopping:
+            items = [await self._queue.get()]
+            await asyncio.sleep(_BATCH_WINDOW_SECONDS)
+            while not self._queue.empty():
+                items.append(self._queue.get_nowait())
+
+            batch: Dict[Path, Content] = {}
+            waiters: List[Tuple[Optional[Path], asyncio.Future]] = []
+            for item in items:
+                if item is _STOP:
+                    stopping = True
+                    continue
+                path, content, future = item
+                if path is not None:
+                    batch[path] = content
+                waiters.append((path, future))
+
+            errors: Dict[Path, Exception] = {}
+            if batch:
+                try:
+                    errors = await asyncio.to_thread(self._write_batch, batch)
+                except Exception as e:
+                    logger.error(f"Ошибка записи данных: {e}")
+                    errors = {path: e for path in batch}
+
+            for path, content in batch.items():
+                # Запись могла быть снова поставлена в очередь, пока шла эта пачка
+                if self._pending.get(path, _STOP) is content:
+                    del self._pending[path]
+
+            for path, future in waiters:
+                if future.done():
+                    continue
+                if path in errors:
+                    future.set_exception(errors[path])
+                else:
+                    future.set_result(None)
+
+    @staticmethod
+    def _write_batch(batch: Dict[Path, Content]) -> Dict[Path, Exception]:
+        """Атомарно записывает файлы пачки (выполняется в потоке записи)"""
+        errors: Dict[Path, Exception] = {}
+        directories = set()
+        replaces: List[Tuple[Path, Path]] = []
+
+        # Сначала данные всех файлов пачки попадают на диск во временные файлы
+        for path, content in batch.items():
+            try:
+                if content is None:
+                    continue
+                data = content() if callable(content) else content
+                if isinstance(data, str):
+                    data = data.encode('utf-8')
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_name(path.name + '.tmp')
+                with open(tmp_path, 'wb') as file:
+                    file.write(data)
+                    file.flush()
+                    os.fsync(file.fileno())
+                replaces.append((tmp_path, path))
+            except Exception as e:
+                logger.error(f"Ошибка записи файла {path}: {e}")
+                errors[path] = e
+
+        # Затем один проход переименований и удалений
+        for path, content in batch.items():
+            if content is not None:
+                continue
+            try:
+                path.unlink(missing_ok=True)
+                directories.add(path.parent)
+            except Exception as e:
+                logger.error(f"Ошибка удаления файла {path}: {e}")
+                errors[path] = e
+        for tmp_path, path in replaces:
+            try:
+                os.replace(tmp_path, path)
+                directories.add(path.parent)
+            except Exception as e:
+                logger.error(f"Ошибка записи файла {path}: {e}")
+                errors[path] = e
+
+        # Один fsync каталога фиксирует все переименования пачки
+        for directory in directories:
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+
+        return errors
+
+# Глобальный экземпляр
+persistence = PersistenceActor()
@@ -0,0 +1,112 @@
+"""
+Отмена начатой обработки голосовых сообщений
+
+Обработка каждого голосового сообщения идёт отдельной задачей. Команды
+/cancel и /start отменяют её на любом этапе, а новое голосовое сообщение -
+на этапах GPT и TTS, когда ответ на старое уже никто не ждёт. Отмена
+доходит до открытых запросов к OpenAI (закрываются HTTP-соединения) и
+освобождает временные файлы через finally обработчика.
+
+Решение об отмене принимается при получении обновления (см. fair_queue.py),
+а не в обработчике: обновления пользователя обрабатываются по одному, и
+/cancel иначе ждал бы окончания той самой обработки, которую отменяет.
+"""
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from telegram import Update
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Команды, отменяющие обработку на любом этапе
+_CANCEL_COMMANDS = ('/cancel', '/start')
+
+# Этапы, на которых обработку отменяет новое голосовое сообщение
+_SUPERSEDE_STAGES = ('gpt', 'tts')
+
+class Pipeline:
+    """Обработка одного голосового сообщения"""
+    __slots__ = ('task', 'stage', 'tts_chars', 'cancel_reason')
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.stage = 'download'
+        self.tts_chars = 0
+        self.cancel_reason: Optional[str] = None
+
+class PipelineRegistry:
+    """Обработки голосовых сообщений, выполняющиеся сейчас, по пользователям"""
+
+    def __init__(self):
+        self._pipelines: Dict[int, Pipeline] = {}
+
+    @contextmanager
+    def track(self, user_id: int, task: asyncio.Task) -> Iterator[Pipeline]:
+        """Регистрирует задачу обработки на время её выполнения"""
+        pipeline = self._pipelines[user_id] = Pipeline(task)
+        try:
+            yield pipeline
+        finally:
+            if self._pipelines.get(user_id) is pipeline:
+                del self._pipelines[user_id]
+
+    def set_stage(self, user_id: int, stage: str, tts_chars: int = 0) -> None:
+        """Отмечает этап обработки (для решения об отмене и оценки сэкономленного)"""
+        pipeline = self._pipelines.get(user_id)
+        if pipeline:
+            pipeline.stage = stage
+            pipeline.tts_chars = tts_chars
+
+    def cancel(self, user_id: int, reason: str) -> bool:
+        """
+        Отменяет обработку пользователя и учитывает сэкономленные запросы
+
+        Сэкономленное - оценка: запрос, отменённый на середине, может быть
+        частично оплачен.
+
+        Returns:
+            bool: True, если обработка была отменена
+        """
+        pipeline = self._pipelines.get(user_id)
+        if not pipeline or pipeline.task.done() or pipeline.cancel_reason:
+            return False
+
+        pipeline.cancel_reason = reason
+        pipeline.task.cancel()
+
+        metrics.inc('cancel.total')
+        metrics.inc(f'cancel.{reason}')
+        if pipeline.stage in ('download', 'stt', 'gpt'):
+            metrics.inc('cancel.saved_gpt_calls')
+        if pipeline.stage != 'send':
+            metrics.inc('cancel.saved_tts_calls')
+            metrics.inc('cancel.saved_tts_chars', pipeline.tts_chars)
+        logger.info(f"[CANCEL] Обработка сообщения пользователя {user_id} отменена на этапе {pipeline.stage} ({reason})")
+        return True
+
+    def supersede(self, update: Update, heavy: bool) -> None:
+        """
+        Отменяет обработку, если новое обновление делает её ненужной
+
+        Args:
+            update: Только что полученное обновление
+            heavy: Обновление - голосовое сообщение, которое будет обработано
+        """
+        user_id = update.effective_user.id
+        pipeline = self._pipelines.get(user_id)
+        if not pipeline:
+            return
+
+        text = update.message.text if update.message and update.message.text else ''
+        command = text.split(maxsplit=1)[0].split('@')[0] if text.startswith('/') else ''
+        if command in _CANCEL_COMMANDS:
+            self.cancel(user_id, 'command')
+        elif heavy and pipeline.stage in _SUPERSEDE_STAGES:
+            self.cancel(user_id, 'new_voice')
+
+# Глобальный экземпляр
+pipeline_registry = PipelineRegistry()
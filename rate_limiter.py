@@ -0,0 +1,214 @@
+"""
+Ограничение исходящих запросов к Bot API с учётом лимитов Telegram и приоритетов
+
+Все запросы с chat_id проходят через общий «ведро токенов» (лимит бота)
+и ведро конкретного чата. Когда общих токенов не хватает, первыми их
+получают ответы пользователям, затем индикаторы набора, копии для
+администраторов и фоновые уведомления. Ошибка RetryAfter от Telegram
+приостанавливает отправку только в тот чат, к которому она относится.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+from enum import IntEnum
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from config import (
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST,
+    TELEGRAM_GROUP_RATE_PER_MINUTE, TELEGRAM_MAX_RETRIES
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ведра чатов, которые давно не использовались, удаляются при превышении этого числа
+_MAX_CHAT_BUCKETS = 1000
+
+class Priority(IntEnum):
+    """Приоритет исходящего запроса (меньше - важнее)"""
+    USER = 0  # ответы пользователю
+    CHAT_ACTION = 1  # «записывает голосовое», «печатает»
+    ADMIN = 2  # копии сообщений для администраторов
+    BACKGROUND = 3  # уведомления планировщика
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def try_take(self) -> float:
+        """Забирает токен; возвращает 0 или сколько секунд ждать до следующей попытки"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def give_back(self) -> None:
+        """Возвращает неиспользованный токен"""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def block(self, seconds: float) -> None:
+        """Запрещает отправку на seconds секунд (RetryAfter)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        """Ведро полное и не заблокировано - его можно удалить"""
+        now = time.monotonic()
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+def _seconds(value: Union[int, float, timedelta]) -> float:
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """
+    Ограничитель запросов для Application.builder().rate_limiter(...)
+
+    Приоритет передаётся через rate_limit_args методов бота, например
+    ``await context.bot.send_message(..., rate_limit_args=Priority.ADMIN)``.
+    Без него sendChatAction получает Priority.CHAT_ACTION, остальное - Priority.USER.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = TELEGRAM_GLOBAL_RATE,
+        chat_rate: float = TELEGRAM_CHAT_RATE,
+        chat_burst: float = TELEGRAM_CHAT_BURST,
+        group_rate_per_minute: float = TELEGRAM_GROUP_RATE_PER_MINUTE,
+        max_retries: int = TELEGRAM_MAX_RETRIES
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.max_retries = max_retries
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        # Очередь ожидающих общий токен: (приоритет, порядковый номер, future)
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    async def initialize(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for _, _, future in self._waiters:
+            future.cancel()
+        self._waiters.clear()
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _MAX_CHAT_BUCKETS:
+                for key in [key for key, value in self._chats.items() if value.idle]:
+                    del self._chats[key]
+            # Группы и каналы (отрицательный id или @username) - 20 сообщений в минуту
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = TokenBucket(rate, 1 if is_group else self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire_global(self, priority: int) -> None:
+        """Ждёт общий токен; при нехватке токены выдаются по приоритету"""
+        if not self._waiters and self._global.try_take() == 0:
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self._wakeup.set()
+        await future
+
+    async def _dispatch_loop(self) -> None:
+        """Раздаёт общие токены ожидающим запросам в порядке приоритета"""
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            wait = self._global.try_take()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # Запрос отменён, пока ждал
+                self._global.give_back()
+            else:
+                future.set_result(None)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], None]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], None]:
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            # getUpdates, getFile и т.п. не ограничиваются
+            return await callback(*args, **kwargs)
+
+        if rate_limit_args is not None:
+            priority = int(rate_limit_args)
+        elif endpoint == 'sendChatAction':
+            priority = Priority.CHAT_ACTION
+        else:
+            priority = Priority.USER
+
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            # Индикатор набора не расходует лимит сообщений чата, но ждёт снятия RetryAfter
+            while True:
+                wait = bucket.try_take() if endpoint != 'sendChatAction' else max(0.0, bucket.blocked_until - time.monotonic())
+                if wait == 0:
+                    break
+                await asyncio.sleep(wait)
+
+            await self._acquire_global(priority)
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = _seconds(e.retry_after)
+                metrics.inc('telegram.retry_after')
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(
+                    f"Telegram RetryAfter {delay:.0f} с для чата {chat_id} ({endpoint}), "
+                    f"повтор {attempt + 1}/{self.max_retries}"
+                )
+                bucket.block(delay)
+
+        return None  # недостижимо: последняя попытка либо вернула результат, либо подняла исключение
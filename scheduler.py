@@ -1,122 +1,376 @@
 """
 Модуль планировщика задач для автоматического выполнения операций
+
+Задачи запускаются по интервалу или по расписанию в формате cron
+("минута час день месяц день_недели"). Интервалы отсчитываются по
+монотонным часам, расписание cron сверяется с местным временем на каждом
+такте, поэтому переводы часов не сбивают планировщик. Время последнего
+запуска сохраняется на диск, пропущенные за время простоя запуски
+выполняются один раз при старте.
 """
 import asyncio
+import json
 import logging
-from datetime import datetime, time
-from typing import Optional
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from config import (
+    DATA_DIR, TEMP_JANITOR_INTERVAL_SECONDS, ANALYTICS_FLUSH_SECONDS,
+    SCHEDULER_OFF_PEAK_MAX_DEFER_MINUTES, ADMIN_MIRROR_MODE
+)
+from persistence import persistence
 
 logger = logging.getLogger(__name__)
 
-class DailyScheduler:
-    """Планировщик для выполнения задач в определенное время каждый день"""
-    
-    def __init__(self):
-        self._running = False
+# Файл с временем последнего запуска задач
+SCHEDULER_STATE_FILE = DATA_DIR / 'scheduler.json'
+
+# Максимальная пауза между проверками расписания
+_TICK_SECONDS = 30
+# На сколько откладывается фоновая задача, пока идёт обработка сообщений
+_OFF_PEAK_RETRY_SECONDS = 30
+
+class CronSchedule:
+    """Расписание в формате cron: минута, час, день месяца, месяц, день недели"""
+
+    _RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Расписание cron должно содержать 5 полей: {expression!r}")
+
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse_field(value, low, high) for value, (low, high) in zip(fields, self._RANGES)
+        )
+        # 7 и 0 - воскресенье
+        self.weekdays = {day % 7 for day in weekdays}
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse_field(value: str, low: int, high: int) -> Set[int]:
+        """Разбирает поле: *, числа, списки через запятую, диапазоны и шаг (*/15, 1-5/2)"""
+        result: Set[int] = set()
+        for part in value.split(','):
+            step = 1
+            if '/' in part:
+                part, step_text = part.split('/', 1)
+                step = int(step_text)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(x) for x in part.split('-', 1))
+            else:
+                start = end = int(part)
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Некорректное поле cron: {value!r}")
+            result.update(range(start, end + 1, step))
+        return result
+
+    def _day_matches(self, day: datetime) -> bool:
+        weekday = (day.weekday() + 1) % 7  # в cron 0 - воскресенье
+        if self._any_day and self._any_weekday:
+            return True
+        if self._any_day:
+            return weekday in self.weekdays
+        if self._any_weekday:
+            return day.day in self.days
+        # Если заданы оба поля, достаточно совпадения любого из них (как в cron)
+        return day.day in self.days or weekday in self.weekdays
+
+    def next_after(self, moment: datetime) -> datetime:
+        """Ближайший момент по расписанию строго после moment"""
+        start = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        # Переход на следующий день через timedelta корректен и в конце месяца
+        for _ in range(366 * 5):
+            if day.month in self.months and self._day_matches(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days=1)
+        raise ValueError(f"Расписание cron никогда не срабатывает: {self.expression!r}")
+
+@dataclass
+class Job:
+    """Задача планировщика"""
+    name: str
+    func: Callable[[], Awaitable[None]]
+    interval: Optional[float] = None  # секунды
+    cron: Optional[CronSchedule] = None
+    jitter: float = 0.0  # случайная задержка запуска, секунды
+    catch_up: bool = False  # выполнить пропущенный за время простоя запуск
+    off_peak: bool = False  # откладывать, пока идёт обработка сообщений
+    last_run: Optional[float] = None  # unix time
+    due_monotonic: Optional[float] = None  # для задач с интервалом
+    due_wall: Optional[float] = None  # для задач cron (unix time)
+    deferred_since: Optional[float] = None
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def schedule_next(self) -> None:
+        """Вычисляет следующий запуск от текущего момента"""
+        delay = random.uniform(0, self.jitter) if self.jitter else 0.0
+        if self.interval is not None:
+            self.due_monotonic = time.monotonic() + self.interval + delay
+        else:
+            self.due_wall = self.cron.next_after(datetime.now()).timestamp() + delay
+
+    def is_due(self) -> bool:
+        if self.interval is not None:
+            return time.monotonic() >= self.due_monotonic
+        return time.time() >= self.due_wall
+
+    def seconds_until_due(self) -> float:
+        if self.interval is not None:
+            return self.due_monotonic - time.monotonic()
+        return self.due_wall - time.time()
+
+class JobScheduler:
+    """Планировщик периодических задач"""
+
+    def __init__(self, state_file: Path):
+        self.state_file = state_file
+        self._jobs: Dict[str, Job] = {}
         self._task: Optional[asyncio.Task] = None
-    
+
+    def add_job(
+        self,
+        name: str,
+        func: Callable[[], Awaitable[None]],
+        *,
+        interval: Optional[float] = None,
+        cron: Optional[str] = None,
+        jitter: float = 0.0,
+        catch_up: bool = False,
+        off_peak: bool = False
+    ) -> None:
+        """
+        Регистрирует задачу
+
+        Args:
+            name: Уникальное имя (ключ в файле состояния)
+            func: Асинхронная функция без аргументов
+            interval: Период запуска в секундах
+            cron: Расписание cron, например "0 0 * * *" (каждый день в 00:00)
+            jitter: Случайная задержка до jitter секунд, чтобы задачи не совпадали
+            catch_up: Выполнить при старте запуск, пропущенный за время простоя
+            off_peak: Откладывать, пока бот обрабатывает сообщения
+        """
+        if (interval is None) == (cron is None):
+            raise ValueError("Укажите для задачи либо interval, либо cron")
+        if name in self._jobs:
+            raise ValueError(f"Задача {name} уже зарегистрирована")
+
+        self._jobs[name] = Job(
+            name=name,
+            func=func,
+            interval=interval,
+            cron=CronSchedule(cron) if cron else None,
+            jitter=jitter,
+            catch_up=catch_up,
+            off_peak=off_peak
+        )
+
     async def start(self):
         """Запускает планировщик"""
-        if self._running:
+        if self._task and not self._task.done():
             logger.warning("Планировщик уже запущен")
             return
-        
-        self._running = True
+
+        state = await asyncio.to_thread(self._load_state)
+        now = time.time()
+        for job in self._jobs.values():
+            job.last_run = state.get(job.name)
+            job.schedule_next()
+            if job.last_run is None:
+                continue
+            # Догоняем пропущенный запуск (один раз, даже если пропущено несколько)
+            if job.interval is not None:
+                remaining = job.last_run + job.interval - now
+                if remaining > 0 or job.catch_up:
+                    job.due_monotonic = time.monotonic() + max(0.0, remaining)
+            elif job.catch_up and job.cron.next_after(datetime.fromtimestamp(job.last_run)).timestamp() <= now:
+                logger.info(f"Задача {job.name} пропустила запуск, выполняем сейчас")
+                job.due_wall = now
+
         self._task = asyncio.create_task(self._scheduler_loop())
-        logger.info("Планировщик задач запущен")
-    
+        logger.info(f"Планировщик задач запущен: {', '.join(self._jobs)}")
+
     async def stop(self):
-        """Останавливает планировщик"""
-        if not self._running:
+        """Останавливает планировщик и дожидается завершения выполняемых задач"""
+        if not self._task:
             return
-        
-        self._running = False
-        if self._task:
-            self._task.cancel()
-            try:
-                await self._task
-            except asyncio.CancelledError:
-                pass
-        
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        running = [job.task for job in self._jobs.values() if job.running]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
         logger.info("Планировщик задач остановлен")
-    
+
+    def _ready(self, job: Job) -> bool:
+        """Можно ли запускать задачу сейчас"""
+        if job.running:
+            logger.warning(f"Задача {job.name} ещё выполняется, запуск пропущен")
+            job.schedule_next()
+            return False
+
+        if job.off_peak:
+            from metrics import metrics
+            busy = metrics.in_flight_total()
+            now = time.monotonic()
+            if job.deferred_since is None:
+                job.deferred_since = now
+            if busy and now - job.deferred_since < SCHEDULER_OFF_PEAK_MAX_DEFER_MINUTES * 60:
+                logger.debug("Задача %s отложена: в обработке %s этапов", job.name, busy)
+                if job.interval is not None:
+                    job.due_monotonic = now + _OFF_PEAK_RETRY_SECONDS
+                else:
+                    job.due_wall = time.time() + _OFF_PEAK_RETRY_SECONDS
+                return False
+            job.deferred_since = None
+
+        return True
+
     async def _scheduler_loop(self):
         """Основной цикл планировщика"""
+        while True:
+            for job in self._jobs.values():
+                if job.is_due() and self._ready(job):
+                    job.schedule_next()
+                    job.task = asyncio.create_task(self._run_job(job))
+
+            wait = min((job.seconds_until_due() for job in self._jobs.values()), default=_TICK_SECONDS)
+            await asyncio.sleep(min(max(wait, 0.1), _TICK_SECONDS))
+
+    async def _run_job(self, job: Job):
+        """Выполняет задачу и сохраняет время запуска"""
+        started = time.monotonic()
         try:
-            while self._running:
-                # Вычисляем время до следующего выполнения (00:00)
-                now = datetime.now()
-                target_time = time(0, 0)  # 00:00
-                
-                # Если сейчас уже после 00:00, планируем на следующий день
-                if now.time() > target_time:
-                    next_run = now.replace(hour=0, minute=0, second=0, microsecond=0)
-                    next_run = next_run.replace(day=next_run.day + 1)
-                else:
-                    next_run = now.replace(hour=0, minute=0, second=0, microsecond=0)
-                
-                # Вычисляем время ожидания
-                wait_seconds = (next_run - now).total_seconds()
-                
-                logger.info(f"Следующая очистка блокировок запланирована на: {next_run.strftime('%Y-%m-%d %H:%M:%S')}")
-                logger.info(f"Ожидание: {wait_seconds:.0f} секунд ({wait_seconds/3600:.1f} часов)")
-                
-                # Ждем до назначенного времени
-                await asyncio.sleep(wait_seconds)
-                
-                if self._running:
-                    await self._execute_daily_cleanup()
-                
+            await job.func()
+            logger.info(f"Задача {job.name} выполнена за {time.monotonic() - started:.2f} с")
         except asyncio.CancelledError:
-            logger.info("Планировщик задач отменен")
+            raise
         except Exception as e:
-            logger.error(f"Ошибка в планировщике задач: {e}")
-    
-    async def _execute_daily_cleanup(self):
-        """Выполняет ежедневную очистку блокировок в 00:00"""
+            logger.error(f"Ошибка при выполнении задачи {job.name}: {e}")
+        finally:
+            job.last_run = time.time()
+
         try:
-            logger.info("🕛 Выполняется ежедневная очистка заблокированных пользователей (00:00)")
-            
-            from user_limits import user_limit_manager
-            
-            # Получаем количество заблокированных пользователей до очистки
-            blocked_count_before = user_limit_manager.get_blocked_users_count()
-            
-            # Выполняем полную очистку
-            cleared_count = user_limit_manager.clear_all_blocks()
-            
-            # Логируем результат
-            if cleared_count > 0:
-                logger.info(f"✅ Ежедневная очистка завершена: разблокировано {cleared_count} пользователей")
-                
-                # Отправляем уведомление администраторам
-                await self._notify_admins_about_cleanup(cleared_count)
-            else:
-                logger.info("ℹ️ Ежедневная очистка завершена: заблокированных пользователей не было")
-            
+            state = {name: j.last_run for name, j in self._jobs.items() if j.last_run}
+            await persistence.write(self.state_file, json.dumps(state))
         except Exception as e:
-            logger.error(f"Ошибка при выполнении ежедневной очистки: {e}")
-    
-    async def _notify_admins_about_cleanup(self, cleared_count: int):
-        """Отправляет уведомление администраторам о выполненной очистке"""
+            logger.error(f"Ошибка сохранения состояния планировщика: {e}")
+
+    def _load_state(self) -> Dict[str, float]:
         try:
-            from utils import send_to_admins_text
-            
-            message = (
-                f"🕛 **Ежедневная очистка блокировок (00:00)**\n\n"
-                f"✅ Разблокировано пользователей: **{cleared_count}**\n"
-                f"📅 Дата: {datetime.now().strftime('%d.%m.%Y')}\n\n"
-                f"Все пользователи снова могут пользоваться ботом."
-            )
-            
-            # Отправляем уведомление (если функция существует)
-            try:
-                await send_to_admins_text(message)
-            except Exception as e:
-                logger.warning(f"Не удалось отправить уведомление администраторам: {e}")
-            
+            if self.state_file.exists():
+                return json.loads(self.state_file.read_text(encoding='utf-8'))
         except Exception as e:
-            logger.error(f"Ошибка отправки уведомления администраторам: {e}")
+            logger.error(f"Ошибка чтения состояния планировщика: {e}")
+        return {}
+
+    def jobs_info(self) -> List[dict]:
+        """Сведения о задачах: имя, последний и следующий запуск (unix time)"""
+        return [
+            {
+                'name': job.name,
+                'last_run': job.last_run,
+                'next_run': None if job.due_wall is None and job.due_monotonic is None else time.time() + job.seconds_until_due(),
+                'running': job.running,
+            }
+            for job in self._jobs.values()
+        ]
+
+# --- Задачи обслуживания ---
+
+async def clear_blocks_job():
+    """Выполняет ежедневную очистку блокировок в 00:00"""
+    logger.info("🕛 Выполняется ежедневная очистка заблокированных пользователей (00:00)")
+
+    from user_limits import user_limit_manager
+
+    # Выполняем полную очистку
+    cleared_count = await user_limit_manager.clear_all_blocks()
+
+    # Логируем результат
+    if cleared_count > 0:
+        logger.info(f"✅ Ежедневная очистка завершена: разблокировано {cleared_count} пользователей")
+
+        # Отправляем уведомление администраторам
+        await _notify_admins_about_cleanup(cleared_count)
+    else:
+        logger.info("ℹ️ Ежедневная очистка завершена: заблокированных пользователей не было")
+
+async def _notify_admins_about_cleanup(cleared_count: int):
+    """Отправляет уведомление администраторам о выполненной очистке"""
+    try:
+        from utils import send_to_admins_text
+
+        message = (
+            f"🕛 **Ежедневная очистка блокировок (00:00)**\n\n"
+            f"✅ Разблокировано пользователей: **{cleared_count}**\n"
+            f"📅 Дата: {datetime.now().strftime('%d.%m.%Y')}\n\n"
+            f"Все пользователи снова могут пользоваться ботом."
+        )
+
+        await send_to_admins_text(message)
+
+    except Exception as e:
+        logger.warning(f"Не удалось отправить уведомление администраторам: {e}")
+
+async def temp_cleanup_job():
+    """Удаляет забытые временные файлы"""
+    from temp_files import temp_file_manager
+    await asyncio.to_thread(temp_file_manager.sweep)
+
+async def transcript_cache_job():
+    """Удаляет просроченные транскрипты и сохраняет кэш"""
+    from transcript_cache import transcript_cache
+    removed = transcript_cache.evict_expired()
+    if removed:
+        logger.info(f"Из кэша транскриптов удалено {removed} просроченных записей")
+    await transcript_cache.save()
+
+async def analytics_flush_job():
+    """Записывает накопленную статистику сессий, в том числе брошенных"""
+    from analytics import analytics_store
+    analytics_store.expire_idle()
+    await analytics_store.flush()
+
+async def admin_digest_job():
+    """Отправляет сводки для администраторов по таймауту или окну времени"""
+    from admin_digest import admin_digest
+    await admin_digest.flush_due()
+
+def register_maintenance_jobs(job_scheduler: 'JobScheduler') -> None:
+    """Регистрирует стандартные задачи обслуживания"""
+    job_scheduler.add_job('clear_blocks', clear_blocks_job, cron='0 0 * * *', catch_up=True)
+    job_scheduler.add_job('temp_cleanup', temp_cleanup_job, interval=TEMP_JANITOR_INTERVAL_SECONDS, jitter=30, off_peak=True)
+    job_scheduler.add_job('transcript_cache', transcript_cache_job, interval=600, jitter=60, off_peak=True)
+    job_scheduler.add_job('analytics_flush', analytics_flush_job, interval=ANALYTICS_FLUSH_SECONDS, jitter=5)
+    if ADMIN_MIRROR_MODE in ('session', 'window'):
+        job_scheduler.add_job('admin_digest', admin_digest_job, interval=60, jitter=5)
 
 # Глобальный экземпляр планировщика
-daily_scheduler = DailyScheduler()
\ No newline at end of file
+scheduler = JobScheduler(SCHEDULER_STATE_FILE)
+register_maintenance_jobs(scheduler)
@@ -0,0 +1,69 @@
+"""
+Замеры времени запуска бота
+
+`python bot.py --profile-startup` выводит в лог время импорта каждого модуля
+и каждого этапа инициализации. Время от запуска процесса до первого
+обновления замеряется всегда и показывается в /stats.
+"""
+import importlib
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Момент импорта модуля - бот импортирует его первым из своих модулей
+_STARTED = time.perf_counter()
+
+class StartupProfile:
+    """Замеры импорта, этапов инициализации и времени до первого обновления"""
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.timings: List[Tuple[str, float]] = []
+        self.first_update_seconds = None
+
+    def profile_imports(self, modules: List[str]) -> None:
+        """
+        Импортирует модули по очереди и замеряет каждый (только в режиме профилирования)
+
+        Время модуля включает его ещё не загруженные зависимости.
+        """
+        if not self.enabled:
+            return
+        for name in modules:
+            started = time.perf_counter()
+            importlib.import_module(name)
+            self.timings.append((f"import {name}", time.perf_counter() - started))
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Замеряет этап инициализации"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.perf_counter() - started))
+
+    def update_received(self) -> None:
+        """Отмечает обновление; первое фиксирует время от запуска"""
+        if self.first_update_seconds is not None:
+            return
+        self.first_update_seconds = time.perf_counter() - _STARTED
+
+        from metrics import metrics
+        metrics.set_gauge('startup.first_update_seconds', round(self.first_update_seconds, 2))
+        logger.info(f"Первое обновление получено через {self.first_update_seconds:.2f} с после запуска")
+
+    def report(self) -> None:
+        """Выводит замеры в лог (только в режиме профилирования)"""
+        if not self.enabled:
+            return
+        lines = [f"{seconds * 1000:8.1f} мс  {name}" for name, seconds in self.timings]
+        lines.append(f"{(time.perf_counter() - _STARTED) * 1000:8.1f} мс  всего до начала опроса")
+        logger.info("Профиль запуска:\n" + "\n".join(lines))
+
+# Глобальный экземпляр
+startup_profile = StartupProfile(enabled='--profile-startup' in sys.argv)
@@ -2,109 +2,442 @@
 Модуль для преобразования речи в текст с использованием OpenAI Whisper
 """
 import asyncio
+import io
 import logging
+import re
+import time
+import wave
+from dataclasses import dataclass
 from pathlib import Path
-from openai import AsyncOpenAI
-from pydub import AudioSegment
-from pydub.exceptions import CouldntDecodeError
+from typing import List, Tuple
+import numpy as np
 
-from config import OPENAI_API_KEY
+from config import (
+    MAX_VOICE_DURATION_SECONDS,
+    VAD_ENABLED, VAD_MAX_PAUSE_MS, VAD_MARGIN_DB,
+    STT_CHUNK_SECONDS, STT_CHUNK_OVERLAP_SECONDS, STT_MAX_CONCURRENCY,
+    STT_SEGMENT_FILTER, STT_NO_SPEECH_PROB, STT_MIN_AVG_LOGPROB
+)
 from utils import create_temp_file, cleanup_temp_file
+from temp_files import temp_file_manager
+from audio_probe import probe_audio
+from openai_client import get_client
+from deadline import request_timeout
+from hedging import hedger
+from metrics import metrics
 
 logger = logging.getLogger(__name__)
 
-# Инициализируем клиент OpenAI
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Whisper принимает WAV 16kHz моно; лимит размера одного файла - 25MB
+_SAMPLE_RATE = 16000
+_WHISPER_MAX_BYTES = 25 * 1024 * 1024
 
-async def convert_to_wav(input_path: Path, max_duration_minutes: int = 7) -> Path:
+class NoSpeechError(ValueError):
+    """В записи не найдено речи (тишина или шум)"""
+
+@dataclass
+class Transcription:
+    """Результат распознавания голосового сообщения"""
+    text: str
+    original_seconds: float  # длительность исходной записи
+    speech_seconds: float  # длительность после удаления тишины (оплачивается в Whisper)
+
+    @property
+    def saved_seconds(self) -> float:
+        """Сколько секунд тишины не было отправлено в Whisper"""
+        return max(0.0, self.original_seconds - self.speech_seconds)
+
+# Параметры детектора речи (VAD)
+_VAD_FRAME_MS = 30
+_VAD_MIN_SPEECH_MS = 90  # более короткие всплески считаем щелчками
+_VAD_HANGOVER_MS = 240  # запас вокруг речи, чтобы не обрезать начала и концы слов
+_VAD_ABSOLUTE_FLOOR_DB = -50.0  # тише этого уровня (dBFS) речи нет
+_VAD_THRESHOLD_CEILING_DB = -35.0  # громче этого уровня всегда речь (запись без пауз не режем)
+
+def frame_energy_db(samples: np.ndarray, sample_rate: int) -> np.ndarray:
+    """Энергия (dBFS) кадров длиной _VAD_FRAME_MS"""
+    frame_len = sample_rate * _VAD_FRAME_MS // 1000
+    frame_count = len(samples) // frame_len
+    frames = samples[:frame_count * frame_len].astype(np.float32).reshape(frame_count, frame_len) / 32768.0
+    return 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+
+def detect_speech(samples: np.ndarray, sample_rate: int) -> np.ndarray:
     """
-    Конвертирует аудиофайл в WAV формат 16kHz
+    Находит кадры с речью по энергии сигнала
+    
+    Порог считается относительно уровня шума записи (10-й перцентиль энергии
+    кадров) и ограничен снизу порогом тишины, а сверху - уровнем, который
+    заведомо является речью.
     
     Args:
-        input_path: Путь к исходному файлу
-        max_duration_minutes: Максимальная длительность в минутах
+        samples: Моно-отсчёты int16
+        sample_rate: Частота дискретизации
         
     Returns:
-        Path: Путь к сконвертированному WAV файлу
+        np.ndarray: Булева маска речи по кадрам длиной _VAD_FRAME_MS
+    """
+    energy_db = frame_energy_db(samples, sample_rate)
+    if len(energy_db) == 0:
+        return np.zeros(0, dtype=bool)
+    
+    noise_floor = np.percentile(energy_db, 10)
+    threshold = min(max(noise_floor + VAD_MARGIN_DB, _VAD_ABSOLUTE_FLOOR_DB), _VAD_THRESHOLD_CEILING_DB)
+    speech = energy_db > threshold
+    
+    # Убираем короткие всплески (щелчки, стуки)
+    edges = np.diff(np.concatenate(([0], speech.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    min_frames = max(1, _VAD_MIN_SPEECH_MS // _VAD_FRAME_MS)
+    for start, end in zip(starts, ends):
+        if end - start < min_frames:
+            speech[start:end] = False
+    
+    # Расширяем речевые участки на запас с каждой стороны
+    hangover = _VAD_HANGOVER_MS // _VAD_FRAME_MS
+    if hangover and speech.any():
+        window = np.ones(2 * hangover + 1, dtype=np.int32)
+        speech = np.convolve(speech.astype(np.int32), window, mode='same') > 0
+    
+    return speech
+
+def trim_silence(samples: np.ndarray, sample_rate: int, max_pause_ms: int = VAD_MAX_PAUSE_MS) -> np.ndarray:
+    """
+    Обрезает тишину в начале и в конце и сокращает длинные паузы внутри записи
+    
+    Args:
+        samples: Моно-отсчёты int16
+        sample_rate: Частота дискретизации
+        max_pause_ms: Максимальная длительность паузы внутри записи
+        
+    Запись отбрасывается как тишина, только если даже самый громкий кадр тише
+    порога тишины. Если адаптивный порог не нашёл речь в записи, которая громче
+    этого порога (тихая речь без пауз, речь чуть громче шума), запись
+    возвращается целиком - решать, есть ли в ней слова, будет Whisper.
+    
+    Returns:
+        np.ndarray: Отсчёты без лишней тишины
         
     Raises:
-        ValueError: Если файл слишком длинный или поврежден
+        NoSpeechError: Если в записи нет речи
     """
-    output_path = create_temp_file('.wav')
+    speech = detect_speech(samples, sample_rate)
+    if not speech.any():
+        energy_db = frame_energy_db(samples, sample_rate)
+        if len(energy_db) == 0 or energy_db.max() < _VAD_ABSOLUTE_FLOOR_DB:
+            raise NoSpeechError("В записи не слышно речи")
+        logger.info("VAD не нашёл речь выше адаптивного порога, запись отправляется целиком")
+        return samples
+    
+    frame_len = sample_rate * _VAD_FRAME_MS // 1000
+    max_pause_frames = max_pause_ms // _VAD_FRAME_MS
+    
+    edges = np.diff(np.concatenate(([0], speech.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    
+    # Паузы между речевыми участками сжимаем до max_pause_frames
+    keep = np.zeros_like(speech)
+    for start, end in zip(starts, ends):
+        keep[start:end] = True
+    for gap_start, gap_end in zip(ends[:-1], starts[1:]):
+        if gap_end - gap_start <= max_pause_frames:
+            keep[gap_start:gap_end] = True
+        else:
+            half = max_pause_frames // 2
+            keep[gap_start:gap_start + half] = True
+            keep[gap_end - (max_pause_frames - half):gap_end] = True
+    
+    # Хвост короче кадра относится к последнему кадру
+    sample_mask = np.repeat(keep, frame_len)
+    if len(samples) > len(sample_mask):
+        sample_mask = np.concatenate((sample_mask, np.full(len(samples) - len(sample_mask), keep[-1])))
+    
+    return samples[sample_mask]
+
+def plan_chunks(samples: np.ndarray, sample_rate: int, chunk_seconds: float, overlap_seconds: float) -> List[Tuple[int, int]]:
+    """
+    Делит запись на перекрывающиеся фрагменты с разрезами в самых тихих местах
+    
+    Разрез ищется в последних 30% каждого фрагмента по минимуму энергии кадра,
+    поэтому фрагмент не бывает длиннее chunk_seconds (плюс перекрытие).
+    
+    Args:
+        samples: Моно-отсчёты int16
+        sample_rate: Частота дискретизации
+        chunk_seconds: Максимальная длительность фрагмента
+        overlap_seconds: Перекрытие с предыдущим фрагментом
+        
+    Returns:
+        List[Tuple[int, int]]: Границы фрагментов в отсчётах
+    """
+    total = len(samples)
+    chunk_len = int(chunk_seconds * sample_rate)
+    if total <= chunk_len:
+        return [(0, total)]
+    
+    frame_len = sample_rate * _VAD_FRAME_MS // 1000
+    energy_db = frame_energy_db(samples, sample_rate)
+    overlap = int(overlap_seconds * sample_rate)
+    
+    ranges = []
+    start = 0
+    while total - start > chunk_len:
+        window_start = (start + int(chunk_len * 0.7)) // frame_len
+        window_end = (start + chunk_len) // frame_len
+        quietest = window_start + int(np.argmin(energy_db[window_start:window_end]))
+        cut = (quietest * frame_len) + frame_len // 2
+        ranges.append((max(0, start - overlap), cut))
+        start = cut
+    ranges.append((max(0, start - overlap), total))
+    
+    return ranges
+
+_WORD_NORMALIZE = re.compile(r'[^\w]+')
+
+def stitch_transcripts(texts: List[str], max_overlap_words: int = 12) -> str:
+    """
+    Склеивает тексты фрагментов, убирая слова, повторённые из-за перекрытия
+    
+    Ищется самое длинное совпадение конца уже собранного текста с началом
+    следующего фрагмента (без учёта регистра и пунктуации).
+    
+    Args:
+        texts: Тексты фрагментов по порядку
+        max_overlap_words: Максимальная длина повтора в словах
+        
+    Returns:
+        str: Общий текст
+    """
+    words: List[str] = []
+    keys: List[str] = []
+    
+    for text in texts:
+        chunk_words = text.split()
+        if not chunk_words:
+            continue
+        chunk_keys = [_WORD_NORMALIZE.sub('', word.lower()) for word in chunk_words]
+        
+        skip = 0
+        for size in range(min(max_overlap_words, len(keys), len(chunk_keys)), 0, -1):
+            if keys[-size:] == chunk_keys[:size]:
+                skip = size
+                break
+        
+        words.extend(chunk_words[skip:])
+        keys.extend(chunk_keys[skip:])
+    
+    return ' '.join(words)
+
+def _decode_samples(input_path: Path, remove_silence: bool) -> np.ndarray:
+    """
+    Декодирует файл в моно 16kHz int16 и при необходимости удаляет тишину
+    
+    Выполняется в отдельном потоке, чтобы не блокировать event loop.
+    """
+    # pydub импортируется при первом декодировании: при импорте он ищет ffmpeg в PATH
+    from pydub import AudioSegment
+    from pydub.exceptions import CouldntDecodeError
     
     try:
-        # Загружаем аудиофайл
         audio = AudioSegment.from_file(str(input_path))
+    except CouldntDecodeError:
+        raise ValueError("Не удалось декодировать аудиофайл. Возможно, файл поврежден.")
+    
+    # Конвертируем в моно, 16kHz, 16 бит
+    audio = audio.set_channels(1).set_frame_rate(_SAMPLE_RATE).set_sample_width(2)
+    samples = np.frombuffer(audio.raw_data, dtype=np.int16)
+    
+    if remove_silence:
+        samples = trim_silence(samples, _SAMPLE_RATE)
+    return samples
+
+def _encode_wav(samples: np.ndarray) -> bytes:
+    """Кодирует моно-отсчёты int16 в WAV"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(_SAMPLE_RATE)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+async def load_audio(
+    input_path: Path,
+    max_duration_minutes: float = MAX_VOICE_DURATION_SECONDS / 60,
+    remove_silence: bool = VAD_ENABLED
+) -> Tuple[np.ndarray, float]:
+    """
+    Проверяет аудиофайл по заголовкам и декодирует его в моно 16kHz
+    
+    Args:
+        input_path: Путь к исходному файлу
+        max_duration_minutes: Максимальная длительность в минутах
+        remove_silence: Удалять тишину детектором речи
         
-        # Проверяем длительность
-        duration_minutes = len(audio) / 1000 / 60  # длительность в минутах
-        if duration_minutes > max_duration_minutes:
-            raise ValueError(f"Аудио слишком длинное: {duration_minutes:.1f} мин (макс. {max_duration_minutes} мин)")
+    Returns:
+        Tuple[np.ndarray, float]: Отсчёты int16 и исходная длительность в секундах
         
-        # Конвертируем в моно, 16kHz
-        audio = audio.set_channels(1)  # моно
-        audio = audio.set_frame_rate(16000)  # 16kHz
+    Raises:
+        NoSpeechError: Если в записи нет речи
+        ValueError: Если файл слишком длинный или поврежден
+    """
+    # Проверяем длительность по заголовкам до декодирования
+    # Поток держит ссылку на файл: отменённая обработка не удалит его посреди чтения
+    info = await temp_file_manager.run_in_thread(input_path, probe_audio, input_path)
+    duration_minutes = info.duration_seconds / 60
+    if info.duration_us == 0:
+        raise ValueError("Аудиофайл не содержит звука")
+    if duration_minutes > max_duration_minutes:
+        raise ValueError(f"Аудио слишком длинное: {duration_minutes:.1f} мин (макс. {max_duration_minutes:g} мин)")
+    
+    try:
+        samples = await temp_file_manager.run_in_thread(input_path, _decode_samples, input_path, remove_silence)
+    except (NoSpeechError, ValueError):
+        raise
+    except Exception as e:
+        logger.error("Ошибка конвертации аудио: %s", e)
+        raise ValueError(f"Ошибка обработки аудио: {str(e)}")
+    
+    logger.info("Аудио декодировано: %.1f с -> %.1f с речи", info.duration_seconds, len(samples) / _SAMPLE_RATE)
+    return samples, info.duration_seconds
+
+async def convert_to_wav(input_path: Path, max_duration_minutes: float = MAX_VOICE_DURATION_SECONDS / 60) -> Path:
+    """
+    Конвертирует аудиофайл в WAV формат 16kHz
+    
+    Args:
+        input_path: Путь к исходному файлу
+        max_duration_minutes: Максимальная длительность в минутах
         
-        # Экспортируем в WAV
-        audio.export(str(output_path), format="wav")
+    Returns:
+        Path: Путь к сконвертированному WAV файлу
         
-        logger.info(f"Аудио сконвертировано: {duration_minutes:.1f} мин, {output_path}")
+    Raises:
+        ValueError: Если файл слишком длинный или поврежден
+    """
+    samples, _ = await load_audio(input_path, max_duration_minutes, remove_silence=False)
+    
+    output_path = create_temp_file('.wav')
+    try:
+        output_path.write_bytes(_encode_wav(samples))
+        temp_file_manager.commit(output_path)
+        logger.info("Аудио сконвертировано: %s", output_path)
         return output_path
-        
-    except CouldntDecodeError:
-        cleanup_temp_file(output_path)
-        raise ValueError("Не удалось декодировать аудиофайл. Возможно, файл поврежден.")
     except Exception as e:
         cleanup_temp_file(output_path)
-        logger.error(f"Ошибка конвертации аудио: {e}")
+        logger.error("Ошибка конвертации аудио: %s", e)
         raise ValueError(f"Ошибка обработки аудио: {str(e)}")
 
-async def speech_to_text(file_path: Path) -> str:
+def confident_text(segments) -> str:
     """
-    Преобразует аудиофайл в текст с использованием OpenAI Whisper
+    Текст сегментов Whisper, распознанных уверенно
+    
+    Сегмент отбрасывается, если Whisper считает, что в нём нет речи
+    (no_speech_prob выше STT_NO_SPEECH_PROB), или распознал его неуверенно
+    (avg_logprob ниже STT_MIN_AVG_LOGPROB).
+    
+    Args:
+        segments: Сегменты ответа Whisper в формате verbose_json
+    """
+    kept = []
+    for segment in segments:
+        if segment.no_speech_prob > STT_NO_SPEECH_PROB or segment.avg_logprob < STT_MIN_AVG_LOGPROB:
+            logger.debug(
+                "Сегмент отброшен: no_speech_prob=%.2f, avg_logprob=%.2f, текст '%s'",
+                segment.no_speech_prob, segment.avg_logprob, segment.text
+            )
+            metrics.inc('stt.segments_dropped')
+            continue
+        kept.append(segment.text.strip())
+    return " ".join(kept)
+
+async def _transcribe_chunk(index: int, wav_bytes: bytes, semaphore: asyncio.Semaphore) -> str:
+    """Отправляет один фрагмент в Whisper"""
+    # OpenAI имеет лимит 25MB на файл
+    if len(wav_bytes) > _WHISPER_MAX_BYTES:
+        raise ValueError(f"Фрагмент слишком большой: {len(wav_bytes) / (1024 * 1024):.1f}MB (макс. 25MB)")
+    
+    def request():
+        return get_client().audio.transcriptions.create(
+            model="whisper-1",
+            file=(f"chunk_{index}.wav", wav_bytes),
+            language="ru",  # Указываем русский язык для лучшего качества
+            # verbose_json возвращает сегменты с оценками уверенности
+            response_format="verbose_json" if STT_SEGMENT_FILTER else "json",
+            **request_timeout()
+        )
+    
+    async with semaphore:
+        transcript = await hedger.run('stt', request)
+    if STT_SEGMENT_FILTER and transcript.segments is not None:
+        return confident_text(transcript.segments)
+    return transcript.text.strip()
+
+async def _transcribe_chunks(chunks: List[bytes]) -> List[str]:
+    """
+    Параллельно распознаёт фрагменты, сохраняя их порядок
+    
+    При ошибке одного фрагмента остальные запросы отменяются.
+    """
+    semaphore = asyncio.Semaphore(STT_MAX_CONCURRENCY)
+    tasks = [asyncio.create_task(_transcribe_chunk(i, chunk, semaphore)) for i, chunk in enumerate(chunks)]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def transcribe(file_path: Path) -> Transcription:
+    """
+    Распознаёт голосовое сообщение: удаляет тишину и отправляет речь в Whisper
+    
+    Длинные записи делятся по паузам на перекрывающиеся фрагменты, которые
+    распознаются параллельно и склеиваются с удалением повторов на стыках.
     
     Args:
         file_path: Путь к аудиофайлу
         
     Returns:
-        str: Распознанный текст
+        Transcription: Текст и длительности до и после удаления тишины
         
     Raises:
+        NoSpeechError: Если в записи нет речи
         ValueError: При ошибках распознавания или обработки
     """
-    wav_path = None
-    
     try:
-        # Конвертируем в WAV если нужно
-        if file_path.suffix.lower() != '.wav':
-            wav_path = await convert_to_wav(file_path)
-            audio_file_path = wav_path
-        else:
-            audio_file_path = file_path
+        samples, original_seconds = await load_audio(file_path)
+        speech_seconds = len(samples) / _SAMPLE_RATE
         
-        # Проверяем размер файла (OpenAI имеет лимит 25MB)
-        file_size_mb = audio_file_path.stat().st_size / (1024 * 1024)
-        if file_size_mb > 25:
-            raise ValueError(f"Файл слишком большой: {file_size_mb:.1f}MB (макс. 25MB)")
+        ranges = plan_chunks(samples, _SAMPLE_RATE, STT_CHUNK_SECONDS, STT_CHUNK_OVERLAP_SECONDS)
+        chunks = [_encode_wav(samples[start:end]) for start, end in ranges]
         
         # Отправляем на распознавание
-        with open(audio_file_path, 'rb') as audio_file:
-            transcript = await client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="ru"  # Указываем русский язык для лучшего качества
-            )
-        
-        text = transcript.text.strip()
+        started = time.perf_counter()
+        texts = await _transcribe_chunks(chunks)
+        text = stitch_transcripts(texts).strip()
         
+        if not text and STT_SEGMENT_FILTER:
+            # Уверенно распознанной речи нет - GPT и TTS не вызываются
+            metrics.inc('stt.low_confidence_skipped')
+            raise NoSpeechError("В записи не слышно уверенной речи")
         if not text:
             raise ValueError("Не удалось распознать речь. Попробуйте говорить громче и четче.")
         
-        logger.info(f"STT успешно: {len(text)} символов")
-        return text
+        result = Transcription(text, original_seconds, speech_seconds)
+        logger.info(
+            "STT успешно: %s символов, %s фрагм. за %.2f с, "
+            "сэкономлено %.1f с тишины",
+            len(text), len(chunks), time.perf_counter() - started, result.saved_seconds
+        )
+        return result
         
+    except NoSpeechError:
+        raise
     except Exception as e:
-        logger.error(f"Ошибка STT: {e}")
+        logger.error("Ошибка STT: %s", e)
         if "insufficient_quota" in str(e).lower() or "quota" in str(e).lower():
             raise ValueError("Превышен лимит использования сервиса распознавания речи. Обратитесь к администратору.")
         elif "rate limit" in str(e).lower():
@@ -113,16 +446,29 @@ async def speech_to_text(file_path: Path) -> str:
             raise ValueError("Не удалось обработать аудиофайл. Попробуйте записать заново.")
         else:
             raise ValueError("Не расслышал. Попробуй ещё раз.")
+
+async def speech_to_text(file_path: Path) -> str:
+    """
+    Преобразует аудиофайл в текст с использованием OpenAI Whisper
     
-    finally:
-        # Очищаем временный WAV файл
-        if wav_path:
-            cleanup_temp_file(wav_path)
+    Args:
+        file_path: Путь к аудиофайлу
+        
+    Returns:
+        str: Распознанный текст
+        
+    Raises:
+        ValueError: При ошибках распознавания или обработки
+    """
+    transcription = await transcribe(file_path)
+    return transcription.text
 
 async def get_audio_duration(file_path: Path) -> float:
     """
     Получает длительность аудиофайла в секундах
     
+    Длительность читается из заголовков контейнера, без декодирования
+    
     Args:
         file_path: Путь к аудиофайлу
         
@@ -130,10 +476,10 @@ async def get_audio_duration(file_path: Path) -> float:
         float: Длительность в секундах
     """
     try:
-        audio = AudioSegment.from_file(str(file_path))
-        duration = len(audio) / 1000.0  # длительность в секундах
-        logger.info(f"Длительность аудио {file_path}: {duration:.2f} секунд")
+        info = await asyncio.to_thread(probe_audio, file_path)
+        duration = info.duration_seconds
+        logger.info("Длительность аудио %s: %.2f секунд", file_path, duration)
         return duration
     except Exception as e:
-        logger.error(f"Ошибка получения длительности аудио: {e}")
+        logger.error("Ошибка получения длительности аудио: %s", e)
         return 0.0
\ No newline at end of file
@@ -0,0 +1,247 @@
+"""
+Управление временными файлами: уникальные имена, области видимости,
+подсчёт ссылок, квота на объём и фоновая очистка
+
+Каждый файл живёт, пока на него есть ссылки. Первую ссылку держит область
+прогона обработки (TempScope). Работа в потоке, которая может пережить
+отменённую задачу (декодирование в STT), берёт ещё одну ссылку через
+run_in_thread(), и файл удаляется, только когда её отпустит последний владелец.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from config import TEMP_DIR, TEMP_QUOTA_MB, TEMP_QUOTA_WAIT_SECONDS, TEMP_MAX_AGE_MINUTES
+
+logger = logging.getLogger(__name__)
+
+class TempScope:
+    """
+    Набор временных файлов одного прогона обработки сообщения
+
+    Область держит по одной ссылке на каждый свой файл и отпускает их вызовом
+    release() по окончании обработки (или release_file() - раньше).
+    """
+
+    def __init__(self, manager: 'TempFileManager'):
+        self._manager = manager
+        self._paths: List[Path] = []
+
+    def create(self, suffix: str = '.tmp') -> Path:
+        """Создаёт путь к новому временному файлу, принадлежащему области"""
+        path = self._manager.create(suffix)
+        self._paths.append(path)
+        return path
+
+    def release_file(self, path: Path) -> None:
+        """Отпускает ссылку области на файл до окончания обработки"""
+        if path in self._paths:
+            self._paths.remove(path)
+            self._manager.release(path)
+
+    def release(self) -> None:
+        """Отпускает ссылки на все файлы области"""
+        for path in self._paths:
+            self._manager.release(path)
+        self._paths.clear()
+
+    async def __aenter__(self) -> 'TempScope':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+class TempFileManager:
+    """Менеджер временных файлов с квотой (очистку запускает планировщик)"""
+
+    def __init__(self, base_dir: Path, quota_bytes: int, max_age_seconds: float):
+        self.base_dir = base_dir
+        self.quota_bytes = quota_bytes
+        self.max_age_seconds = max_age_seconds
+
+        self._lock = threading.Lock()
+        self._refs: Dict[Path, int] = {}  # путь -> число ссылок (и ещё не записанные файлы)
+        self._files: Dict[Path, int] = {}  # записанный файл -> размер в байтах
+        self._bytes = 0
+        # Событие ожидания квоты и его цикл: release() вызывается и из рабочих потоков (sweep)
+        self._space_freed: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def file_count(self) -> int:
+        """Количество записанных на диск временных файлов"""
+        return len(self._files)
+
+    @property
+    def reserved_count(self) -> int:
+        """Количество выданных путей, в которые ещё ничего не записано"""
+        return len(self._refs.keys() - self._files.keys())
+
+    @property
+    def total_bytes(self) -> int:
+        """Суммарный размер отслеживаемых файлов"""
+        return self._bytes
+
+    def create(self, suffix: str = '.tmp') -> Path:
+        """Возвращает уникальный путь для временного файла с одной ссылкой"""
+        path = self.base_dir / f"temp_{uuid.uuid4().hex}{suffix}"
+        with self._lock:
+            self._refs[path] = 1
+        return path
+
+    def commit(self, path: Path) -> None:
+        """Учитывает размер записанного файла в квоте"""
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return
+        with self._lock:
+            if path not in self._refs:
+                # Файл уже отпущен всеми владельцами
+                return
+            self._bytes += size - self._files.get(path, 0)
+            self._files[path] = size
+
+    def acquire(self, path: Path) -> bool:
+        """Добавляет ссылку на отслеживаемый файл; False, если файл не отслеживается"""
+        with self._lock:
+            if path not in self._refs:
+                return False
+            self._refs[path] += 1
+            return True
+
+    def release(self, path: Path) -> None:
+        """
+        Отпускает ссылку на файл; без ссылок файл удаляется и освобождает квоту
+
+        Файл, который менеджер не отслеживает, удаляется сразу. Можно вызывать
+        из любого потока.
+        """
+        with self._lock:
+            refs = self._refs.get(path)
+            if refs is not None:
+                if refs > 1:
+                    self._refs[path] = refs - 1
+                    return
+                del self._refs[path]
+        self._delete(path)
+
+    async def run_in_thread(self, path: Path, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        Выполняет func(*args) в отдельном потоке, удерживая ссылку на path
+
+        Поток не прерывается отменой ожидающей задачи (а shield не даёт отменить
+        ещё не начатый вызов), поэтому ссылка отпускается всегда и файл удаляется
+        не раньше, чем поток закончит с ним работать.
+        """
+        acquired = self.acquire(path)
+
+        def run() -> Any:
+            try:
+                return func(*args)
+            finally:
+                if acquired:
+                    self.release(path)
+
+        return await asyncio.shield(asyncio.to_thread(run))
+
+    def _delete(self, path: Path) -> None:
+        """Удаляет файл с диска и освобождает его квоту"""
+        try:
+            if path.exists():
+                path.unlink()
+                logger.debug(f"Удален временный файл: {path}")
+        except Exception as e:
+            logger.error(f"Ошибка удаления временного файла {path}: {e}")
+
+        with self._lock:
+            self._bytes -= self._files.pop(path, 0)
+
+        if self._space_freed is not None and self._bytes < self.quota_bytes:
+            # asyncio.Event не потокобезопасен - устанавливаем его в потоке цикла событий
+            try:
+                self._loop.call_soon_threadsafe(self._space_freed.set)
+            except RuntimeError:
+                # Цикл событий уже закрыт - ждать некому
+                pass
+
+    def scope(self) -> TempScope:
+        """Новая область временных файлов (используется как async with)"""
+        return TempScope(self)
+
+    async def wait_for_space(self) -> None:
+        """
+        Ждёт, пока суммарный объём временных файлов опустится ниже квоты
+
+        Raises:
+            ValueError: Если место не освободилось за TEMP_QUOTA_WAIT_SECONDS
+        """
+        if self._bytes < self.quota_bytes:
+            return
+
+        logger.warning(
+            f"Квота временных файлов превышена: {self._bytes / (1024 * 1024):.1f} MB, ожидаем освобождения"
+        )
+        await asyncio.to_thread(self.sweep)
+
+        if self._space_freed is None:
+            self._loop = asyncio.get_running_loop()
+            self._space_freed = asyncio.Event()
+
+        deadline = time.monotonic() + TEMP_QUOTA_WAIT_SECONDS
+        while self._bytes >= self.quota_bytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ValueError("Сервер сейчас перегружен. Попробуйте через минуту.")
+            self._space_freed.clear()
+            try:
+                await asyncio.wait_for(self._space_freed.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def sweep(self, max_age_seconds: Optional[float] = None) -> int:
+        """
+        Удаляет временные файлы старше max_age_seconds, в том числе оставшиеся от прошлых запусков
+
+        Returns:
+            Количество удалённых файлов
+        """
+        if max_age_seconds is None:
+            max_age_seconds = self.max_age_seconds
+
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+
+        try:
+            with os.scandir(self.base_dir) as entries:
+                for entry in entries:
+                    if not entry.name.startswith('temp_') or not entry.is_file():
+                        continue
+                    path = Path(entry.path)
+                    try:
+                        if entry.stat().st_mtime < cutoff:
+                            # Забытые файлы удаляются независимо от ссылок
+                            with self._lock:
+                                self._refs.pop(path, None)
+                            self._delete(path)
+                            removed += 1
+                    except FileNotFoundError:
+                        continue
+        except Exception as e:
+            logger.error(f"Ошибка очистки временных файлов: {e}")
+
+        if removed:
+            logger.info(f"Удалено {removed} временных файлов старше {max_age_seconds / 60:.0f} мин")
+        return removed
+
+# Глобальный экземпляр менеджера
+temp_file_manager = TempFileManager(
+    base_dir=TEMP_DIR,
+    quota_bytes=TEMP_QUOTA_MB * 1024 * 1024,
+    max_age_seconds=TEMP_MAX_AGE_MINUTES * 60
+)
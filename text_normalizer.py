@@ -0,0 +1,558 @@
+"""
+Нормализация текста перед озвучиванием (TTS)
+
+Весь текст проходит через одну предкомпилированную таблицу замен символов
+(str.translate) и один проход скомпилированного регулярного выражения, который
+убирает Markdown, раскрывает числа, даты и время в русские слова и заменяет
+служебные символы. Результат собирается в список фрагментов без промежуточных
+копий всей строки.
+"""
+import re
+from typing import List
+
+# Посимвольная нормализация: пробельные символы, невидимые символы, скобки кода
+_CHAR_TABLE = str.maketrans({
+    '\t': ' ',
+    '\r': ' ',
+    '\v': ' ',
+    '\f': ' ',
+    '\xa0': ' ',
+    '\u2009': ' ',
+    '\u202f': ' ',
+    '\u200b': None,
+    '\u200c': None,
+    '\u200d': None,
+    '\ufeff': None,
+    '`': None,
+    '{': None,
+    '}': None,
+    '\u2026': '...',
+})
+
+# Служебные символы, которые озвучиваются словами
+_SYMBOL_WORDS = {
+    '&': ' и ',
+    '@': ' собака ',
+    '#': ' хештег ',
+    '%': ' процент ',
+    '$': ' доллар ',
+    '€': ' евро ',
+    '₽': ' рубль ',
+    '+': ' плюс ',
+    '=': ' равно ',
+    '<': ' меньше ',
+    '>': ' больше ',
+    '|': ' или ',
+    '\\': ' слеш ',
+    '/': ' слеш ',
+    '_': ' подчеркивание ',
+    '^': ' степень ',
+    '~': ' тильда ',
+    '[': '',
+    ']': '',
+}
+
+# --- Числительные ---
+
+_UNITS_MASC = ['ноль', 'один', 'два', 'три', 'четыре', 'пять', 'шесть', 'семь', 'восемь', 'девять']
+_UNITS_FEM = ['ноль', 'одна', 'две', 'три', 'четыре', 'пять', 'шесть', 'семь', 'восемь', 'девять']
+_TEENS = [
+    'десять', 'одиннадцать', 'двенадцать', 'тринадцать', 'четырнадцать',
+    'пятнадцать', 'шестнадцать', 'семнадцать', 'восемнадцать', 'девятнадцать'
+]
+_TENS = [
+    '', '', 'двадцать', 'тридцать', 'сорок', 'пятьдесят',
+    'шестьдесят', 'семьдесят', 'восемьдесят', 'девяносто'
+]
+_HUNDREDS = [
+    '', 'сто', 'двести', 'триста', 'четыреста', 'пятьсот',
+    'шестьсот', 'семьсот', 'восемьсот', 'девятьсот'
+]
+
+# (формы для 1, 2-4, 5+; женский род)
+_SCALES = [
+    (('тысяча', 'тысячи', 'тысяч'), True),
+    (('миллион', 'миллиона', 'миллионов'), False),
+    (('миллиард', 'миллиарда', 'миллиардов'), False),
+    (('триллион', 'триллиона', 'триллионов'), False),
+    (('квадриллион', 'квадриллиона', 'квадриллионов'), False),
+]
+
+# Основы порядковых числительных (первого/первое, двадцатого/двадцатое, ...)
+_ORDINAL_STEMS = {
+    1: 'перв', 2: 'втор', 3: 'трет', 4: 'четвёрт', 5: 'пят', 6: 'шест',
+    7: 'седьм', 8: 'восьм', 9: 'девят', 10: 'десят', 11: 'одиннадцат',
+    12: 'двенадцат', 13: 'тринадцат', 14: 'четырнадцат', 15: 'пятнадцат',
+    16: 'шестнадцат', 17: 'семнадцат', 18: 'восемнадцат', 19: 'девятнадцат',
+    20: 'двадцат', 30: 'тридцат', 40: 'сороков', 50: 'пятидесят',
+    60: 'шестидесят', 70: 'семидесят', 80: 'восьмидесят', 90: 'девяност',
+    100: 'сот', 200: 'двухсот', 300: 'трёхсот', 400: 'четырёхсот',
+    500: 'пятисот', 600: 'шестисот', 700: 'семисот', 800: 'восьмисот',
+    900: 'девятисот',
+}
+_THOUSANDS_ORDINAL_STEMS = {1: 'тысячн', 2: 'двухтысячн', 3: 'трёхтысячн'}
+
+# Ударное окончание в мужском роде: второй, шестой, сороковой
+_ORDINAL_STRESSED = {2, 6, 7, 8, 40}
+
+# «Третий» склоняется по-своему
+_THIRD_ENDINGS = {
+    'ый': 'ий', 'ого': 'ьего', 'ом': 'ьем', 'ым': 'ьим',
+    'ое': 'ье', 'ая': 'ья', 'ые': 'ьи', 'ых': 'ьих',
+}
+
+# Окончания после дефиса (5-й, 10-го, 90-х) -> окончание порядкового числительного
+_ORDINAL_SUFFIXES = {
+    'й': 'ый', 'ый': 'ый', 'ий': 'ый', 'ой': 'ый',
+    'го': 'ого', 'ого': 'ого', 'его': 'ого',
+    'м': 'ом', 'ом': 'ом', 'ем': 'ом', 'ым': 'ым',
+    'е': 'ое', 'я': 'ая', 'ая': 'ая', 'ое': 'ое',
+    'х': 'ых', 'ых': 'ых', 'их': 'ых', 'ые': 'ые',
+}
+
+# Падеж слова «год» -> окончание порядкового числительного года
+_YEAR_ENDINGS = {'': 'ый', 'а': 'ого', 'у': 'ом', 'е': 'ом', 'ом': 'ым'}
+
+_MONTHS_GENITIVE = [
+    '', 'января', 'февраля', 'марта', 'апреля', 'мая', 'июня',
+    'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря'
+]
+
+_UNIT_FORMS = {
+    '%': ('процент', 'процента', 'процентов'),
+    '₽': ('рубль', 'рубля', 'рублей'),
+    'руб': ('рубль', 'рубля', 'рублей'),
+    '$': ('доллар', 'доллара', 'долларов'),
+    '€': ('евро', 'евро', 'евро'),
+}
+
+def plural_form(n: int, forms: tuple) -> str:
+    """Выбирает форму слова для числа: (1 процент, 2 процента, 5 процентов)"""
+    n = abs(n) % 100
+    if 11 <= n <= 14:
+        return forms[2]
+    n %= 10
+    if n == 1:
+        return forms[0]
+    if 2 <= n <= 4:
+        return forms[1]
+    return forms[2]
+
+def _triplet_words(n: int, feminine: bool, out: List[str]) -> None:
+    """Добавляет в out слова для числа от 1 до 999"""
+    hundreds, rest = divmod(n, 100)
+    if hundreds:
+        out.append(_HUNDREDS[hundreds])
+    if 10 <= rest <= 19:
+        out.append(_TEENS[rest - 10])
+        return
+    tens, units = divmod(rest, 10)
+    if tens:
+        out.append(_TENS[tens])
+    if units:
+        out.append((_UNITS_FEM if feminine else _UNITS_MASC)[units])
+
+def number_to_words(n: int, feminine: bool = False) -> str:
+    """
+    Преобразует целое число в русские слова (количественное числительное)
+
+    Args:
+        n: Число
+        feminine: Женский род для единиц (одна, две)
+
+    Returns:
+        str: Число прописью
+    """
+    if n == 0:
+        return 'ноль'
+    if n < 0:
+        return 'минус ' + number_to_words(-n, feminine)
+
+    words: List[str] = []
+    groups = []
+    while n:
+        n, group = divmod(n, 1000)
+        groups.append(group)
+
+    for index in range(len(groups) - 1, -1, -1):
+        group = groups[index]
+        if not group:
+            continue
+        if index == 0:
+            _triplet_words(group, feminine, words)
+        else:
+            forms, scale_feminine = _SCALES[index - 1]
+            # «тысяча девятьсот», а не «одна тысяча девятьсот»; «один миллион» - с числом
+            if not (group == 1 and index == 1 and index == len(groups) - 1):
+                _triplet_words(group, scale_feminine, words)
+            words.append(plural_form(group, forms))
+
+    return ' '.join(words)
+
+def _ordinal_tail(n: int, ending: str) -> str:
+    """Порядковое числительное для 1-999 без составной части (третьего, сорокового)"""
+    stem = _ORDINAL_STEMS[n]
+    if n == 3:
+        return stem + _THIRD_ENDINGS[ending]
+    if ending == 'ый' and n in _ORDINAL_STRESSED:
+        return stem + 'ой'
+    return stem + ending
+
+def ordinal_to_words(n: int, ending: str = 'ое') -> str:
+    """
+    Преобразует число в порядковое числительное
+
+    Склоняется только последнее слово, остальные остаются количественными:
+    2024 -> «две тысячи двадцать четвёртого».
+
+    Args:
+        n: Число от 1 до 999999
+        ending: Окончание «обычной» основы: 'ый', 'ого', 'ом', 'ым', 'ое', 'ая', 'ые', 'ых'
+
+    Returns:
+        str: Порядковое числительное прописью
+    """
+    if n <= 0 or n >= 1000000:
+        return number_to_words(n)
+
+    if n % 1000 == 0:
+        thousands = n // 1000
+        if thousands in _THOUSANDS_ORDINAL_STEMS:
+            return _THOUSANDS_ORDINAL_STEMS[thousands] + ending
+        return number_to_words(thousands) + ' тысячн' + ending
+
+    rest = n % 100
+    if rest == 0:
+        tail = n % 1000
+    elif rest < 20 or rest % 10 == 0:
+        tail = rest
+    else:
+        tail = rest % 10
+
+    head = n - tail
+    tail_words = _ordinal_tail(tail, ending)
+    if head:
+        return number_to_words(head) + ' ' + tail_words
+    return tail_words
+
+def _digits_to_words(digits: str) -> str:
+    """Читает строку цифр по одной (номера телефонов, коды)"""
+    return ' '.join(_UNITS_MASC[ord(c) - 48] for c in digits)
+
+def _integer_words(digits: str, feminine: bool = False) -> str:
+    """Читает целое число; длинные числа и числа с ведущим нулём читаются по цифрам"""
+    if len(digits) > 18 or (len(digits) > 1 and digits[0] == '0'):
+        return _digits_to_words(digits)
+    return number_to_words(int(digits), feminine)
+
+_FRACTION_FORMS = {
+    1: ('десятая', 'десятых'),
+    2: ('сотая', 'сотых'),
+    3: ('тысячная', 'тысячных'),
+}
+
+def _decimal_words(int_digits: str, frac_digits: str) -> str:
+    """Читает десятичную дробь: 3,5 -> «три целых пять десятых»"""
+    frac_forms = _FRACTION_FORMS.get(len(frac_digits))
+    if frac_forms is None:
+        return f"{_integer_words(int_digits)} точка {_digits_to_words(frac_digits)}"
+
+    whole = int(int_digits)
+    frac = int(frac_digits)
+    whole_word = 'целая' if whole % 10 == 1 and whole % 100 != 11 else 'целых'
+    frac_word = frac_forms[0] if frac % 10 == 1 and frac % 100 != 11 else frac_forms[1]
+    return (
+        f"{_integer_words(int_digits, feminine=True)} {whole_word} "
+        f"{number_to_words(frac, feminine=True)} {frac_word}"
+    )
+
+# --- Единое регулярное выражение ---
+
+_MONTH_NAMES = '|'.join(_MONTHS_GENITIVE[1:])
+
+_PATTERN = re.compile(
+    r'(?P<link>!?\[(?P<link_text>[^\]\n]*)\]\([^)\s]*\))'
+    r'|(?P<line>(?:^|\n)[ ]*(?:#{1,6}|>+|[-*+•]|\d{1,2}[.)])[ ]+)'
+    r'|(?P<emph>\*+|(?<!\w)_+|_+(?!\w))'
+    r'|(?P<date>\b(?P<day>\d{1,2})\.(?P<month>\d{1,2})\.(?P<year>\d{4}|\d{2})\b)'
+    r'|(?P<daymonth>\b(?P<dm_day>\d{1,2})(?=[ ]+(?:' + _MONTH_NAMES + r')\b))'
+    r'|(?P<time>\b(?P<hour>[01]?\d|2[0-3]|24(?=:00)):(?P<minute>[0-5]\d)\b)'
+    r'|(?P<ordinal>\b(?P<ord_num>\d+)-(?P<ord_suffix>[а-яё]+)\b)'
+    r'|(?P<yearword>\b(?P<yw_num>[12]\d{3})(?=[ ]+год(?P<yw_case>|а|у|е|ом)\b))'
+    r'|(?P<cur>(?P<cur_sym>[$€₽])[ ]?(?P<cur_num>\d+)\b)'
+    r'|(?P<number>(?P<minus>(?<![\w.,])[-−])?(?<!\w)(?<!\d[.,:])'
+    r'(?P<int>\d{1,3}(?:[ ]\d{3})+|[1-9]\d{0,2}(?:,\d{3})+(?!\d)|\d+)'
+    r'(?:[.,](?P<frac>\d+))?\b(?![.,:]\d)'
+    r'(?:[ ]?(?P<unit>%|₽|\$|€|руб\b(?:\.(?![ ]*(?:[A-ZА-ЯЁ]|$)))?))?)'
+    r'|(?P<sym>[&@#%$€₽+=<>|\\/_^~\[\]])'
+    r'|(?P<space>\s+)'
+)
+
+def _number_replacement(match: re.Match) -> str:
+    """Раскрывает число (с дробной частью и единицей измерения) в слова"""
+    # 1 000 и 1,000 - разделители разрядов; 3,5 и 2,50 - дроби
+    int_digits = match.group('int').replace(' ', '').replace(',', '')
+    frac_digits = match.group('frac')
+    unit = match.group('unit')
+
+    if frac_digits is not None:
+        words = _decimal_words(int_digits, frac_digits)
+    else:
+        words = _integer_words(int_digits)
+
+    if match.group('minus'):
+        words = 'минус ' + words
+
+    if unit:
+        forms = _UNIT_FORMS[unit.rstrip('.')]
+        if frac_digits is not None:
+            # С дробями используется родительный падеж единственного числа
+            words += ' ' + forms[1]
+        else:
+            words += ' ' + plural_form(int(int_digits[-2:]), forms)
+
+    return words
+
+def _date_replacement(match: re.Match) -> str:
+    """Раскрывает дату ДД.ММ.ГГГГ: «двенадцатое марта две тысячи двадцать четвёртого года»"""
+    day = int(match.group('day'))
+    month = int(match.group('month'))
+    year_digits = match.group('year')
+
+    if not (1 <= day <= 31 and 1 <= month <= 12):
+        # Не дата (например, версия 10.20.30) - читаем как числа
+        return f"{number_to_words(day)} точка {number_to_words(month)} точка {_integer_words(year_digits)}"
+
+    year = int(year_digits)
+    if len(year_digits) == 2:
+        year += 2000
+
+    return f"{ordinal_to_words(day)} {_MONTHS_GENITIVE[month]} {ordinal_to_words(year, 'ого')} года"
+
+def _time_replacement(match: re.Match) -> str:
+    """Раскрывает время ЧЧ:ММ: 9:05 -> «девять ноль пять»"""
+    hour = number_to_words(int(match.group('hour')))
+    minute_digits = match.group('minute')
+    if minute_digits == '00':
+        return f"{hour} ноль ноль"
+    if minute_digits[0] == '0':
+        return f"{hour} ноль {_UNITS_MASC[int(minute_digits[1])]}"
+    return f"{hour} {number_to_words(int(minute_digits))}"
+
+def _ordinal_replacement(match: re.Match) -> str:
+    """Раскрывает порядковое числительное с окончанием: 5-й, 10-го, 90-х, 90-е"""
+    n = int(match.group('ord_num'))
+    suffix = match.group('ord_suffix')
+    ending = _ORDINAL_SUFFIXES.get(suffix)
+    if ending is None or n >= 1000000:
+        return match.group(0)
+    if suffix == 'е':
+        # «90-е» - десятилетие (девяностые), «5-е» - пятое
+        ending = 'ые' if n >= 10 and n % 10 == 0 else 'ое'
+    return ordinal_to_words(n, ending)
+
+def _replacement(match: re.Match) -> str:
+    """Возвращает замену для одного совпадения единого регулярного выражения"""
+    kind = match.lastgroup
+
+    if kind == 'space':
+        return ' '
+    if kind == 'sym':
+        return _SYMBOL_WORDS[match.group('sym')]
+    if kind == 'number':
+        return _number_replacement(match)
+    if kind == 'emph':
+        return ''
+    if kind == 'line':
+        return ' '
+    if kind == 'link':
+        return normalize_text(match.group('link_text'))
+    if kind == 'date':
+        return _date_replacement(match)
+    if kind == 'daymonth':
+        return ordinal_to_words(int(match.group('dm_day')))
+    if kind == 'time':
+        return _time_replacement(match)
+    if kind == 'ordinal':
+        return _ordinal_replacement(match)
+    if kind == 'yearword':
+        return ordinal_to_words(int(match.group('yw_num')), _YEAR_ENDINGS[match.group('yw_case')])
+    if kind == 'cur':
+        count = int(match.group('cur_num'))
+        forms = _UNIT_FORMS[match.group('cur_sym')]
+        return f"{number_to_words(count)} {plural_form(count, forms)}"
+    return match.group(0)
+
+def normalize_text(text: str) -> str:
+    """
+    Нормализует текст для озвучивания за один проход
+
+    Убирает разметку Markdown, раскрывает числа, даты, время и денежные суммы,
+    заменяет служебные символы словами и схлопывает пробелы.
+
+    Args:
+        text: Исходный текст (обычно ответ GPT)
+
+    Returns:
+        str: Текст, готовый для TTS
+    """
+    if not text:
+        return ""
+
+    text = text.translate(_CHAR_TABLE)
+
+    parts: List[str] = []
+    append = parts.append
+    last_space = True  # в начале строки пробелы не нужны
+    position = 0
+
+    for match in _PATTERN.finditer(text):
+        start = match.start()
+        if start > position:
+            append(text[position:start])
+            last_space = False
+
+        piece = _replacement(match)
+        if piece:
+            if last_space and piece[0] == ' ':
+                piece = piece.lstrip(' ')
+            if piece:
+                append(piece)
+                last_space = piece[-1] == ' '
+        position = match.end()
+
+    if position < len(text):
+        append(text[position:])
+
+    return ''.join(parts).strip()
+
+# --- Разбиение на предложения ---
+
+_SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')
+_CLAUSE_BOUNDARY = re.compile(r'(?<=[,;:—])\s+')
+
+def split_sentences(text: str) -> List[str]:
+    """Разбивает нормализованный текст на предложения"""
+    return [sentence for sentence in _SENTENCE_BOUNDARY.split(text) if sentence]
+
+def _split_long(sentence: str, max_chars: int) -> List[str]:
+    """Разбивает слишком длинное предложение по знакам препинания, затем по пробелам"""
+    pieces: List[str] = []
+    for clause in _CLAUSE_BOUNDARY.split(sentence):
+        while len(clause) > max_chars:
+            cut = clause.rfind(' ', 0, max_chars + 1)
+            if cut <= 0:
+                cut = max_chars
+            pieces.append(clause[:cut].rstrip())
+            clause = clause[cut:].lstrip()
+        if clause:
+            pieces.append(clause)
+    return pieces
+
+def chunk_text(text: str, max_chars: int) -> List[str]:
+    """
+    Группирует предложения в фрагменты не длиннее max_chars для поблочного синтеза
+
+    Args:
+        text: Нормализованный текст
+        max_chars: Максимальная длина одного фрагмента
+
+    Returns:
+        List[str]: Фрагменты в исходном порядке
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    current_len = 0
+
+    for sentence in split_sentences(text):
+        pieces = [sentence] if len(sentence) <= max_chars else _split_long(sentence, max_chars)
+        for piece in pieces:
+            added = len(piece) + (1 if current else 0)
+            if current and current_len + added > max_chars:
+                chunks.append(' '.join(current))
+                current = []
+                current_len = 0
+                added = len(piece)
+            current.append(piece)
+            current_len += added
+
+    if current:
+        chunks.append(' '.join(current))
+
+    return chunks
+
+def _self_check() -> None:
+    """Проверяет разбор чисел на случаях, которые уже ломались"""
+    cases = {
+        # Точка после «руб.» в конце предложения сохраняется, внутри - поглощается
+        'Стоит 100 руб. Потом ещё.': 'Стоит сто рублей. Потом ещё.',
+        'Стоит 100 руб.': 'Стоит сто рублей.',
+        'Это 5 руб. за штуку.': 'Это пять рублей за штуку.',
+        # Числа, склеенные с буквами, и версии через точку не раскрываются
+        'v2.0 и 1.2.3': 'v2.0 и 1.2.3',
+        'Модель gpt4 и 3,5 часа': 'Модель gpt4 и три целых пять десятых часа',
+        # Единица старшего разряда читается с числом, кроме «тысячи»
+        '1 000 000 человек': 'один миллион человек',
+        '1000 шагов': 'тысяча шагов',
+        '2001000': 'два миллиона одна тысяча',
+        # Регрессия: обычные числа, даты, время и проценты
+        '87% случаев': 'восемьдесят семь процентов случаев',
+        '12.03.2024 в 14:30': 'двенадцатое марта две тысячи двадцать четвёртого года в четырнадцать тридцать',
+        'Температура -5, а вчера 2,5': 'Температура минус пять, а вчера две целых пять десятых',
+        # Полночь, соотношения через двоеточие не трогаем
+        'до 24:00': 'до двадцать четыре ноль ноль',
+        'счёт 3:2': 'счёт 3:2',
+        # Разделитель разрядов через запятую
+        '1,000 и 12,500,000': 'тысяча и двенадцать миллионов пятьсот тысяч',
+        '0,125': 'ноль целых сто двадцать пять тысячных',
+        # Порядковые числительные с окончанием и годы
+        'в 90-х и 80-е': 'в девяностых и восьмидесятые',
+        '3-й раз, 2-й этаж, на 5-м': 'третий раз, второй этаж, на пятом',
+        'в 2024 году': 'в две тысячи двадцать четвёртом году',
+        'с 1999 года': 'с тысяча девятьсот девяносто девятого года',
+        '2 года': 'два года',
+        # Длинные числа
+        '123456789012345': 'сто двадцать три триллиона четыреста пятьдесят шесть миллиардов '
+                           'семьсот восемьдесят девять миллионов двенадцать тысяч триста сорок пять',
+    }
+    for source, expected in cases.items():
+        result = normalize_text(source)
+        assert result == expected, f"{source!r}: {result!r} != {expected!r}"
+    print(f"text_normalizer: {len(cases)} проверок пройдено")
+
+def benchmark(sizes: tuple = (1_000, 10_000, 100_000, 1_000_000)) -> None:
+    """
+    Замеряет время и пиковое потребление памяти normalize_text на длинных текстах
+
+    Время на символ и отношение пиковой памяти к размеру входа должны оставаться
+    примерно постоянными при росте длины текста (линейное поведение).
+    """
+    import timeit
+    import tracemalloc
+
+    sample = (
+        "## Важно\n"
+        "**Дыши глубже** — это помогает в 87% случаев. 12.03.2024 в 14:30 "
+        "ты потратил $15 и 2,5 руб. на [кофе](https://example.com) & пирожок.\n"
+        "- Первый пункт в 90-х\n- Второй пункт с snake_case и 1,000,000 шагов!\n"
+    )
+
+    print(f"{'символов':>10} {'мс':>10} {'нс/символ':>10} {'пик/вход':>10}")
+    for size in sizes:
+        text = (sample * (size // len(sample) + 1))[:size]
+
+        repeat = max(1, 100_000 // size)
+        elapsed = min(timeit.repeat(lambda: normalize_text(text), number=repeat, repeat=3)) / repeat
+
+        tracemalloc.start()
+        normalize_text(text)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Строка в UCS-2/UCS-4 занимает больше байт на символ, сравниваем с байтами входа
+        input_bytes = len(text.encode('utf-32-le'))
+        print(f"{size:>10} {elapsed * 1000:>10.2f} {elapsed / size * 1e9:>10.1f} {peak / input_bytes:>10.2f}")
+
+if __name__ == '__main__':
+    _self_check()
+    benchmark()
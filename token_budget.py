@@ -0,0 +1,157 @@
+"""
+Бюджет токенов в минуту (TPM) для запросов к GPT
+
+OpenAI ограничивает не только число запросов, но и число токенов в минуту,
+и превышение до сих пор обнаруживалось только по ошибке 429. Теперь перед
+отправкой запрос резервирует оценку токенов промпта плюс max_tokens в
+скользящем окне за последнюю минуту. Запросы, которые не помещаются, ждут
+в очереди по порядку поступления, а после ответа резерв заменяется
+фактическим расходом из usage.
+
+Токены промпта считаются через tiktoken, если он установлен, иначе -
+с запасом по числу символов.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from config import GPT_TOKENS_PER_MINUTE
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_WINDOW_SECONDS = 60.0
+
+# Служебные токены на каждое сообщение и на ответ в формате chat
+_TOKENS_PER_MESSAGE = 4
+_TOKENS_PER_REPLY = 3
+
+# Оценка без tiktoken: кириллица в cl100k_base занимает около токена на 2-3 символа
+_CHARS_PER_TOKEN = 2.0
+
+_encoding = None
+
+def estimate_prompt_tokens(messages: List[Dict[str, str]], model: str = 'gpt-4') -> int:
+    """Оценивает число токенов промпта без обращения к API"""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.encoding_for_model(model)
+        except (ImportError, KeyError):
+            _encoding = False
+
+    tokens = _TOKENS_PER_REPLY
+    for message in messages:
+        content = message.get('content', '')
+        if _encoding:
+            tokens += len(_encoding.encode(content))
+        else:
+            tokens += int(len(content) / _CHARS_PER_TOKEN) + 1
+        tokens += _TOKENS_PER_MESSAGE
+    return tokens
+
+class Reservation:
+    """Токены одного запроса в окне"""
+    __slots__ = ('at', 'tokens')
+
+    def __init__(self, at: float, tokens: int):
+        self.at = at
+        self.tokens = tokens
+
+class TokenBudget:
+    """Скользящее окно токенов за минуту с очередью запросов"""
+
+    def __init__(self, tokens_per_minute: int):
+        self.tokens_per_minute = tokens_per_minute
+        self._reservations: Deque[Reservation] = deque()
+        self._waiters: Deque[object] = deque()
+        self._changed: Optional[asyncio.Future] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.tokens_per_minute > 0
+
+    @property
+    def waiting(self) -> int:
+        """Сколько запросов ждут места в бюджете"""
+        return len(self._waiters)
+
+    def used(self) -> int:
+        """Токенов израсходовано и зарезервировано за последнюю минуту"""
+        self._expire(time.monotonic())
+        return sum(reservation.tokens for reservation in self._reservations)
+
+    def _expire(self, now: float) -> None:
+        while self._reservations and self._reservations[0].at <= now - _WINDOW_SECONDS:
+            self._reservations.popleft()
+
+    def _wait_seconds(self, tokens: int) -> float:
+        """Через сколько секунд в окне освободится место для tokens (0 - уже есть)"""
+        now = time.monotonic()
+        self._expire(now)
+        excess = sum(reservation.tokens for reservation in self._reservations) + tokens - self.tokens_per_minute
+        if excess <= 0:
+            return 0.0
+        for reservation in self._reservations:
+            excess -= reservation.tokens
+            if excess <= 0:
+                return max(reservation.at + _WINDOW_SECONDS - now, 0.001)
+        return 0.0
+
+    def _notify(self) -> None:
+        """Будит ожидающих: место в окне могло освободиться"""
+        if self._changed is not None and not self._changed.done():
+            self._changed.set_result(None)
+        self._changed = None
+
+    async def reserve(self, tokens: int) -> Optional[Reservation]:
+        """
+        Резервирует токены, дожидаясь места в окне
+
+        Запрос больше всего бюджета резервирует весь бюджет, чтобы не ждать вечно.
+
+        Returns:
+            Reservation или None, если бюджет выключен
+        """
+        if not self.enabled:
+            return None
+        tokens = min(tokens, self.tokens_per_minute)
+
+        ticket = object()
+        self._waiters.append(ticket)
+        started = time.monotonic()
+        try:
+            while True:
+                wait = self._wait_seconds(tokens) if self._waiters[0] is ticket else None
+                if wait == 0:
+                    break
+                if self._changed is None:
+                    self._changed = asyncio.get_running_loop().create_future()
+                await asyncio.wait({self._changed}, timeout=wait)
+        finally:
+            self._waiters.remove(ticket)
+            self._notify()
+
+        waited = time.monotonic() - started
+        if waited > 0.01:
+            metrics.inc('gpt.tpm_waits')
+            logger.info(f"[TPM] Запрос ждал бюджета токенов {waited:.1f} с ({tokens} токенов)")
+
+        reservation = Reservation(time.monotonic(), tokens)
+        self._reservations.append(reservation)
+        metrics.set_gauge('gpt.tpm_used', self.used())
+        return reservation
+
+    def settle(self, reservation: Optional[Reservation], actual_tokens: int) -> None:
+        """Заменяет резерв фактическим расходом токенов из ответа API"""
+        if reservation is None:
+            return
+        reservation.tokens = actual_tokens
+        metrics.set_gauge('gpt.tpm_used', self.used())
+        self._notify()
+
+# Глобальный экземпляр
+token_budget = TokenBudget(tokens_per_minute=GPT_TOKENS_PER_MINUTE)
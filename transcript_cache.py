@@ -0,0 +1,124 @@
+"""
+Кэш распознанных голосовых сообщений по file_unique_id Telegram
+
+Пересланные и повторно отправленные голосовые сообщения имеют тот же
+file_unique_id, поэтому для них не нужно заново скачивать файл и вызывать Whisper.
+"""
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import asdict
+from pathlib import Path
+from typing import Optional, Tuple
+
+from config import TRANSCRIPT_CACHE_SIZE, TRANSCRIPT_CACHE_TTL_HOURS, TRANSCRIPT_CACHE_PERSIST, DATA_DIR
+from stt import Transcription
+from persistence import persistence
+
+logger = logging.getLogger(__name__)
+
+# Файл для сохранения кэша между перезапусками
+TRANSCRIPT_CACHE_FILE = DATA_DIR / 'transcripts.json'
+
+class TranscriptCache:
+    """Ограниченный LRU-кэш транскриптов со сроком жизни записей"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float, cache_file: Optional[Path] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.cache_file = cache_file
+        # file_unique_id -> (время истечения, транскрипт)
+        self._entries: "OrderedDict[str, Tuple[float, Transcription]]" = OrderedDict()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self) -> None:
+        """Загружает кэш с диска (бот вызывает при запуске в отдельном потоке)"""
+        if self.cache_file:
+            self._load()
+
+    def get(self, file_unique_id: str) -> Optional[Transcription]:
+        """Возвращает транскрипт из кэша или None"""
+        entry = self._entries.get(file_unique_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, transcription = entry
+        if expires_at < time.time():
+            del self._entries[file_unique_id]
+            self._dirty = True
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(file_unique_id)
+        self.hits += 1
+        return transcription
+
+    def put(self, file_unique_id: str, transcription: Transcription) -> None:
+        """Добавляет транскрипт в кэш, вытесняя самые старые записи"""
+        self._entries[file_unique_id] = (time.time() + self.ttl_seconds, transcription)
+        self._entries.move_to_end(file_unique_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def evict_expired(self) -> int:
+        """Удаляет просроченные записи и возвращает их количество"""
+        now = time.time()
+        expired = [key for key, (expires_at, _) in self._entries.items() if expires_at < now]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._dirty = True
+        return len(expired)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _load(self) -> None:
+        """Загружает кэш с диска"""
+        try:
+            if not self.cache_file.exists():
+                return
+
+            data = json.loads(self.cache_file.read_text(encoding='utf-8'))
+            now = time.time()
+            for key, expires_at, fields in data:
+                if expires_at >= now:
+                    self._entries[key] = (expires_at, Transcription(**fields))
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            logger.info(f"Загружено {len(self._entries)} транскриптов из кэша")
+
+        except Exception as e:
+            logger.error(f"Ошибка загрузки кэша транскриптов: {e}")
+            self._entries.clear()
+
+    async def save(self) -> None:
+        """Сохраняет кэш на диск, если он изменился (сериализация и запись - в потоке persistence)"""
+        if not self.cache_file or not self._dirty:
+            return
+
+        data = [
+            [key, expires_at, asdict(transcription)]
+            for key, (expires_at, transcription) in self._entries.items()
+        ]
+        self._dirty = False
+
+        try:
+            await persistence.write(self.cache_file, lambda: json.dumps(data, ensure_ascii=False))
+        except Exception as e:
+            self._dirty = True
+            logger.error(f"Ошибка сохранения кэша транскриптов: {e}")
+
+# Глобальный экземпляр кэша
+transcript_cache = TranscriptCache(
+    max_entries=TRANSCRIPT_CACHE_SIZE,
+    ttl_seconds=TRANSCRIPT_CACHE_TTL_HOURS * 3600,
+    cache_file=TRANSCRIPT_CACHE_FILE if TRANSCRIPT_CACHE_PERSIST else None
+)
@@ -3,21 +3,69 @@
 """
 import asyncio
 import logging
+import time
 from pathlib import Path
-from openai import AsyncOpenAI
+from typing import List
 
-from config import OPENAI_API_KEY
+from config import TTS_CHUNK_CHARS, TTS_MAX_CONCURRENCY
 from utils import create_temp_file, cleanup_temp_file
+from temp_files import temp_file_manager
+from text_normalizer import normalize_text, chunk_text
+from ogg import concat_opus_streams
+from openai_client import get_client
+from deadline import request_timeout
+from hedging import hedger
 
 logger = logging.getLogger(__name__)
 
-# Инициализируем клиент OpenAI
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+async def _synthesize_chunk(text: str, semaphore: asyncio.Semaphore) -> bytes:
+    """
+    Синтезирует один фрагмент текста в OGG/Opus
+    
+    Args:
+        text: Фрагмент текста (не длиннее лимита TTS)
+        semaphore: Ограничение количества одновременных запросов
+        
+    Returns:
+        bytes: Содержимое OGG/Opus файла
+    """
+    async def request() -> bytes:
+        response = await get_client().audio.speech.create(
+            model="tts-1",
+            voice="onyx",  # Используем голос onyx как указано в ТЗ
+            input=text,
+            response_format="opus",  # OGG/Opus - родной формат голосовых сообщений Telegram
+            **request_timeout()
+        )
+        return response.read()
+    
+    async with semaphore:
+        return await hedger.run('tts', request)
+
+async def _synthesize_chunks(chunks: List[str]) -> List[bytes]:
+    """
+    Параллельно синтезирует фрагменты, сохраняя их порядок
+    
+    При ошибке одного фрагмента остальные запросы отменяются.
+    """
+    semaphore = asyncio.Semaphore(TTS_MAX_CONCURRENCY)
+    tasks = [asyncio.create_task(_synthesize_chunk(chunk, semaphore)) for chunk in chunks]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
 
 async def text_to_speech(text: str, output_path: Path = None) -> Path:
     """
     Преобразует текст в речь с использованием OpenAI TTS
     
+    Текст делится на фрагменты по границам предложений, фрагменты синтезируются
+    параллельными запросами и склеиваются в один OGG/Opus файл на уровне
+    страниц контейнера, без перекодирования.
+    
     Args:
         text: Текст для озвучивания
         output_path: Путь для сохранения аудиофайла (если не указан, создается временный)
@@ -29,40 +77,39 @@ async def text_to_speech(text: str, output_path: Path = None) -> Path:
         ValueError: При ошибках генерации или обработки
     """
     if not output_path:
-        output_path = create_temp_file('.mp3')
+        output_path = create_temp_file('.ogg')
     
     try:
-        # Проверяем длину текста
-        if len(text) > 4096:
-            # OpenAI TTS имеет лимит на длину текста
-            text = text[:4090] + "..."
-            logger.warning("Текст обрезан до лимита TTS")
-        
         if not text.strip():
             raise ValueError("Пустой текст для озвучивания")
         
+        chunks = chunk_text(text, TTS_CHUNK_CHARS)
+        
         # Генерируем речь
-        response = await client.audio.speech.create(
-            model="tts-1",
-            voice="onyx",  # Используем голос onyx как указано в ТЗ
-            input=text,
-            response_format="mp3"
-        )
+        started = time.perf_counter()
+        audio_chunks = await _synthesize_chunks(chunks)
+        
+        # Склеиваем фрагменты (CRC страниц считается в отдельном потоке)
+        audio_bytes = await asyncio.to_thread(concat_opus_streams, audio_chunks)
         
         # Сохраняем аудиофайл
-        response_bytes = response.read()
         with open(output_path, 'wb') as audio_file:
-            audio_file.write(response_bytes)
+            audio_file.write(audio_bytes)
+        temp_file_manager.commit(output_path)
         
         # Проверяем, что файл создан и не пустой
         if not output_path.exists() or output_path.stat().st_size == 0:
             raise ValueError("Не удалось создать аудиофайл")
         
-        logger.info(f"TTS успешно: {len(text)} символов -> {output_path}")
+        logger.info(
+            "TTS успешно: %s символов, %s фрагм. "
+            "за %.2f с -> %s",
+            len(text), len(chunks), time.perf_counter() - started, output_path
+        )
         return output_path
         
     except Exception as e:
-        logger.error(f"Ошибка TTS: {e}")
+        logger.error("Ошибка TTS: %s", e)
         
         # Очищаем файл при ошибке
         if output_path and output_path.exists():
@@ -98,63 +145,29 @@ async def validate_audio_file(file_path: Path) -> bool:
         # Проверяем, что это действительно аудиофайл (базовая проверка)
         with open(file_path, 'rb') as f:
             header = f.read(4)
-            # MP3 файлы обычно начинаются с ID3 тега или синхронизационного слова
+            # OGG начинается с "OggS", MP3 - с ID3 тега или синхронизационного слова
+            if header.startswith(b'OggS'):
+                return True
             if header.startswith(b'ID3') or header.startswith(b'\xff\xfb'):
                 return True
         
         return False
         
     except Exception as e:
-        logger.error(f"Ошибка валидации аудиофайла: {e}")
+        logger.error("Ошибка валидации аудиофайла: %s", e)
         return False
 
 def prepare_text_for_tts(text: str) -> str:
     """
     Подготавливает текст для TTS (очистка, форматирование)
     
+    Убирает Markdown, раскрывает числа и даты, заменяет служебные символы
+    словами (см. text_normalizer.normalize_text)
+    
     Args:
         text: Исходный текст
         
     Returns:
         str: Подготовленный текст
     """
-    if not text:
-        return ""
-    
-    # Убираем лишние пробелы и переносы строк
-    text = ' '.join(text.split())
-    
-    # Заменяем некоторые символы для лучшего произношения
-    replacements = {
-        '&': ' и ',
-        '@': ' собака ',
-        '#': ' хештег ',
-        '%': ' процент ',
-        '$': ' доллар ',
-        '€': ' евро ',
-        '₽': ' рубль ',
-        '+': ' плюс ',
-        '=': ' равно ',
-        '<': ' меньше ',
-        '>': ' больше ',
-        '|': ' или ',
-        '\\': ' слеш ',
-        '/': ' слеш ',
-        '_': ' подчеркивание ',
-        '^': ' степень ',
-        '~': ' тильда ',
-        '`': '',
-        '*': '',
-        '[': '',
-        ']': '',
-        '{': '',
-        '}': '',
-    }
-    
-    for old, new in replacements.items():
-        text = text.replace(old, new)
-    
-    # Убираем множественные пробелы
-    text = ' '.join(text.split())
-    
-    return text.strip()
\ No newline at end of file
+    return normalize_text(text)
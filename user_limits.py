@@ -2,17 +2,24 @@
 Модуль для управления пользователями с истекшим периодом эксплуатации
 """
 import csv
+import io
 import logging
+import threading
 from pathlib import Path
 from datetime import datetime, timedelta
-from typing import Set, Optional
+from typing import Callable, Dict, List, Set, Optional
 from dataclasses import dataclass
 
+from persistence import persistence
+
 logger = logging.getLogger(__name__)
 
 # Путь к CSV файлу с заблокированными пользователями
 BLOCKED_USERS_FILE = Path('data/blocked_users.csv')
 
+# Колонки CSV файла
+CSV_FIELDS = ['user_id', 'username', 'first_name', 'blocked_at', 'reason', 'message_count', 'session_duration']
+
 @dataclass
 class BlockedUser:
     """Информация о заблокированном пользователе"""
@@ -29,7 +36,25 @@ class UserLimitManager:
     
     def __init__(self):
         self._blocked_users: Set[int] = set()
-        self._load_blocked_users()
+        # Строки CSV файла; файл целиком перезаписывается через persistence
+        self._rows: List[Dict[str, str]] = []
+        self._fieldnames: List[str] = list(CSV_FIELDS)
+        self._loaded = False
+        self._load_lock = threading.Lock()
+    
+    def load(self) -> None:
+        """
+        Загружает список блокировок, если он ещё не загружен
+        
+        Бот вызывает метод при запуске в отдельном потоке; остальные методы
+        вызывают его сами, если обращение произошло раньше.
+        """
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                self._load_blocked_users()
+                self._loaded = True
     
     def _load_blocked_users(self) -> None:
         """Загружает список заблокированных пользователей из CSV файла"""
@@ -41,7 +66,11 @@ class UserLimitManager:
             
             with open(BLOCKED_USERS_FILE, 'r', encoding='utf-8', newline='') as file:
                 reader = csv.DictReader(file)
+                if reader.fieldnames:
+                    self._fieldnames = list(reader.fieldnames)
                 for row in reader:
+                    # Некорректные строки сохраняем в файле как есть
+                    self._rows.append(row)
                     try:
                         user_id = int(row['user_id'])
                         self._blocked_users.add(user_id)
@@ -53,30 +82,48 @@ class UserLimitManager:
         except Exception as e:
             logger.error(f"Ошибка загрузки заблокированных пользователей: {e}")
             self._blocked_users = set()
+            self._rows = []
     
     def _create_csv_file(self) -> None:
         """Создает CSV файл с заголовками"""
         try:
-            # Создаем директорию если не существует
-            BLOCKED_USERS_FILE.parent.mkdir(exist_ok=True)
-            
-            with open(BLOCKED_USERS_FILE, 'w', encoding='utf-8', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow([
-                    'user_id', 'username', 'first_name', 'blocked_at', 
-                    'reason', 'message_count', 'session_duration'
-                ])
-            
+            # Файл создаётся при первом обращении, в том числе из синхронного кода
+            persistence.write_logged(BLOCKED_USERS_FILE, self._render())
             logger.info(f"Создан файл заблокированных пользователей: {BLOCKED_USERS_FILE}")
-            
         except Exception as e:
             logger.error(f"Ошибка создания CSV файла: {e}")
     
+    def _render(self) -> Callable[[], str]:
+        """Снимок строк и функция, которая построит из него CSV в потоке записи"""
+        rows = list(self._rows)
+        fieldnames = list(self._fieldnames)
+        
+        def render() -> str:
+            buffer = io.StringIO(newline='')
+            writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+            return buffer.getvalue()
+        
+        return render
+    
+    async def _save(self) -> None:
+        """
+        Перезаписывает CSV файл через persistence и дожидается записи
+        
+        Raises:
+            OSError: Если файл не удалось записать
+        """
+        future = persistence.write(BLOCKED_USERS_FILE, self._render())
+        if future is not None:
+            await future
+    
     def is_user_blocked(self, user_id: int) -> bool:
         """Проверяет, заблокирован ли пользователь"""
+        self.load()
         return user_id in self._blocked_users
     
-    def block_user(self, user_id: int, username: Optional[str] = None, 
+    async def block_user(self, user_id: int, username: Optional[str] = None, 
                    first_name: Optional[str] = None, reason: str = "Превышен лимит", 
                    message_count: int = 0, session_duration: int = 0) -> bool:
         """
@@ -91,9 +138,12 @@ class UserLimitManager:
             session_duration: Длительность сессии в минутах
         
         Returns:
-            True если пользователь успешно заблокирован, False в случае ошибки
+            True если пользователь заблокирован и это записано в файл, False в случае ошибки
         """
+        row = None
         try:
+            self.load()
+            
             # Добавляем в память
             self._blocked_users.add(user_id)
             
@@ -108,31 +158,31 @@ class UserLimitManager:
                 session_duration=session_duration
             )
             
-            # Проверяем существование файла
-            if not BLOCKED_USERS_FILE.exists():
-                self._create_csv_file()
-            
             # Добавляем запись в файл
-            with open(BLOCKED_USERS_FILE, 'a', encoding='utf-8', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow([
-                    blocked_user.user_id,
-                    blocked_user.username or '',
-                    blocked_user.first_name or '',
-                    blocked_user.blocked_at.isoformat(),
-                    blocked_user.reason,
-                    blocked_user.message_count,
-                    blocked_user.session_duration
-                ])
+            row = {
+                'user_id': str(blocked_user.user_id),
+                'username': blocked_user.username or '',
+                'first_name': blocked_user.first_name or '',
+                'blocked_at': blocked_user.blocked_at.isoformat(),
+                'reason': blocked_user.reason,
+                'message_count': str(blocked_user.message_count),
+                'session_duration': str(blocked_user.session_duration)
+            }
+            self._rows.append(row)
+            await self._save()
             
             logger.info(f"Пользователь {user_id} ({first_name}) заблокирован. Причина: {reason}")
             return True
             
         except Exception as e:
             logger.error(f"Ошибка блокировки пользователя {user_id}: {e}")
+            # Блокировка не записана - отменяем её и в памяти
+            self._blocked_users.discard(user_id)
+            if row is not None and row in self._rows:
+                self._rows.remove(row)
             return False
     
-    def unblock_user(self, user_id: int) -> bool:
+    async def unblock_user(self, user_id: int) -> bool:
         """
         Разблокирует пользователя (удаляет из списка и перезаписывает CSV файл)
         
@@ -140,9 +190,11 @@ class UserLimitManager:
             user_id: ID пользователя для разблокировки
         
         Returns:
-            True если пользователь успешно разблокирован, False в случае ошибки
+            True если пользователь разблокирован и это записано в файл, False в случае ошибки
         """
+        removed_rows: List[Dict[str, str]] = []
         try:
+            self.load()
             if user_id not in self._blocked_users:
                 logger.warning(f"Пользователь {user_id} не найден в списке заблокированных")
                 return False
@@ -150,47 +202,25 @@ class UserLimitManager:
             # Удаляем из памяти
             self._blocked_users.remove(user_id)
             
-            # Перезаписываем CSV файл без этого пользователя
-            if not BLOCKED_USERS_FILE.exists():
-                logger.warning("CSV файл не существует")
-                return True
-            
-            # Читаем все записи кроме удаляемой
-            rows_to_keep = []
-            with open(BLOCKED_USERS_FILE, 'r', encoding='utf-8', newline='') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    try:
-                        if int(row['user_id']) != user_id:
-                            rows_to_keep.append(row)
-                    except (ValueError, KeyError):
-                        # Сохраняем некорректные строки
-                        rows_to_keep.append(row)
-            
-            # Перезаписываем файл
-            with open(BLOCKED_USERS_FILE, 'w', encoding='utf-8', newline='') as file:
-                if rows_to_keep:
-                    fieldnames = rows_to_keep[0].keys()
-                    writer = csv.DictWriter(file, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(rows_to_keep)
-                else:
-                    # Если файл стал пустым, создаем с заголовками
-                    writer = csv.writer(file)
-                    writer.writerow([
-                        'user_id', 'username', 'first_name', 'blocked_at', 
-                        'reason', 'message_count', 'session_duration'
-                    ])
+            # Перезаписываем CSV файл без этого пользователя (некорректные строки сохраняем)
+            removed_rows = [row for row in self._rows if row.get('user_id') == str(user_id)]
+            self._rows = [row for row in self._rows if row.get('user_id') != str(user_id)]
+            await self._save()
             
             logger.info(f"Пользователь {user_id} разблокирован")
             return True
             
         except Exception as e:
             logger.error(f"Ошибка разблокировки пользователя {user_id}: {e}")
+            # Разблокировка не записана - возвращаем блокировку в памяти
+            if removed_rows:
+                self._blocked_users.add(user_id)
+                self._rows.extend(removed_rows)
             return False
     
     def get_blocked_users_count(self) -> int:
         """Возвращает количество заблокированных пользователей"""
+        self.load()
         return len(self._blocked_users)
     
     def get_blocked_users_info(self) -> list:
@@ -201,28 +231,24 @@ class UserLimitManager:
             Список словарей с информацией о заблокированных пользователях
         """
         try:
-            if not BLOCKED_USERS_FILE.exists():
-                return []
-            
+            self.load()
             users_info = []
-            with open(BLOCKED_USERS_FILE, 'r', encoding='utf-8', newline='') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    try:
-                        # Парсим дату
-                        blocked_at = datetime.fromisoformat(row['blocked_at'])
+            for row in self._rows:
+                try:
+                    # Парсим дату
+                    blocked_at = datetime.fromisoformat(row['blocked_at'])
                         
-                        users_info.append({
-                            'user_id': int(row['user_id']),
-                            'username': row.get('username', ''),
-                            'first_name': row.get('first_name', ''),
-                            'blocked_at': blocked_at,
-                            'reason': row.get('reason', ''),
-                            'message_count': int(row.get('message_count', 0)),
-                            'session_duration': int(row.get('session_duration', 0))
-                        })
-                    except (ValueError, KeyError) as e:
-                        logger.warning(f"Некорректная строка в CSV: {row}, ошибка: {e}")
+                    users_info.append({
+                        'user_id': int(row['user_id']),
+                        'username': row.get('username', ''),
+                        'first_name': row.get('first_name', ''),
+                        'blocked_at': blocked_at,
+                        'reason': row.get('reason', ''),
+                        'message_count': int(row.get('message_count', 0)),
+                        'session_duration': int(row.get('session_duration', 0))
+                    })
+                except (ValueError, KeyError) as e:
+                    logger.warning(f"Некорректная строка в CSV: {row}, ошибка: {e}")
             
             return users_info
             
@@ -230,7 +256,7 @@ class UserLimitManager:
             logger.error(f"Ошибка получения информации о заблокированных пользователях: {e}")
             return []
     
-    def check_user_limits(self, user_id: int, message_count: int, session_duration_minutes: int,
+    async def check_user_limits(self, user_id: int, message_count: int, session_duration_minutes: int,
                          username: Optional[str] = None, first_name: Optional[str] = None) -> bool:
         """
         Проверяет лимиты пользователя и блокирует при превышении
@@ -250,18 +276,18 @@ class UserLimitManager:
         # Проверяем лимит сообщений
         if message_count >= MAX_MESSAGES_PER_SESSION:
             reason = f"Превышен лимит сообщений ({MAX_MESSAGES_PER_SESSION})"
-            self.block_user(user_id, username, first_name, reason, message_count, session_duration_minutes)
+            await self.block_user(user_id, username, first_name, reason, message_count, session_duration_minutes)
             return True
         
         # Проверяем лимит времени
         if session_duration_minutes >= SESSION_DURATION_MINUTES:
             reason = f"Превышен лимит времени ({SESSION_DURATION_MINUTES} мин)"
-            self.block_user(user_id, username, first_name, reason, message_count, session_duration_minutes)
+            await self.block_user(user_id, username, first_name, reason, message_count, session_duration_minutes)
             return True
         
         return False
     
-    def cleanup_old_blocks(self, days_old: int = 30) -> int:
+    async def cleanup_old_blocks(self, days_old: int = 30) -> int:
         """
         Удаляет старые блокировки (старше указанного количества дней)
         
@@ -270,79 +296,71 @@ class UserLimitManager:
         
         Returns:
             Количество удаленных записей
+            
+        Raises:
+            OSError: Если файл не удалось записать (в памяти блокировки уже сняты
+                и попадут в файл при следующей записи)
         """
         try:
-            if not BLOCKED_USERS_FILE.exists():
-                return 0
-            
+            self.load()
             cutoff_date = datetime.now() - timedelta(days=days_old)
             rows_to_keep = []
             removed_count = 0
             
-            with open(BLOCKED_USERS_FILE, 'r', encoding='utf-8', newline='') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    try:
-                        blocked_at = datetime.fromisoformat(row['blocked_at'])
-                        if blocked_at >= cutoff_date:
-                            rows_to_keep.append(row)
-                        else:
-                            # Удаляем из памяти
-                            user_id = int(row['user_id'])
-                            self._blocked_users.discard(user_id)
-                            removed_count += 1
-                    except (ValueError, KeyError):
-                        # Сохраняем некорректные строки
+            for row in self._rows:
+                try:
+                    blocked_at = datetime.fromisoformat(row['blocked_at'])
+                    if blocked_at >= cutoff_date:
                         rows_to_keep.append(row)
+                    else:
+                        # Удаляем из памяти
+                        user_id = int(row['user_id'])
+                        self._blocked_users.discard(user_id)
+                        removed_count += 1
+                except (ValueError, KeyError):
+                    # Сохраняем некорректные строки
+                    rows_to_keep.append(row)
             
-            # Перезаписываем файл
-            with open(BLOCKED_USERS_FILE, 'w', encoding='utf-8', newline='') as file:
-                if rows_to_keep:
-                    fieldnames = rows_to_keep[0].keys()
-                    writer = csv.DictWriter(file, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(rows_to_keep)
-                else:
-                    # Если файл стал пустым, создаем с заголовками
-                    writer = csv.writer(file)
-                    writer.writerow([
-                        'user_id', 'username', 'first_name', 'blocked_at', 
-                        'reason', 'message_count', 'session_duration'
-                    ])
-            
-            logger.info(f"Удалено {removed_count} старых блокировок (старше {days_old} дней)")
-            return removed_count
+            self._rows = rows_to_keep
             
         except Exception as e:
             logger.error(f"Ошибка очистки старых блокировок: {e}")
             return 0
+        
+        # Перезаписываем файл; ошибка записи передаётся вызывающему
+        await self._save()
+        logger.info(f"Удалено {removed_count} старых блокировок (старше {days_old} дней)")
+        return removed_count
     
-    def clear_all_blocks(self) -> int:
+    async def clear_all_blocks(self) -> int:
         """
         Полностью очищает все блокировки (сброс в 00:00)
         
         Returns:
             Количество удаленных записей
+            
+        Raises:
+            OSError: Если файл не удалось записать (в памяти блокировки уже сняты
+                и попадут в файл при следующей записи)
         """
         try:
-            if not BLOCKED_USERS_FILE.exists():
-                return 0
+            self.load()
             
             # Подсчитываем количество заблокированных пользователей
             blocked_count = len(self._blocked_users)
             
             # Очищаем память
             self._blocked_users.clear()
-            
-            # Создаем пустой файл с заголовками
-            self._create_csv_file()
-            
-            logger.info(f"Выполнена полная очистка блокировок: удалено {blocked_count} записей")
-            return blocked_count
+            self._rows = []
             
         except Exception as e:
             logger.error(f"Ошибка полной очистки блокировок: {e}")
             return 0
+        
+        # Создаем пустой файл с заголовками; ошибка записи передаётся вызывающему
+        await self._save()
+        logger.info(f"Выполнена полная очистка блокировок: удалено {blocked_count} записей")
+        return blocked_count
 
 # Глобальный экземпляр менеджера
 user_limit_manager = UserLimitManager()
\ No newline at end of file
@@ -9,9 +9,13 @@ from pathlib import Path
 from typing import Optional, List
 from telegram import Bot
 from telegram.error import TelegramError
+from telegram.ext import ExtBot
 import logging
 
 from config import ADMIN_IDS, TEMP_DIR, DEBUG_SEND_VOICE, SESSION_DURATION_MINUTES
+from temp_files import temp_file_manager
+from rate_limiter import Priority
+from admin_digest import admin_digest
 
 logger = logging.getLogger(__name__)
 
@@ -38,36 +42,24 @@ class SessionTimer:
 
 def create_temp_file(suffix: str = '.tmp') -> Path:
     """Создает временный файл и возвращает путь к нему"""
-    timestamp = int(time.time() * 1000000)  # микросекунды для уникальности
-    filename = f"temp_{timestamp}{suffix}"
-    return TEMP_DIR / filename
+    return temp_file_manager.create(suffix)
 
 def cleanup_temp_file(file_path: Path) -> None:
     """Удаляет временный файл"""
-    try:
-        if file_path.exists():
-            file_path.unlink()
-            logger.debug(f"Удален временный файл: {file_path}")
-    except Exception as e:
-        logger.error(f"Ошибка удаления временного файла {file_path}: {e}")
+    temp_file_manager.release(file_path)
 
-def cleanup_old_temp_files(max_age_hours: int = 1) -> None:
-    """Удаляет старые временные файлы"""
-    try:
-        cutoff_time = time.time() - (max_age_hours * 3600)
-        for file_path in TEMP_DIR.glob('temp_*'):
-            if file_path.stat().st_mtime < cutoff_time:
-                print("Здесь удаление временного аудиофайла ")
-                #cleanup_temp_file(file_path)
-    except Exception as e:
-        logger.error(f"Ошибка очистки временных файлов: {e}")
+def cleanup_old_temp_files(max_age_hours: int = 1) -> int:
+    """Удаляет старые временные файлы и возвращает их количество"""
+    return temp_file_manager.sweep(max_age_hours * 3600)
 
 async def send_to_admins(
     bot: Bot, 
     message_type: str, 
     content: str = None, 
     voice_file: Path = None,
-    user_name: str = "Пользователь"
+    user_name: str = "Пользователь",
+    user_id: Optional[int] = None,
+    voice_file_id: Optional[str] = None
 ) -> None:
     """
     Отправляет сообщение администраторам
@@ -76,12 +68,19 @@ async def send_to_admins(
         bot: Экземпляр бота
         message_type: Тип сообщения (STT, GPT, Voice (user), Voice (bot))
         content: Текстовое содержимое
-        voice_file: Путь к голосовому файлу (если нужно отправить)
+        voice_file: Путь к голосовому файлу (если нет voice_file_id)
         user_name: Имя пользователя
+        user_id: ID пользователя (нужен для сводок)
+        voice_file_id: file_id голосового сообщения в Telegram (отправляется без загрузки файла)
     """
     if not ADMIN_IDS:
         return
     
+    # В режиме сводок сообщение копится и отправляется вместе с остальными
+    if admin_digest.enabled and user_id is not None:
+        admin_digest.add(bot, user_id, user_name, message_type, content, voice_file_id)
+        return
+    
     current_time = datetime.now().strftime("%H:%M:%S")
     
     # Формируем заголовок сообщения
@@ -92,21 +91,35 @@ async def send_to_admins(
             continue
             
         try:
-            if voice_file and voice_file.exists():
+            if voice_file_id or (voice_file and voice_file.exists()):
                 # Отправляем голосовое сообщение
                 if DEBUG_SEND_VOICE or message_type in ['Voice (user)', 'Voice (bot)']:
-                    with open(voice_file, 'rb') as audio:
+                    if voice_file_id:
+                        # Файл уже есть на серверах Telegram - повторная загрузка не нужна
                         await bot.send_voice(
                             chat_id=admin_id,
-                            voice=audio,
-                            caption=header
+                            voice=voice_file_id,
+                            caption=header,
+                            rate_limit_args=Priority.ADMIN
                         )
+                    else:
+                        # Загружаем файл один раз, остальным админам - по полученному file_id
+                        with open(voice_file, 'rb') as audio:
+                            sent = await bot.send_voice(
+                                chat_id=admin_id,
+                                voice=audio,
+                                caption=header,
+                                rate_limit_args=Priority.ADMIN
+                            )
+                        if sent.voice:
+                            voice_file_id = sent.voice.file_id
             elif content:
                 # Отправляем текстовое сообщение
                 full_message = f"{header}\n[Содержание: {content}]"
                 await bot.send_message(
                     chat_id=admin_id,
-                    text=full_message
+                    text=full_message,
+                    rate_limit_args=Priority.ADMIN
                 )
                 
         except TelegramError as e:
@@ -114,22 +127,35 @@ async def send_to_admins(
         except Exception as e:
             logger.error(f"Неожиданная ошибка при отправке админу {admin_id}: {e}")
 
+# Бот приложения: уведомления идут через его ограничитель запросов
+_notification_bot: Optional[Bot] = None
+
+def set_notification_bot(bot: Bot) -> None:
+    """Задаёт бота для уведомлений, отправляемых без контекста обработчика"""
+    global _notification_bot
+    _notification_bot = bot
+
 async def send_to_admins_text(message: str, bot: Bot = None) -> None:
     """
     Отправляет текстовое сообщение всем администраторам
     
     Args:
         message: Текст сообщения
-        bot: Экземпляр бота (если не передан, создается новый)
+        bot: Экземпляр бота (если не передан, используется бот приложения или создается новый)
     """
     if not ADMIN_IDS:
         return
     
-    # Если бот не передан, создаем новый экземпляр
+    # Если бот не передан, используем бот приложения или создаем новый экземпляр
+    if bot is None:
+        bot = _notification_bot
     if bot is None:
         from config import TELEGRAM_TOKEN
         bot = Bot(token=TELEGRAM_TOKEN)
     
+    # Фоновые уведомления уступают ответам пользователям (rate_limit_args есть только у ExtBot)
+    send_kwargs = {'rate_limit_args': Priority.BACKGROUND} if isinstance(bot, ExtBot) else {}
+    
     for admin_id in ADMIN_IDS:
         if admin_id == 0:  # Пропускаем некорректные ID
             continue
@@ -138,7 +164,8 @@ async def send_to_admins_text(message: str, bot: Bot = None) -> None:
             await bot.send_message(
                 chat_id=admin_id,
                 text=message,
-                parse_mode='Markdown'
+                parse_mode='Markdown',
+                **send_kwargs
             )
             logger.debug(f"Уведомление отправлено администратору {admin_id}")
                 